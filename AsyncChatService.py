@@ -1,11 +1,11 @@
 import asyncio
 import logging
-import queue
 from concurrent.futures import ThreadPoolExecutor
 from typing import AsyncIterator, Iterator, Optional, Tuple
 
-from chatbot import ChatBot
-from chatwithllm import YieldType
+from admission import AdmissionController
+from cancellation import CancellationToken
+from chatwithllm import IChatLogic, YieldType
 
 logger = logging.getLogger("AsyncChatService")
 
@@ -19,7 +19,11 @@ class AsyncChatService:
     """
 
     def __init__(self, database_name: str) -> None:
-        self.chat_logic = ChatBot(database_name)
+        self.database_name = database_name
+        # created on the worker thread, see _initialize_database
+        self.chat_logic: Optional[IChatLogic] = None
+        # the token of the question being answered, see cancel()
+        self.current_cancel: Optional[CancellationToken] = None
 
         # Create a dedicated executor pool with ONLY ONE worker thread
         self.executor: ThreadPoolExecutor = ThreadPoolExecutor(
@@ -27,62 +31,159 @@ class AsyncChatService:
             thread_name_prefix="DBWorker"
         )
 
+        # Questions wait here, not in the unbounded queue of the executor;
+        # the controller hands them to the executor one at a time
+        self.admission = AdmissionController(self.executor.submit)
+
         # Submit the open_database call as the first task to the single thread.
         self._initialize_database()
 
     def _initialize_database(self) -> None:
-        """Runs the blocking open_database() call on the worker thread."""
+        """
+        Queues the blocking open_database() call on the worker thread.
+
+        We do not wait for it: the user can type the first question while
+        the database opens, and that question simply queues behind it.
+        """
 
         def init_task() -> None:
+            # chatbot.py and the Gramps modules it needs take the better part
+            # of a second to import, so that happens here and not before the
+            # first prompt is shown.
+            from chatbot import ChatBot
+
+            self.chat_logic = ChatBot(self.database_name)
             logger.debug("Running open_database on the dedicated worker thread.")
             self.chat_logic.open_database_for_chat()
 
-        # Blocking wait for the database to open on the worker thread.
-        future = self.executor.submit(init_task)
-        future.result()
+        self.database_ready = self.executor.submit(init_task)
+
+    def cancel(self) -> None:
+        """
+        Cancels the question being answered, if any. The worker is free for
+        the next question within a fraction of a second.
+        """
+        if self.current_cancel is not None:
+            self.current_cancel.cancel()
+
+    @property
+    def idle(self) -> bool:
+        """
+        True when the database is open and no question is running or waiting.
+        """
+        return (
+            self.database_ready.done()
+            and not self.admission.busy
+            and not self.admission.depth()
+        )
+
+    def warm_up(self) -> None:
+        """
+        Queues building the indexes of the tree on the worker thread, behind
+        the opening of the database.
+        """
+
+        def warm_up_task() -> None:
+            try:
+                self.database_ready.result()
+                self.chat_logic.warm_up()
+            except Exception as exc:
+                logger.warning(f"Unable to warm up {self.database_name}: {exc}")
+
+        self.executor.submit(warm_up_task)
+
+    def memory_bytes(self) -> int:
+        """
+        Returns an estimate of the memory of the indexes and caches of the
+        tree; 0 while the database opens.
+        """
+        if self.chat_logic is None:
+            return 0
+        return self.chat_logic.memory_bytes()
 
     def stop_worker(self) -> None:
-        """Shuts down the executor pool."""
-        # Optional: Submit close_database to ensure it runs on the worker thread,
-        # but needs careful handling as shutdown might be concurrent.
+        """Closes the database and shuts down the executor pool."""
+        self.cancel()
+
+        def close_task() -> None:
+            if self.chat_logic is not None:
+                self.chat_logic.close_database()
 
-        # We rely on the executor's shutdown mechanism for cleanup.
+        # queued behind the question being answered, on the worker thread
+        # that opened the database
+        self.executor.submit(close_task)
         self.executor.shutdown(wait=True)
 
-    async def get_reply_stream(self, query: str) -> AsyncIterator[ReplyItem]:
+    async def get_reply_stream(
+        self, query: str, client_id: str = "console"
+    ) -> AsyncIterator[ReplyItem]:
         """
         Asynchronously submits a query to the single-worker executor and yields results
-        as they come back from the thread.
+        as they come back from the thread. While the query waits for the
+        questions of others it yields (YieldType.QUEUED, place in the queue).
+        Raises AdmissionRejected when the queue is full.
+
+        When the stream is closed early, e.g. because the task reading it
+        was cancelled, the query is cancelled on the worker thread too.
         """
-        loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        cancel = CancellationToken()
+
+        # The worker hands the replies to the event loop; awaiting this queue
+        # does not block a thread, so the wait can always be cancelled
+        result_queue: asyncio.Queue[Optional[ReplyItem]] = asyncio.Queue()
 
-        # Create a synchronous queue for this reply stream
-        result_queue: queue.Queue[Optional[ReplyItem]] = queue.Queue()
+        def put(item: Optional[ReplyItem]) -> None:
+            try:
+                loop.call_soon_threadsafe(result_queue.put_nowait, item)
+            except RuntimeError:
+                # the event loop is closed: nobody reads the replies anymore
+                cancel.cancel()
 
         # Define the synchronous wrapper function that will run on the executor thread
         def generate_replies_on_worker() -> None:
             # This runs on the *single* dedicated worker thread.
-
-            # The type hint for the generator: Iterator[ReplyItem]
-            reply_iterator: Iterator[ReplyItem] = self.chat_logic.get_reply(query)
-
-            for reply in reply_iterator:
-                result_queue.put(reply)
-            result_queue.put(None)  # Sentinel
-
-        # Submit the wrapper function to the dedicated executor
-        self.executor.submit(generate_replies_on_worker)
+            self.current_cancel = cancel
+            try:
+                # already finished: it was the first task of this thread
+                self.database_ready.result()
+
+                if cancel.cancelled:
+                    # cancelled while queued behind the database opening
+                    return
+
+                # The type hint for the generator: Iterator[ReplyItem]
+                reply_iterator: Iterator[ReplyItem] = self.chat_logic.get_reply(
+                    query, cancel
+                )
+
+                for reply in reply_iterator:
+                    put(reply)
+            except Exception as exc:
+                logger.debug(exc)
+                put((YieldType.FINAL, f"Error: {exc}"))
+            finally:
+                self.current_cancel = None
+                put(None)  # Sentinel
+
+        # Hand the wrapper function to the dedicated executor, fairly
+        # between the clients
+        ticket = self.admission.admit(
+            client_id,
+            generate_replies_on_worker,
+            lambda position: put((YieldType.QUEUED, str(position))),
+        )
 
         # 4. Asynchronously read from the queue back on the main async thread
-        while True:
-            # We use run_in_executor to block ASYNCHRONOUSLY on the queue.
-            # We hint the expected return type is Optional[ReplyItem],
-            # meaning it can be ReplyItem or None.
-            reply: Optional[ReplyItem] = await (
-                loop.run_in_executor(None, result_queue.get)
-            )
-            if reply is None:  # Sentinel received
-                break  # to end the async generator
-
-            # Since reply is guaranteed not to be None here, it is a ReplyItem
-            yield reply
+        try:
+            while True:
+                reply: Optional[ReplyItem] = await result_queue.get()
+                if reply is None:  # Sentinel received
+                    break  # to end the async generator
+
+                # Since reply is guaranteed not to be None here, it is a ReplyItem
+                yield reply
+        finally:
+            # a no-op when the reply is complete
+            cancel.cancel()
+            self.admission.withdraw(ticket)
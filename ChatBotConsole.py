@@ -1,11 +1,15 @@
+import argparse
 import asyncio
+import json
 import logging
 import os
 
 from gramps.gen.config import CONFIGMAN
 
+from admission import AdmissionRejected
 from AsyncChatService import AsyncChatService
-from chatbot import YieldType
+from ChatServicePool import ChatServicePool
+from chatwithllm import YieldType
 
 logger = logging.getLogger("chatbot")
 
@@ -17,8 +21,29 @@ class ChatBotConsole:
     """
     def __init__(self, database_name):
         logger.debug("Initializing ChatBotConsole")
-        # Encapsulate the threading logic
-        self.chat_service = AsyncChatService(database_name)
+        self.database_name = database_name
+        # the open trees, each with its own service that encapsulates the
+        # threading logic
+        self.pool = ChatServicePool()
+        self.chat_service: AsyncChatService = self.pool.service(database_name)
+
+    def switch_tree(self, query: str) -> None:
+        """
+        /tree <name> continues the chat with another tree; /tree lists them.
+        """
+        parts = query.split(maxsplit=1)
+        names = self.get_gramps_database_names()
+        if len(parts) == 1:
+            for name in names:
+                marker = "*" if name == self.database_name else " "
+                print(f"{marker} {name}")
+            return
+        if parts[1] not in names:
+            print(f"Unknown tree: {parts[1]}, use one of {', '.join(names)}")
+            return
+        self.database_name = parts[1]
+        self.chat_service = self.pool.service(self.database_name)
+        print(f"Chatting with {self.database_name}")
 
     def chat_loop(self):
         # We don't need to start/stop the worker here; the service handles it
@@ -28,21 +53,39 @@ class ChatBotConsole:
                 query = input("\n\nEnter your question: ")
                 if not query:
                     break
+                if query.strip() == "/queue":
+                    # answered here: the chat service, not the chatbot, queues
+                    print(json.dumps(self.chat_service.admission.stats(), indent=2))
+                    continue
+                if query.strip() == "/tree" or query.startswith("/tree "):
+                    self.switch_tree(query)
+                    continue
+                if query.strip() == "/trees":
+                    print(json.dumps(self.pool.stats(), indent=2))
+                    continue
 
                 # Run the asynchronous processing for this single query
                 try:
                     asyncio.run(self.process_query_async(query))
+                except KeyboardInterrupt:
+                    # Ctrl-C stops this question, not the chat
+                    self.chat_service.cancel()
+                    print("\n>>> Cancelled")
+                except AdmissionRejected as e:
+                    print(f"\n>>> {e}")
                 except Exception as e:
                     print(f"An error occurred: {e}")
                     break
         finally:
-            # Crucial: Stop the persistent worker when the app exits
-            self.chat_service.stop_worker()
+            # Crucial: Stop the persistent workers when the app exits
+            self.pool.close()
 
     async def process_query_async(self, query):
         """
         Asynchronously processes a single query and prints the replies as they come in.
         """
+        # the tree may have been closed while the chat was idle
+        self.chat_service = self.pool.service(self.database_name)
         # The ChatThreading service handles all the threading and queues.
         # We just iterate over the async generator it returns.
         async for reply in self.chat_service.get_reply_stream(query):
@@ -54,26 +97,27 @@ class ChatBotConsole:
                 print(" - toolcall: ", content, flush=True)
             elif reply_type == YieldType.FINAL:
                 print("\n>>>", content)
+            elif reply_type == YieldType.QUEUED:
+                print(f" - waiting, place {content} in the queue", flush=True)
 
     def get_gramps_database_names(self) -> list[str]:
         """
         Returns a list of available Gramps database names.
         """
-        db_path = CONFIGMAN.get("database.path")
-        if not os.path.isdir(db_path):
-            raise Exception(f"Database path does not exist: {db_path}")
-        db_names = [
-            name
-            for name in os.listdir(db_path)
-            if os.path.isdir(os.path.join(db_path, name))
-        ]
-        return db_names
+        return self.pool.database_names()
 
 
 # overwrite the default database path in case the env variable is set
 GRAMPS_DB_LOCATION = os.environ.get("GRAMPS_DB_LOCATION")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat with your Gramps tree")
+    parser.add_argument(
+        "--debug", action="store_true", help="show debug logging of the chat"
+    )
+    if parser.parse_args().debug:
+        # read by chatbot.py when the chat service imports it
+        os.environ["GRAMPS_AI_DEBUG"] = "1"
     # Get the database name from the environment variable
     database_name = os.getenv("GRAMPS_DB_NAME")
     logger.debug(f"Attempting to initialize Chatbot with database: {database_name}")
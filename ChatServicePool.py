@@ -0,0 +1,218 @@
+"""
+The chat services of several Gramps trees in one process.
+
+A tree is opened when a session first asks for it, in an AsyncChatService
+of its own: its own database worker, indexes and caches. The services are
+kept in least recently used order. When the open trees take more than the
+memory budget, or there are more than GRAMPS_AI_MAX_OPEN_TREES of them,
+the least recently used trees that are not answering a question are
+closed. The uses of every tree are counted in a file in the database
+folder, written at most once a minute and on close, and the most used
+trees are opened and their indexes built in the background while there is
+room, so their first question does not wait.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from gramps.gen.config import CONFIGMAN
+
+from AsyncChatService import AsyncChatService
+
+logger = logging.getLogger("ChatServicePool")
+
+# memory for the open trees, and their number
+GRAMPS_AI_MEMORY_BUDGET_MB = int(os.environ.get("GRAMPS_AI_MEMORY_BUDGET_MB", "2048"))
+GRAMPS_AI_MAX_OPEN_TREES = int(os.environ.get("GRAMPS_AI_MAX_OPEN_TREES", "8"))
+# what an open tree takes besides its indexes and caches: the database
+# connection and caches of Gramps, the worker thread, the chat history
+TREE_BASE_BYTES = 64 * 1024 * 1024
+# the most used trees that are kept open and warm when there is room
+WARM_TREES = 2
+USAGE_FILE_NAME = "chatbot_usage.json"
+# seconds between two writes of the usage file
+USAGE_SAVE_SECONDS = 60.0
+
+
+def database_names(db_path: str) -> List[str]:
+    """
+    Returns the names of the trees in a Gramps database folder, as given
+    in the name.txt of every tree.
+    """
+    if not os.path.isdir(db_path):
+        raise Exception(f"Database path does not exist: {db_path}")
+    names = []
+    for folder in sorted(os.listdir(db_path)):
+        name_file = os.path.join(db_path, folder, "name.txt")
+        if not os.path.isfile(name_file):
+            continue
+        with open(name_file, encoding="utf-8") as f:
+            names.append(f.read().strip() or folder)
+    return names
+
+
+class ChatServicePool:
+    """
+    Opens, keeps and closes the chat services of the trees in the Gramps
+    database folder.
+    """
+
+    def __init__(
+        self,
+        memory_budget: int = GRAMPS_AI_MEMORY_BUDGET_MB * 1024 * 1024,
+        max_open: int = GRAMPS_AI_MAX_OPEN_TREES,
+        db_path: Optional[str] = None,
+    ) -> None:
+        self.memory_budget = memory_budget
+        self.max_open = max(1, max_open)
+        self.db_path = db_path or CONFIGMAN.get("database.path")
+        # tree name -> its service, the least recently used first
+        self.services: "OrderedDict[str, AsyncChatService]" = OrderedDict()
+        self.uses: Dict[str, int] = self._load_uses()
+        self._uses_saved = time.monotonic()
+        self._uses_changed = False
+        # the trees in the database folder, read on first use and again
+        # when the list is asked for
+        self._names: Optional[List[str]] = None
+        self.opened = 0
+        self.closed = 0
+        self._lock = threading.Lock()
+        # closes the evicted trees without blocking the caller
+        self._closer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="TreeCloser"
+        )
+
+    def _usage_path(self) -> str:
+        return os.path.join(self.db_path, USAGE_FILE_NAME)
+
+    def _load_uses(self) -> Dict[str, int]:
+        try:
+            with open(self._usage_path(), encoding="utf-8") as f:
+                return {name: int(count) for name, count in json.load(f).items()}
+        except (OSError, ValueError, AttributeError):
+            return {}
+
+    def _save_uses(self) -> None:
+        self._uses_saved = time.monotonic()
+        self._uses_changed = False
+        try:
+            with open(self._usage_path(), "w", encoding="utf-8") as f:
+                json.dump(self.uses, f)
+        except OSError as exc:
+            logger.debug(f"Unable to store the tree usage: {exc}")
+
+    def database_names(self) -> List[str]:
+        """
+        Returns the names of the trees, read again from the database folder.
+        """
+        names = database_names(self.db_path)
+        with self._lock:
+            self._names = names
+        return names
+
+    def service(self, database_name: str) -> AsyncChatService:
+        """
+        Returns the chat service of a tree, opening the tree if needed.
+        """
+        with self._lock:
+            service = self.services.get(database_name)
+            if service is None:
+                service = self._open(database_name)
+            else:
+                self.services.move_to_end(database_name)
+            self.uses[database_name] = self.uses.get(database_name, 0) + 1
+            self._uses_changed = True
+            if time.monotonic() - self._uses_saved >= USAGE_SAVE_SECONDS:
+                self._save_uses()
+            self._evict(keep=database_name)
+            self._warm_up()
+        return service
+
+    def _open(self, database_name: str) -> AsyncChatService:
+        logger.debug(f"Opening tree {database_name}")
+        service = AsyncChatService(database_name)
+        self.services[database_name] = service
+        self.opened += 1
+        return service
+
+    def memory_bytes(self) -> int:
+        return sum(
+            TREE_BASE_BYTES + service.memory_bytes()
+            for service in self.services.values()
+        )
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        """
+        Closes the least recently used idle trees while the open trees are
+        over the budget; the lock is held.
+        """
+        for name in list(self.services):
+            if (
+                len(self.services) <= self.max_open
+                and self.memory_bytes() <= self.memory_budget
+            ):
+                return
+            service = self.services[name]
+            if name == keep or not service.idle:
+                continue
+            logger.debug(f"Closing idle tree {name}")
+            del self.services[name]
+            self.closed += 1
+            self._closer.submit(service.stop_worker)
+
+    def _warm_up(self) -> None:
+        """
+        Opens the most used trees that are not open, in the background,
+        while they fit; the lock is held.
+        """
+        most_used = sorted(self.uses, key=self.uses.get, reverse=True)[:WARM_TREES]
+        if self._names is None:
+            self._names = database_names(self.db_path)
+        for name in most_used:
+            if name in self.services or name not in self._names:
+                continue
+            if (
+                len(self.services) >= self.max_open
+                or self.memory_bytes() + TREE_BASE_BYTES > self.memory_budget
+            ):
+                return
+            logger.debug(f"Warming up tree {name}")
+            service = self._open(name)
+            # the least recently used: the first to go when room is needed
+            self.services.move_to_end(name, last=False)
+            service.warm_up()
+
+    def close(self) -> None:
+        with self._lock:
+            services = list(self.services.values())
+            self.services.clear()
+            if self._uses_changed:
+                self._save_uses()
+        for service in services:
+            service.stop_worker()
+        self._closer.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "open": {
+                    name: {
+                        "idle": service.idle,
+                        "memory_mb": round(
+                            (TREE_BASE_BYTES + service.memory_bytes()) / 2**20, 1
+                        ),
+                        "queue": service.admission.depth(),
+                    }
+                    for name, service in self.services.items()
+                },
+                "uses": self.uses,
+                "memory_budget_mb": round(self.memory_budget / 2**20),
+                "max_open": self.max_open,
+                "opened": self.opened,
+                "closed": self.closed,
+            }
@@ -17,14 +17,13 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 #
-import inspect
 import json
 import logging
 import os
-import re
 import sys
 import time
-from typing import Any, Dict, Iterator, List, Optional, Pattern, Tuple
+from typing import (Any, Callable, Dict, Generator, Iterator, List, Optional,
+                    Tuple)
 
 from gramps.gen.const import GRAMPS_LOCALE as glocale
 # from gramps.gen.db.utils import open_database
@@ -32,21 +31,28 @@ from gramps.gen.display.place import displayer as place_displayer
 # from gramps.gen.plug import Gramplet
 from gramps.gen.simple import SimpleAccess
 
+from cancellation import CancellationToken, QueryCancelled
 from chatwithllm import IChatLogic, YieldType
-from litellm_utils import function_to_litellm_definition
+from date_index import EventDateIndex
+from fast_path import FastPath
+from home_digest import HomeDigest
+from index_maintenance import IndexMaintenance
+from litellm_utils import ToolArgumentError, ToolRegistry
+from llm_client import HEDGE_SECONDS, LLMClient, LLMError
+from model_router import COMPLEX, SIMPLE, SIMPLE_TIER_MAX_TURNS, ModelRouter
+from people_search import (DEFAULT_PEOPLE_RESULTS, MAX_PEOPLE_RESULTS,
+                           find_people)
+from prefetch import (NeighborhoodPrefetcher, person_handles,
+                      person_neighborhood)
+from rawdata_utils import chatbot_cache_dir, event_summary
+from scan_engine import ScanEngine, people_with_attribute
+from sidecar_index import VITAL_EVENTS, SidecarIndex
+from sql_pushdown import SqlPushdown
+from tool_cache import ToolResultCache, tool_cache_key
+from tree_query import run_query
 
 LOG = logging.getLogger(".")
 
-
-try:
-    import litellm
-except ImportError as e:
-    LOG.warning(e)
-    raise Exception("ChatWithTree requires litellm")
-
-
-litellm.drop_params = True
-
 # gramps translation support for this module
 _ = glocale.translation.gettext
 
@@ -68,6 +74,39 @@ export GRAMPS_AI_MODEL_URL="<ENTER URL HERE>"
 
 This is needed if running your own LLM server. Example: "http://127.0.0.1:8000"
 
+```
+export GRAMPS_AI_COLUMNAR_DIR="<ENTER FOLDER HERE>"
+```
+
+Optional: a folder written by `python columnar_export.py <database> <folder>`.
+The tree_statistics tool then loads its data from there instead of reading
+the whole database.
+
+```
+export GRAMPS_AI_SIMPLE_MODEL_NAME="<ENTER MODEL NAME HERE>"
+```
+
+Optional: a small, fast model such as "ollama/llama3.2" for simple lookups
+like "when was X born". Other questions, and simple ones it cannot answer,
+go to GRAMPS_AI_MODEL_NAME. /metrics shows how each model performs.
+
+```
+export GRAMPS_AI_FALLBACK_MODEL_NAMES="<MODEL NAME>,<MODEL NAME>"
+export GRAMPS_AI_HEDGE_SECONDS=15
+```
+
+Optional: models, in order, that also get the request when the model
+asked has not answered within GRAMPS_AI_HEDGE_SECONDS (default 15) or
+fails. The first answer is used; /metrics shows how often each model won.
+
+```
+export GRAMPS_AI_HOME_DIGEST=1
+```
+
+Optional: add the home person with parents, grandparents, spouses,
+siblings, children and grandchildren to the system prompt, which saves the
+first tool calls of most chats at the cost of a longer prompt.
+
 You can find a list of litellm providers here:
 https://docs.litellm.ai/docs/providers
 
@@ -136,10 +175,64 @@ query as soon as you have sufficient information.
       Clearly state what you found and what information you were unable to obtain.
 
 You can get the start point of the genealogy tree using the `start_point` tool.
+For questions that take several steps through the tree, such as grandparents,
+cousins or the birth places of all children, use the `query_tree` tool to get
+the answer in one call instead of looking up one person at a time.
 """
 
 GRAMPS_AI_MODEL_NAME = os.environ.get("GRAMPS_AI_MODEL_NAME")
 GRAMPS_AI_MODEL_URL = os.environ.get("GRAMPS_AI_MODEL_URL")
+# optional small (local) model for simple lookups, see model_router.py
+GRAMPS_AI_SIMPLE_MODEL_NAME = os.environ.get("GRAMPS_AI_SIMPLE_MODEL_NAME")
+# models that also get a request when the model asked has not answered
+# within GRAMPS_AI_HEDGE_SECONDS, in this order
+GRAMPS_AI_FALLBACK_MODEL_NAMES = [
+    name.strip()
+    for name in os.environ.get("GRAMPS_AI_FALLBACK_MODEL_NAMES", "").split(",")
+    if name.strip()
+]
+GRAMPS_AI_HEDGE_SECONDS = float(
+    os.environ.get("GRAMPS_AI_HEDGE_SECONDS", str(HEDGE_SECONDS))
+)
+# folder with a columnar export (see columnar_export.py) to load the
+# tree_statistics snapshot from instead of reading the whole database
+GRAMPS_AI_COLUMNAR_DIR = os.environ.get("GRAMPS_AI_COLUMNAR_DIR")
+# add the home person and their close family to the system prompt
+GRAMPS_AI_HOME_DIGEST = os.environ.get("GRAMPS_AI_HOME_DIGEST", "").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+# upper bound for the "limit" argument of the find_events_in_range tool
+MAX_EVENTS_IN_RANGE = 200
+# upper bound for the "limit" argument of the search_notes tool
+MAX_NOTE_RESULTS = 50
+# upper bound for the number of groups returned by the tree_statistics tool
+MAX_STATISTICS_GROUPS = 100
+# upper bound for the "limit" argument of the query_tree tool
+MAX_QUERY_RESULTS = 200
+# upper bound for the "k" argument of the semantic_search tool
+MAX_SEMANTIC_RESULTS = 50
+# memory for tool results kept to answer repeated and prefetched tool calls
+TOOL_CACHE_MAX_BYTES = 16 * 1024 * 1024
+# after this many LLM turns in which every tool call repeated an earlier
+# one, the model is looping and is asked for its final answer
+MAX_REPEATED_TOOL_TURNS = 2
+
+DUPLICATE_TOOL_CALL = (
+    "This is the same call as tool call {tool_call_id}, its result is above. "
+    "Use that result instead of calling the tool again."
+)
+# the answer to a question the user cancelled, and to its open tool calls
+CANCELLED_ANSWER = "The question was cancelled."
+CANCELLED_TOOL_CALL = "Not run: the question was cancelled."
+# the final answer when the LLM could not be reached
+LLM_ERROR = "Error in LLM completion: {error}"
+
+
+def _call_here(func: Callable[[], Any]) -> Any:
+    return func()
 
 
 # ===
@@ -152,6 +245,54 @@ class ChatBot(IChatLogic):
         self.dbstate = gramplet_instance.dbstate
         self.db = self.dbstate.db
         self.sa = SimpleAccess(self.db)
+        # runs the database work of a question on the thread that owns the
+        # database; GrampletChatDriver hands it to the GTK main loop
+        self.run_in_db_thread: Callable[[Callable[[], Any]], Any] = _call_here
+        # the edits made in Gramps, applied to the indexes and caches below
+        # when a question starts
+        self.index_maintenance = IndexMaintenance()
+        self.index_maintenance.watch(self.db)
+        self._database_changed_key = self.dbstate.connect(
+            "database-changed", self.index_maintenance.database_changed
+        )
+        # built on first use by the find_events_in_range tool
+        self.date_index = None
+        # the name, date and place filters in SQL, made on first use
+        self._pushdown = None
+        # the indexes of the search tools on disk, brought up to date on
+        # first use
+        self._sidecar = None
+        # scans the whole tree for find_people_by_attribute, made on first use
+        self._scan_engine = None
+        # columnar snapshot for the tree_statistics tool, built on first use
+        self.tree_snapshot = None
+        # the columnar export is out of date once the tree was edited
+        self.tree_edited = False
+        # person profile vectors for the semantic_search tool, loaded or
+        # built on first use
+        self.semantic_index = None
+        # the token of the question whose tool call is running, checked by
+        # the tools that read the whole tree
+        self.cancel_token = None
+        # results of earlier tool calls, also filled ahead of time by the
+        # prefetcher with the neighborhood of the persons the LLM looked up
+        self.tool_cache = ToolResultCache(TOOL_CACHE_MAX_BYTES)
+        # (tool, arguments) key -> id of the tool call that answered it in
+        # this conversation, to turn repeated calls into a back-reference
+        self.answered_tool_calls: Dict[str, str] = {}
+        # the home person's family in the system prompt, if enabled
+        self.home_digest = HomeDigest() if GRAMPS_AI_HOME_DIGEST else None
+        # pooled connections, timeouts and retries for the LLM requests
+        self.llm_client = LLMClient()
+        # sends simple lookups to GRAMPS_AI_SIMPLE_MODEL_NAME, if set
+        self.model_router = ModelRouter(GRAMPS_AI_SIMPLE_MODEL_NAME)
+        self.prefetcher = NeighborhoodPrefetcher(
+            self.tool_cache,
+            self.compute_tool,
+            lambda person_handle: self.run_in_db_thread(
+                lambda: person_neighborhood(self.db, person_handle)
+            ),
+        )
 
         self.messages = []
         self.messages.append({"role": "system", "content": SYSTEM_PROMPT})
@@ -172,17 +313,169 @@ class ChatBot(IChatLogic):
             "get_event_place": self.get_event_place,
             "get_child_in_families": self.get_child_in_families,
             "find_people_by_name": self.find_people_by_name,
+            "find_people_by_attribute": self.find_people_by_attribute,
+            "find_events_in_range": self.find_events_in_range,
+            "search_notes": self.search_notes,
+            "tree_statistics": self.tree_statistics,
+            "query_tree": self.query_tree,
+            "semantic_search": self.semantic_search,
         }
-        self.tool_definitions = [
-            function_to_litellm_definition(func) for func in self.tool_map.values()
-        ]
+        # answers common questions such as "who is the father of X" without
+        # the LLM
+        self.fast_path = FastPath(self.tool_map)
+        # built on first use, see the tool_registry property
+        self._tool_registry: Optional[ToolRegistry] = None
 
         # This dictionary maps command names to their handler methods
         self.command_handlers = {
             "/help": self.command_handle_help,
             "/history": self.command_handle_history,
             "/setmodel": self.command_handle_setmodel,
+            "/metrics": self.command_handle_metrics,
         }
+        self.open_database_for_chat()
+
+    def open_database_for_chat(self) -> None:
+        """
+        The database is opened by Gramps; this prepares the system prompt.
+        """
+        self.update_system_prompt()
+
+    def update_system_prompt(self) -> None:
+        """
+        Adds the digest of the home person to the system message, when that
+        option is on, and rebuilds it when the tree changed around them.
+        """
+        if self.home_digest is not None and self.home_digest.refresh(self.db):
+            self.messages[0]["content"] = SYSTEM_PROMPT + self.home_digest.text
+
+    def close(self) -> None:
+        """
+        Stops following the database and closes the indexes; for when the
+        gramplet is done with this chatbot.
+        """
+        self.index_maintenance.stop()
+        self.dbstate.disconnect(self._database_changed_key)
+        self._close_indexes()
+        self.llm_client.close()
+
+    def _close_indexes(self) -> None:
+        if self._sidecar is not None:
+            self._sidecar.close()
+            self._sidecar = None
+        if self._pushdown is not None:
+            self._pushdown.close()
+            self._pushdown = None
+        if self._scan_engine is not None:
+            self._scan_engine.close()
+            self._scan_engine = None
+        self.date_index = None
+        self.tree_snapshot = None
+        self.semantic_index = None
+
+    def apply_tree_changes(self) -> None:
+        """
+        Brings the indexes and caches up to date with the edits made in
+        Gramps since the last question; only the changed objects are
+        indexed again.
+        """
+        changes = self.index_maintenance.take()
+        if not changes:
+            return
+        # a tool result may depend on any object, e.g. a family of a person;
+        # so may an earlier answer in this chat, repeated calls run again
+        self.tool_cache.clear()
+        self.answered_tool_calls.clear()
+        # the prefetched neighborhoods went with the cache
+        self.prefetcher.reset()
+        if changes.database is not None:
+            LOG.debug("The database changed, dropping the indexes")
+            self._close_indexes()
+            self.db = changes.database
+            self.sa = SimpleAccess(self.db)
+            self.tree_edited = False
+            if self.home_digest is not None:
+                self.home_digest = HomeDigest()
+            return
+        self.tree_edited = True
+        # the snapshot is columnar and only rebuilt as a whole, when used
+        self.tree_snapshot = None
+        if changes.rebuild:
+            self.date_index = None
+            self.semantic_index = None
+            if self._sidecar is not None:
+                self._sidecar.refresh()
+            return
+        if self.date_index is not None:
+            for handle in changes.handles["Event"]:
+                raw_event = self.db.get_raw_event_data(handle)
+                if raw_event:
+                    self.date_index.add_event(handle, raw_event)
+                else:
+                    self.date_index.remove_event(handle)
+        people = changes.people(self.db)
+        if self._sidecar is not None:
+            # the people for their birth and death years too
+            self._sidecar.update("Person", people)
+            for object_type in ("Place", "Note", "Source", "Citation"):
+                self._sidecar.update(object_type, changes.handles[object_type])
+        if self.semantic_index is not None:
+            from semantic_index import person_profile
+
+            place_names: Dict[str, str] = {}
+            for handle in people:
+                raw_person = self.db.get_raw_person_data(handle)
+                self.semantic_index.update(
+                    handle,
+                    person_profile(self.db, raw_person, place_names)
+                    if raw_person
+                    else None,
+                )
+
+    @property
+    def sidecar(self) -> SidecarIndex:
+        """
+        The indexes of the search tools, in a SQLite file next to the tree.
+        """
+        if self._sidecar is None:
+            self._sidecar = SidecarIndex.open(self.db)
+        return self._sidecar
+
+    @property
+    def scan_engine(self) -> ScanEngine:
+        """
+        Scans whole tables of the tree for the questions no index answers.
+        """
+        if self._scan_engine is None:
+            # read in this process: worker processes would start another
+            # Gramps inside the Gramps window
+            self._scan_engine = ScanEngine(self.db, workers=1)
+        return self._scan_engine
+
+    @property
+    def pushdown(self) -> SqlPushdown:
+        """
+        The filters of the tools in SQL, when the tree is stored in SQLite.
+        """
+        if self._pushdown is None:
+            self._pushdown = SqlPushdown(self.db)
+        return self._pushdown
+
+    @property
+    def tool_definitions(self) -> List[Dict[str, Any]]:
+        """
+        The litellm definitions of all tools, built when first sent to the LLM.
+        """
+        return self.tool_registry.definitions
+
+    @property
+    def tool_registry(self) -> ToolRegistry:
+        """
+        The tools with their definitions and argument checks, built once.
+        """
+        if self._tool_registry is None:
+            self._tool_registry = ToolRegistry(self.tool_map)
+        return self._tool_registry
 
     def command_handle_help(self, message: str) -> Iterator[Tuple[YieldType, str]]:
         """
@@ -220,10 +513,33 @@ class ChatBot(IChatLogic):
         GRAMPS_AI_MODEL_NAME = new_model_name
         yield (YieldType.FINAL, f"Model name set to: {GRAMPS_AI_MODEL_NAME}")
 
+    def command_handle_metrics(self, message: str) -> Iterator[Tuple[YieldType, str]]:
+        """
+        returns the answer rates and latencies per model tier
+        and the use of the tool cache
+        """
+        metrics = {
+            "models": {
+                SIMPLE: self.model_router.simple_model,
+                COMPLEX: GRAMPS_AI_MODEL_NAME,
+            },
+            "tiers": self.model_router.summary(),
+            "fast_path": self.fast_path.stats(),
+            "tool_cache": self.tool_cache.stats(),
+            "index_maintenance": self.index_maintenance.stats(),
+            "tool_arguments": self.tool_registry.stats(),
+            "llm": self.llm_client.summary(),
+            "hedging": self.llm_client.hedging.summary(),
+        }
+        yield (YieldType.FINAL, json.dumps(metrics, indent=4))
+
     # The implementation of the IChatLogic interface
-    def get_reply(self, message: str) -> Iterator[Tuple[YieldType, str]]:
+    def get_reply(
+        self, message: str, cancel: Optional[CancellationToken] = None
+    ) -> Iterator[Tuple[YieldType, str]]:
         """
-        Processes the message and returns a reply.
+        Processes the message and returns a reply. Cancelling `cancel`
+        stops the work on the reply as soon as possible.
         """
         # Strip leading/trailing whitespace
         message = message.strip()
@@ -242,9 +558,17 @@ class ChatBot(IChatLogic):
                 # Handle unknown command
                 yield (YieldType.FINAL, f"Unknown command: {command_key}")
             return  # prevent command to be sent to LLM
+        answer = self.run_in_db_thread(lambda: self.fast_path.answer(message))
+        if answer is not None:
+            self.prefetcher.cancel()
+            # keep the history complete for follow-up questions to the LLM
+            self.messages.append({"role": "user", "content": message})
+            self.messages.append({"role": "assistant", "content": answer})
+            yield (YieldType.FINAL, answer)
+            return
         if GRAMPS_AI_MODEL_NAME:
             # yield from returns all yields from the calling func
-            yield from self.get_chatbot_response(message)
+            yield from self.get_chatbot_response(message, cancel=cancel)
         else:
             yield (
                 YieldType.FINAL,
@@ -257,62 +581,152 @@ class ChatBot(IChatLogic):
         all_messages: List[Dict[str, str]],
         tool_definitions: Optional[List[Dict[str, str]]],
         seed: int,
+        models: List[str],
+        cancel: CancellationToken,
     ) -> Any:
-        response = litellm.completion(
-            model=GRAMPS_AI_MODEL_NAME,  # self.model,
-            messages=all_messages,
-            seed=seed,
-            tools=tool_definitions,
-            tool_choice="auto" if tool_definitions is not None else None,
-        )
-
-        # logger.debug("\033[92mResponse from AI Model:\033[0m")
-        # Convert response to a dictionary if possible
-        response_dict = (
-            response.to_dict() if hasattr(response, "to_dict") else str(response)
+        """
+        Returns the first response of the models, see
+        LLMClient.hedged_completion(); raises LLMError when no model could
+        be reached, even after retries, and QueryCancelled when the
+        question is cancelled while waiting.
+        """
+        # the database is idle while we wait for the LLM: use that time
+        # to prefetch the tool results the LLM will probably ask for next
+        response = self.prefetcher.run_while(
+            lambda: self.llm_client.hedged_completion(
+                models,
+                GRAMPS_AI_HEDGE_SECONDS,
+                cancel,
+                messages=all_messages,
+                seed=seed,
+                tools=tool_definitions,
+                tool_choice="auto" if tool_definitions is not None else None,
+            ),
+            cancel,
         )
-        # logger.debug(json.dumps(response_dict, indent=2))
-        return response_dict
+        return response
 
     def get_chatbot_response(
         self,
         user_input: str,
         seed: int = 42,
+        cancel: Optional[CancellationToken] = None,
     ) -> Iterator[Tuple[YieldType, str]]:
+        if cancel is None:
+            cancel = CancellationToken()
+        # the tree may have been edited in Gramps since the last question
+        self.run_in_db_thread(self.apply_tree_changes)
+        self.prefetcher.cancel()
+        self.run_in_db_thread(self.update_system_prompt)
         self.messages.append({"role": "user", "content": user_input})
-        yield from self._llm_loop(seed)
-
-    def execute_tool(self, tool_call):
+        try:
+            tier, model = self.model_router.route(user_input, GRAMPS_AI_MODEL_NAME)
+            started = time.perf_counter()
+            if tier == SIMPLE:
+                final_response, answered = yield from self._llm_loop(
+                    seed, model, SIMPLE_TIER_MAX_TURNS, cancel, force_final=False
+                )
+                if answered:
+                    self.model_router.record(
+                        SIMPLE, time.perf_counter() - started, "answered"
+                    )
+                    yield (YieldType.FINAL, final_response)
+                    return
+                # the main model continues from the tool results gathered so far
+                LOG.debug(
+                    f"{model} gave no answer, escalating to {GRAMPS_AI_MODEL_NAME}"
+                )
+                self.model_router.record(
+                    SIMPLE, time.perf_counter() - started, "escalated"
+                )
+                started = time.perf_counter()
+            final_response, answered = yield from self._llm_loop(
+                seed, GRAMPS_AI_MODEL_NAME, 6, cancel
+            )
+            self.model_router.record(
+                COMPLEX,
+                time.perf_counter() - started,
+                "answered" if answered else "failed",
+            )
+            yield (YieldType.FINAL, final_response)
+        except QueryCancelled:
+            LOG.debug("The question was cancelled")
+            self.prefetcher.cancel()
+            # every question in the history gets an answer, so the next
+            # question starts from a complete conversation
+            self.messages.append({"role": "assistant", "content": CANCELLED_ANSWER})
+            yield (YieldType.FINAL, CANCELLED_ANSWER)
+
+    def execute_tool(
+        self, tool_call, cancel: Optional[CancellationToken] = None
+    ) -> bool:
+        """
+        Runs a tool call of the LLM and adds the result to the messages.
+        Returns True when the same call was already answered earlier in the
+        conversation; it then gets a reference to that answer. After the
+        question was cancelled the tool is not run.
+        """
         # logger.debug(f"Executing tool call: {tool_call['function']['name']}")
         tool_name = tool_call["function"]["name"]
-        arguments = json.loads(tool_call["function"]["arguments"])
         sys.stdout.flush()
-        tool_func = self.tool_map.get(tool_name)
+        if cancel is not None and cancel.cancelled:
+            # the LLM needs an answer to every tool call in the history
+            self.messages.append(
+                {
+                    "role": "tool",
+                    "tool_call_id": tool_call["id"],
+                    "content": CANCELLED_TOOL_CALL,
+                }
+            )
+            return False
         try:
-            if tool_func is not None:
-                sig = inspect.signature(tool_func)
-                if len(sig.parameters) == 0:
-                    # Ignore any arguments, call with none
-                    tool_result = tool_func()
-                else:
-                    tool_result = tool_func(**arguments)
-
-            else:
-                tool_result = f"Unknown tool: {tool_name}"
-
-            content_for_llm = ""
-            if isinstance(tool_result, (dict, list)):
-                content_for_llm = json.dumps(tool_result)
-            else:
-                content_for_llm = str(tool_result)
+            # wrong argument names and types are repaired here, which saves
+            # the LLM a turn to correct them
+            arguments = self.tool_registry.bind(
+                tool_name, tool_call["function"]["arguments"]
+            )
+        except ToolArgumentError as exc:
+            # logger.debug(exc)
+            self.messages.append(
+                {
+                    "role": "tool",
+                    "tool_call_id": tool_call["id"],
+                    "content": f"Error in calling tool `{tool_name}`: {exc}",
+                }
+            )
+            return False
+        key = tool_cache_key(tool_name, arguments)
+        earlier_call_id = self.answered_tool_calls.get(key)
+        if earlier_call_id is not None:
+            # logger.debug(f"Repeated tool call, answered by {earlier_call_id}")
+            self.messages.append(
+                {
+                    "role": "tool",
+                    "tool_call_id": tool_call["id"],
+                    "content": DUPLICATE_TOOL_CALL.format(tool_call_id=earlier_call_id),
+                }
+            )
+            return True
+        try:
+            self.cancel_token = cancel
+            content_for_llm = self.call_tool(tool_name, arguments)
+            # only a result is referred back to; a failed call runs again
+            self.answered_tool_calls[key] = tool_call["id"]
 
             # logger.debug("\033[93mTool call result:\033[0m")
             # logger.debug(content_for_llm)
 
+        except QueryCancelled:
+            # the tool stopped reading the tree; the question ends after
+            # this turn
+            content_for_llm = CANCELLED_TOOL_CALL
         except Exception as exc:
             # logger.debug(exc)
             # Include exception for LLM clarity
             content_for_llm = f"Error in calling tool `{tool_name}`: {exc}"
+        finally:
+            self.cancel_token = None
+
         self.messages.append(
             {
                 "role": "tool",
@@ -320,23 +734,83 @@ class ChatBot(IChatLogic):
                 "content": content_for_llm,
             }
         )
+        return False
 
-    def _llm_loop(self, seed: int) -> Iterator[Tuple[YieldType, str]]:
+    def call_tool(self, tool_name: str, arguments: Dict[str, Any]) -> str:
+        """
+        Returns the result of a tool call as text for the LLM, from the tool
+        cache when the call was made or prefetched before, and queues the
+        neighborhood of the persons in the result for prefetching.
+        """
+        key = tool_cache_key(tool_name, arguments)
+        entry = self.tool_cache.get(key)
+        if entry is None:
+            entry = self.compute_tool(tool_name, arguments)
+            self.tool_cache.put(key, entry)
+        content_for_llm, people = entry
+        self.prefetcher.schedule_people(people)
+        return content_for_llm
+
+    def compute_tool(
+        self, tool_name: str, arguments: Dict[str, Any]
+    ) -> Tuple[str, List[str]]:
+        """
+        Runs a tool and returns its result as text for the LLM together with
+        the handles of the persons in it.
+        """
+        tool_result = self.run_in_db_thread(
+            lambda: self.tool_map[tool_name](**arguments)
+        )
+        if isinstance(tool_result, (dict, list)):
+            content_for_llm = json.dumps(tool_result)
+        else:
+            content_for_llm = str(tool_result)
+        return content_for_llm, person_handles(tool_result)
+
+    def _llm_loop(
+        self,
+        seed: int,
+        model: str,
+        limit_loop: int,
+        cancel: CancellationToken,
+        force_final: bool = True,
+    ) -> Generator[Tuple[YieldType, str], None, Tuple[Optional[str], bool]]:
+        """
+        Lets the model call tools for at most limit_loop turns and returns
+        (final response, whether the model answered by itself). If it did
+        not, it is asked for its final answer without tools, unless
+        force_final is False: then (None, False) is returned. Raises
+        QueryCancelled when `cancel` is cancelled.
+        """
         # Tool-calling loop
         final_response = "I was unable to find the desired information."
-        limit_loop = 6
         # logger.debug("   Thinking...")
         sys.stdout.flush()
 
         found_final_result = False
+        answered = False
+        repeated_turns = 0
+        # all models answer in the same message format, so any of them can
+        # take over a turn
+        models = [model] + [
+            name for name in GRAMPS_AI_FALLBACK_MODEL_NAMES if name != model
+        ]
 
         for count in range(limit_loop):  # Iterates from 0 to 5
-            time.sleep(1)  # Add a one-second delay to prevent overwhelming the AI remote
-
+            cancel.raise_if_cancelled()
             messages_for_llm = list(self.messages)
             tools_to_send = self.tool_definitions  # Send all tools on each attempt
 
-            response = self._llm_complete(messages_for_llm, tools_to_send, seed)
+            try:
+                response = self._llm_complete(
+                    messages_for_llm, tools_to_send, seed, models, cancel
+                )
+            except LLMError as exc:
+                LOG.debug(exc)
+                if not force_final:
+                    # the next model may do better
+                    return None, False
+                return LLM_ERROR.format(error=exc), False
 
             if not response.choices:
                 # logger.debug("No response choices available from the AI model.")
@@ -354,14 +828,26 @@ class ChatBot(IChatLogic):
                 # model will do to achieve the final result
                 if msg.content:
                     yield (YieldType.PARTIAL, msg.content)
+                all_repeated = True
                 for tool_call in msg["tool_calls"]:
                     yield (YieldType.TOOL_CALL, tool_call["function"]["name"])
-                    self.execute_tool(tool_call)
+                    all_repeated &= self.execute_tool(tool_call, cancel)
+                cancel.raise_if_cancelled()
+                if all_repeated:
+                    repeated_turns += 1
+                    if repeated_turns >= MAX_REPEATED_TOOL_TURNS:
+                        # the model is going round in circles, more tool
+                        # calls will not help: ask for the answer now
+                        break
             else:
                 final_response = response.choices[0].message.content
                 found_final_result = True
+                answered = True
                 break
 
+        if not answered and not force_final:
+            return None, False
+
         # If the loop completed without being interrupted (no break),
         # force a final response.
         if not found_final_result:
@@ -373,13 +859,21 @@ class ChatBot(IChatLogic):
                 {
                     "role": "system",
                     "content": "You have reached the maximum number of "
-                    "tool-calling attempts. Based on the information gathered "
+                    "tool-calling attempts, or you are repeating tool calls "
+                    "you already made. Based on the information gathered "
                     "so far, provide the most complete answer you can, or "
                     "clearly state what information you could not obtain. Do "
                     "not attempt to call any more tools.",
                 }
             )
-            response = self._llm_complete(messages_for_llm, None, seed)  # No tools!
+            # No tools!
+            try:
+                response = self._llm_complete(
+                    messages_for_llm, None, seed, models, cancel
+                )
+            except LLMError as exc:
+                LOG.debug(exc)
+                return LLM_ERROR.format(error=exc), False
             if response.choices:
                 final_response = response.choices[0].message.content
 
@@ -391,7 +885,7 @@ class ChatBot(IChatLogic):
         ):
             final_response = self.messages[-1]["content"]
 
-        yield (YieldType.FINAL, final_response)
+        return final_response, answered
 
     # Tools:
     def get_person(self, person_handle: str) -> Dict[str, Any]:
@@ -558,158 +1052,238 @@ class ChatBot(IChatLogic):
 
         return family_data_list
 
-    def create_search_pattern(self, search_string: str) -> Pattern:
+    def find_people_by_name(
+        self, search_string: str, limit: int = DEFAULT_PEOPLE_RESULTS, cursor: int = 0
+    ) -> Dict[str, Any]:
         """
-        Creates a case-insensitive regex pattern to match any of the words
-        in a given search string, using word boundaries.
-
-        Args:
-            search_string: The string containing words to search for.
+        Searches the Gramps database for people whose primary or alternate names
+        contain any word of the given search string.
+        * "limit" is the maximum number of people to return (default 20, at
+          most 50).
+        * "cursor" is where to continue: pass the "next_cursor" of the
+          previous result to get the next page.
+        The best matches come first; "match" tells how a person matched:
+        "full_name" (the words cover given name and surname), "surname",
+        "given_name", "other_name" (nickname, title, suffix) or
+        "alternate_name".
+        The result contains "total_matches", which is an estimate when
+        "total_is_estimate" is true (it may change from page to page),
+        "next_cursor" (null on the last page) and a list of "people", each
+        with handle, gramps_id, first_name, surname, prefix and match. When
+        there are many matches, rather narrow the search than page through
+        all of them.
 
-        Returns:
-            A compiled regex Pattern object.
+         Example:
+            To find people named "Chris Woods", call the tool with:
+            find_people_by_name(search_string="Chris Woods")
         """
-        # 1. Split the search string into individual words.
-        search_terms = search_string.split()
-
-        # Handle the case of an empty search string
-        if not search_terms:
-            # Return a pattern that will not match anything
-            return re.compile(r"$^")
-
-        # 2. Escape each term to treat special regex characters as literals.
-        escaped_terms = [re.escape(term) for term in search_terms]
-
-        # 3. Join the escaped terms with the regex "OR" operator.
-        regex_or_pattern = "|".join(escaped_terms)
-
-        # 4. Add word boundaries to the pattern and compile it.
-        final_pattern = re.compile(r"\b(?:" + regex_or_pattern + r")\b", re.IGNORECASE)
+        return find_people(
+            self.db, search_string, limit, cursor, self.sidecar, self.cancel_token
+        )
 
-        return final_pattern
+    def find_events_in_range(
+        self,
+        start_year: int,
+        end_year: int,
+        event_type: str = "",
+        limit: int = 50,
+        place: str = "",
+    ) -> Dict[str, Any]:
+        """
+        Find the events that happened between start_year and end_year
+        (inclusive), for example all births between 1850 and 1870 or every
+        event in 1914.
+        * "event_type" is optional, e.g. "Birth", "Death", "Marriage",
+          "Baptism" or "Burial". Leave it empty to get events of any type.
+        * "limit" is the maximum number of events to return (default 50).
+        * "place" is optional, the name of a place such as a town or a
+          country: only the events in that place, or in any place within
+          it, are returned.
+        Approximate dates such as "about 1860", "before 1870" or date ranges
+        are included when they may fall in the range, and are marked with
+        "approximate": true.
+        The result contains "total_matches" and a list of "events", each with
+        the event handle, type, date, place and "participants": the persons
+        (or families, for a marriage) the event belongs to.
+        """
+        limit = max(1, min(int(limit), MAX_EVENTS_IN_RANGE))
+        start_year, end_year, place = int(start_year), int(end_year), place.strip()
+        if self.pushdown.available:
+            matches, total = self.pushdown.events_in_range(
+                start_year, end_year, event_type, place, limit
+            )
+        else:
+            kind = event_type.strip().lower()
+            if kind in VITAL_EVENTS:
+                # the births and deaths of the people are in the sidecar, so
+                # the other events need not be indexed; the place is checked
+                # afterwards, on all matches
+                matches, total = self.sidecar.vital_events_in_range(
+                    kind, start_year, end_year, None if place else limit
+                )
+            else:
+                if self.date_index is None:
+                    self.date_index = EventDateIndex().build(
+                        self.db, self.cancel_token
+                    )
+                matches, total = self.date_index.query(
+                    start_year,
+                    end_year,
+                    event_type,
+                    len(self.date_index) if place else limit,
+                )
+            if place:
+                within = self.sidecar.places_within(place)
+                matches = [
+                    match
+                    for match in matches
+                    if self.db.get_raw_event_data(match["event_handle"]).get("place")
+                    in within
+                ]
+                total = len(matches)
+                matches = matches[:limit]
+        events = []
+        for match in matches:
+            summary = event_summary(self.db, match["event_handle"])
+            summary["approximate"] = match["approximate"]
+            events.append(summary)
+        result = {"total_matches": total, "events": events}
+        if event_type and not total and event_type.strip().lower() not in VITAL_EVENTS:
+            result["known_event_types"] = (
+                self.pushdown.event_types()
+                if self.pushdown.available
+                else self.date_index.event_types()
+            )
+        return result
 
-    def find_people_by_name(self, search_string: str) -> List[Dict[str, Any]]:
+    def find_people_by_attribute(
+        self,
+        text: str = "",
+        attribute_type: str = "",
+        limit: int = DEFAULT_PEOPLE_RESULTS,
+    ) -> Dict[str, Any]:
         """
-        Searches the Gramps database for people whose primary or alternate names
-        contain the given search string.
+        Finds the people with an attribute, e.g. an occupation, nickname,
+        caste or a custom attribute, whose value contains the given text.
+        * "text": the text to look for in the value, ignoring case; empty
+          to list every person with an attribute of the type.
+        * "attribute_type" (optional): "Occupation", "Nickname", "Caste",
+          "Description", "Identification Number", "National Origin",
+          "Number of Children", "Social Security Number", "Cause", "Age", or
+          the name of a custom attribute type.
+        * "limit": the maximum number of people to return (default 20).
+        This reads every person of the tree, so prefer find_people_by_name
+        when you know a name.
+        Returns "total_matches" and a list of "people", each with handle,
+        gramps_id, name and the "value" of the attribute.
+        """
+        limit = min(max(int(limit), 1), MAX_PEOPLE_RESULTS)
+        return people_with_attribute(
+            self.scan_engine, text, attribute_type, limit, self.cancel_token
+        )
 
-        Argument:
-            One string to match in person names.
+    def search_notes(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """
+        Full-text search through the notes, sources and citations of the tree.
+        This is where stories, occupations, transcriptions and other narrative
+        details are kept that are not part of names or events.
+        * "query" is one or more words, e.g. "sailor ship Indies".
+        * "limit" is the maximum number of results (default 10).
+        Returns a ranked list, best match first. Each result has the "handle"
+        and "type" ("Note", "Source" or "Citation") of the matching object,
+        a "snippet" of the matching text, and "referenced_by": the type and
+        handle of the persons, families, events or citations that use it.
+        """
+        limit = max(1, min(int(limit), MAX_NOTE_RESULTS))
+        return self.sidecar.search_notes(query, limit)
 
-        Returns:
-            A list of dictionaries, where each dictionary contains the raw data
-            of a matching person.
+    def tree_statistics(
+        self,
+        metric: str = "count",
+        group_by: str = "",
+        filters: Optional[Dict[str, Any]] = None,
+        limit: int = 25,
+    ) -> Dict[str, Any]:
+        """
+        Compute statistics over the whole tree in one call. Use this for
+        questions about many people at once, e.g. "most common surnames",
+        "average lifespan per century" or "how many people were born in each
+        province", instead of looking up people one by one.
+        * "metric": "count" (number of people), "mean_lifespan",
+          "min_lifespan", "max_lifespan" (in years), or "event_count".
+        * "group_by" (optional): "surname", "gender", "birth_decade",
+          "birth_century", "death_decade", "death_century", "birth_place",
+          "death_place", or birth_/death_ followed by a place type, e.g.
+          "birth_province", "birth_country", "death_city".
+          For "event_count": "event_type", "event_decade", "event_century",
+          "event_place" or e.g. "event_province".
+        * "filters" (optional) object, for people: "gender" ("male",
+          "female"), "surname", "born_after", "born_before", "died_after",
+          "died_before" (years), "birth_place", "death_place" (name contains);
+          for events: "event_type", "after", "before", "place".
+        * "limit": the maximum number of groups to return (default 25).
+        Groups are sorted by value, largest first; decades and centuries are
+        returned in chronological order.
+        """
+        if self.tree_snapshot is None:
+            # imported here: loading numpy would slow down the start of the chat
+            from tree_statistics import TreeSnapshot
+
+            self.tree_snapshot = TreeSnapshot.load(
+                self.db,
+                None if self.tree_edited else GRAMPS_AI_COLUMNAR_DIR,
+                self.cancel_token,
+            )
+        limit = max(1, min(int(limit), MAX_STATISTICS_GROUPS))
+        return self.tree_snapshot.statistics(metric, group_by, filters, limit)
 
-         Example:
-            To find people named "Chris Woods", call the tool with:
-            find_people_by_name(search_string="Chris Woods")
+    def query_tree(self, query: str, limit: int = 50) -> Dict[str, Any]:
         """
-        matching_people_raw_data = []
-        # search_pattern = re.compile(re.escape(search_string), re.IGNORECASE)
-        search_pattern = self.create_search_pattern(search_string)
-
-        for person_obj in self.sa.all_people():
-            matched = False
-
-            # Helper function to check fields within a Name or Surname object
-            def check_name_fields(name_or_surname_obj: Any) -> bool:
-                """
-                Checks relevant string fields of
-                a Name or Surname object for a match.
-                """
-                fields_to_check = []
-
-                # Fields common to Name object (primary_name or alternate_name elements)
-                if hasattr(name_or_surname_obj, "first_name"):
-                    fields_to_check.append(name_or_surname_obj.first_name)
-                # Corrected: 'prefix' and 'suffix' are properties of the Name
-                # object itself, not the Surname object.
-                if hasattr(name_or_surname_obj, "prefix"):
-                    fields_to_check.append(name_or_surname_obj.prefix)
-                if hasattr(name_or_surname_obj, "suffix"):
-                    fields_to_check.append(name_or_surname_obj.suffix)
-                if hasattr(name_or_surname_obj, "title"):
-                    fields_to_check.append(name_or_surname_obj.title)
-                if hasattr(name_or_surname_obj, "call"):
-                    fields_to_check.append(name_or_surname_obj.call)
-                if hasattr(name_or_surname_obj, "nick"):
-                    fields_to_check.append(name_or_surname_obj.nick)
-                if hasattr(name_or_surname_obj, "famnick"):
-                    fields_to_check.append(name_or_surname_obj.famnick)
-                if hasattr(name_or_surname_obj, "patronymic"):
-                    fields_to_check.append(name_or_surname_obj.patronymic)
-
-                # Fields specific to Surname object (within surname_list)
-                if hasattr(
-                    name_or_surname_obj, "surname"
-                ):  # This means it's a Surname object
-                    fields_to_check.append(name_or_surname_obj.surname)
-                    # Note: Surname objects can also have their own 'prefix'
-                    #  and 'connector'
-                    # which are separate from the 'prefix'
-                    # of the main Name object.
-                    if hasattr(name_or_surname_obj, "connector"):
-                        fields_to_check.append(name_or_surname_obj.connector)
-
-                for field_value in fields_to_check:
-                    # Ensure field_value is a non-empty string before attempting search
-                    if (
-                        isinstance(field_value, str)
-                        and field_value
-                        and search_pattern.search(field_value)
-                    ):
-                        return True
-                return False
-
-            # Check primary name fields
-            if person_obj.primary_name:
-                if check_name_fields(person_obj.primary_name):
-                    matched = True
-
-                # Surnames are in a list, iterate through each Surname object
-                if not matched and hasattr(person_obj.primary_name, "surname_list"):
-                    for surname_obj in person_obj.primary_name.surname_list:
-                        if check_name_fields(surname_obj):  # Check the Surname object
-                            matched = True
-                            break
-
-            # Check alternate name fields if not already matched
-            if (
-                not matched
-                and hasattr(person_obj, "alternate_names")
-                and person_obj.alternate_names
-            ):
-                for alt_name in person_obj.alternate_names:
-                    if check_name_fields(alt_name):
-                        matched = True
-                        break
+        Walk the tree along several relations in one call. A query starts at
+        one object and follows steps separated by dots, for example:
+          person(I0044).parents.parents          the grandparents
+          person(I0044).parents.siblings.children    the cousins
+          person("Jim Baker").children.birth.place   birth places of children
+          home.children[gender=female].spouses   husbands of the daughters
+          person(I0044).events[type=Birth]
+        * Start: person(X), family(X), event(X), place(X) with X a handle or
+          Gramps ID (a person may also be given by a quoted first name and
+          surname that match one person), or "home" for the home person.
+        * Person steps: parents, father, mother, children, spouses,
+          siblings, families, parent_families, events, birth, death.
+          Family steps: father, mother, parents, children, events.
+          Event steps: place, participants. Place steps: enclosed_by.
+        * Filters after a step: [field op value, ...] with op one of
+          = != (case-insensitive), ~ (contains), < > <= >= (numbers).
+          Person fields: name, first_name, surname, gender, birth_year,
+          death_year. Event fields: type, year, place, description.
+          Place fields: name, title, type.
+        * "limit" is the maximum number of results (default 50).
+        Returns "total", "truncated" and the "results" of the last step,
+        each with its handle, Gramps ID, name and dates.
+        """
+        limit = max(1, min(int(limit), MAX_QUERY_RESULTS))
+        return run_query(self.db, query, limit, self.sidecar, self.cancel_token)
 
-                    # Check surnames within alternate name
-                    if not matched and hasattr(alt_name, "surname_list"):
-                        for alt_surname_obj in alt_name.surname_list:
-                            if check_name_fields(alt_surname_obj):
-                                matched = True
-                                break
-                        if matched:  # Break from outer alt_names loop if matched
-                            break
-
-            if matched:
-                # Use the existing _get_raw_person_from_id_data to get raw data
-                # self.db is assumed to be the database access object within
-                # the tool's class.
-                raw_data = dict(
-                    self.db._get_raw_person_from_id_data(person_obj.gramps_id)
-                )
-                desired_fields = {
-                    "handle": raw_data.get("handle"),
-                    "first_name": raw_data.get("primary_name", {}).get("first_name"),
-                    "surname": raw_data.get("primary_name", {})
-                    .get("surname_list", [{}])[0]
-                    .get("surname"),
-                    "prefix": raw_data.get("primary_name", {})
-                    .get("surname_list", [{}])[0]
-                    .get("prefix"),
-                }
-                matching_people_raw_data.append(desired_fields)
+    def semantic_search(self, query: str, k: int = 10) -> List[Dict[str, Any]]:
+        """
+        Find the persons whose life story best matches a description, when
+        you do not know their names, e.g. "sailors", "emigrated to America",
+        "farmers in Friesland" or "died young in the war".
+        Every person is described by a profile of names, events with year,
+        place and description, occupations and notes; the query is matched
+        against these profiles.
+        * "query": a few descriptive words.
+        * "k": the number of persons to return (default 10).
+        Returns a ranked list with for every person the handle, Gramps ID,
+        name, a similarity "score" and the "profile" that matched.
+        """
+        if self.semantic_index is None:
+            # imported here: loading numpy would slow down the start of the chat
+            from semantic_index import open_index
 
-        return matching_people_raw_data
+            self.semantic_index = open_index(
+                self.db, chatbot_cache_dir(self.db), self.cancel_token
+            )
+        k = max(1, min(int(k), MAX_SEMANTIC_RESULTS))
+        return list(self.semantic_index.iter_results(self.db, query, k))
@@ -0,0 +1,141 @@
+"""
+Runs the questions of the gramplet's chatbot off the GTK main loop.
+
+ChatBot.get_reply() waits for the LLM, often for many seconds; run from the
+GTK main loop it freezes the Gramps window for that long. The driver runs
+it on a worker thread instead, one question at a time, and hands every
+PARTIAL, TOOL_CALL and FINAL reply to the gramplet with GLib.idle_add().
+
+The database belongs to the GTK thread: the user edits it there and its
+signals are emitted there. So the chatbot does not use the database on the
+worker. Its database work (the tools, the fast path, the prefetcher and
+bringing the indexes up to date) is handed to the main loop with
+GLib.idle_add() too, one call at a time, and the worker waits for the
+result. In between, the main loop keeps drawing the window and handling
+the edits of the user.
+
+The gramplet creates the driver on the GTK thread:
+
+    self.chat_logic = ChatBot(self)
+    self.driver = GrampletChatDriver(self.chat_logic)
+    self.cancel = self.driver.ask(question, self.show_reply)
+"""
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from typing import Any, Callable, Optional
+
+from gi.repository import GLib
+
+from cancellation import CancellationToken, QueryCancelled
+from chatwithllm import IChatLogic, YieldType
+
+LOG = logging.getLogger("GrampletChatDriver")
+
+# how often a worker waiting for the main loop checks for cancellation
+CANCEL_POLL_SECONDS = 0.1
+CANCELLED_REPLY = "The question was cancelled."
+
+ReplyCallback = Callable[[YieldType, str], None]
+
+
+class GrampletChatDriver:
+    """
+    Answers the questions of a ChatBot on one worker thread and runs its
+    database work in the GTK main loop.
+    """
+
+    def __init__(self, chat_logic: IChatLogic) -> None:
+        self.chat_logic = chat_logic
+        # the thread of the GTK main loop, which owns the database
+        self.main_thread = threading.current_thread()
+        self.chat_logic.run_in_db_thread = self.call_in_main_loop
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="ChatWorker"
+        )
+        # the token of the question being answered, see cancel()
+        self.current_cancel: Optional[CancellationToken] = None
+        self.main_loop_calls = 0
+
+    def call_in_main_loop(self, func: Callable[[], Any]) -> Any:
+        """
+        Returns func() called by the GTK main loop, or raises what it
+        raised. Called on the worker, it waits for the main loop; raises
+        QueryCancelled when the question is cancelled meanwhile.
+        """
+        if threading.current_thread() is self.main_thread:
+            return func()
+        future: Future = Future()
+        cancel = self.current_cancel
+
+        def run() -> bool:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func())
+                except BaseException as exc:
+                    future.set_exception(exc)
+            return GLib.SOURCE_REMOVE
+
+        self.main_loop_calls += 1
+        GLib.idle_add(run)
+        while True:
+            try:
+                return future.result(CANCEL_POLL_SECONDS)
+            except FutureTimeout:
+                # when cancelled before it started, run() does nothing
+                if cancel is not None and cancel.cancelled and future.cancel():
+                    raise QueryCancelled()
+
+    def ask(self, message: str, on_reply: ReplyCallback) -> CancellationToken:
+        """
+        Queues a question. on_reply(reply type, text) is called in the GTK
+        main loop for every reply, the last one being FINAL. Returns the
+        token that cancels the question.
+        """
+        cancel = CancellationToken()
+
+        def deliver(reply_type: YieldType, content: str) -> None:
+            GLib.idle_add(self._deliver, on_reply, reply_type, content)
+
+        def answer() -> None:
+            # This runs on the worker thread.
+            self.current_cancel = cancel
+            try:
+                if cancel.cancelled:
+                    # cancelled while waiting for the question before it
+                    deliver(YieldType.FINAL, CANCELLED_REPLY)
+                    return
+                for reply_type, content in self.chat_logic.get_reply(message, cancel):
+                    deliver(reply_type, content)
+            except QueryCancelled:
+                deliver(YieldType.FINAL, CANCELLED_REPLY)
+            except Exception as exc:
+                LOG.debug(exc)
+                deliver(YieldType.FINAL, f"Error: {exc}")
+            finally:
+                self.current_cancel = None
+
+        self.executor.submit(answer)
+        return cancel
+
+    @staticmethod
+    def _deliver(on_reply: ReplyCallback, reply_type: YieldType, content: str) -> bool:
+        on_reply(reply_type, content)
+        return GLib.SOURCE_REMOVE
+
+    def cancel(self) -> None:
+        """
+        Cancels the question being answered, if any.
+        """
+        if self.current_cancel is not None:
+            self.current_cancel.cancel()
+
+    def stop(self) -> None:
+        """
+        Cancels the question being answered and lets the worker end. It is
+        not waited for: it may be waiting for the main loop, which calls
+        this.
+        """
+        self.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,208 @@
+"""
+Admission control in front of the single database worker.
+
+Questions wait in a bounded queue instead of the unbounded queue of the
+executor. Every client has its own line and the lines are served round
+robin, so one client asking many questions does not delay everyone else.
+A question that does not fit is rejected at once with an estimate of when
+to try again, and every waiting question is told its place in the queue
+whenever it changes.
+"""
+import logging
+import statistics
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, List
+
+LOG = logging.getLogger("admission")
+
+# questions waiting for the worker, over all clients and per client
+MAX_QUEUED = 16
+MAX_QUEUED_PER_CLIENT = 4
+# the retry hint when no question was answered yet
+DEFAULT_SERVICE_SECONDS = 30.0
+# samples kept for the wait and service time metrics
+TIME_SAMPLES = 100
+
+
+class AdmissionRejected(Exception):
+    """
+    The queue is full; try again after retry_after seconds.
+    """
+
+    def __init__(self, message: str, retry_after: float) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """
+    A question waiting for, or running on, the worker.
+    """
+
+    def __init__(
+        self,
+        client_id: str,
+        job: Callable[[], None],
+        on_position: Callable[[int], None],
+    ) -> None:
+        self.client_id = client_id
+        self.job = job
+        self.on_position = on_position
+        self.position = 0
+        self.enqueued = time.perf_counter()
+
+
+class AdmissionController:
+    """
+    Hands the admitted jobs one at a time to `submit`, e.g. the submit of
+    a single-worker executor, fairly over the clients.
+    """
+
+    def __init__(
+        self,
+        submit: Callable[[Callable[[], None]], Any],
+        max_queued: int = MAX_QUEUED,
+        max_queued_per_client: int = MAX_QUEUED_PER_CLIENT,
+    ) -> None:
+        self.submit = submit
+        self.max_queued = max_queued
+        self.max_queued_per_client = max_queued_per_client
+        # client id -> its waiting tickets; the first client is served next
+        self.lines: "OrderedDict[str, Deque[Ticket]]" = OrderedDict()
+        self.busy = False
+        self.admitted = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.wait_seconds: Deque[float] = deque(maxlen=TIME_SAMPLES)
+        self.service_seconds: Deque[float] = deque(maxlen=TIME_SAMPLES)
+        self._lock = threading.Lock()
+
+    def depth(self) -> int:
+        """
+        Returns the number of waiting questions.
+        """
+        return sum(len(line) for line in self.lines.values())
+
+    def retry_after(self) -> float:
+        """
+        Returns the seconds until the queue probably has room again.
+        """
+        service = (
+            statistics.mean(self.service_seconds)
+            if self.service_seconds
+            else DEFAULT_SERVICE_SECONDS
+        )
+        return round(service * (self.depth() + 1), 1)
+
+    def admit(
+        self,
+        client_id: str,
+        job: Callable[[], None],
+        on_position: Callable[[int], None],
+    ) -> Ticket:
+        """
+        Queues job() for the worker. on_position(n) is called with its
+        place in the queue, 1 being next, whenever that changes, from any
+        thread. Raises AdmissionRejected when the queue is full.
+        """
+        with self._lock:
+            line = self.lines.get(client_id)
+            if self.depth() >= self.max_queued or (
+                line is not None and len(line) >= self.max_queued_per_client
+            ):
+                self.rejected += 1
+                retry_after = self.retry_after()
+                LOG.debug(f"Rejected a question of {client_id}, {self.depth()} queued")
+                raise AdmissionRejected(
+                    f"Too many questions are waiting, try again in {retry_after:.0f} "
+                    "seconds.",
+                    retry_after,
+                )
+            ticket = Ticket(client_id, job, on_position)
+            self.lines.setdefault(client_id, deque()).append(ticket)
+            self.admitted += 1
+            self.max_depth = max(self.max_depth, self.depth())
+            self._dispatch()
+            return ticket
+
+    def withdraw(self, ticket: Ticket) -> None:
+        """
+        Removes a question that has not started yet, e.g. because its
+        client went away.
+        """
+        with self._lock:
+            line = self.lines.get(ticket.client_id)
+            if line is None or ticket not in line:
+                return
+            line.remove(ticket)
+            if not line:
+                del self.lines[ticket.client_id]
+            self._announce_positions()
+
+    def _order(self) -> List[Ticket]:
+        """
+        Returns the waiting tickets in the order they will run: one of
+        every client in turn.
+        """
+        lines = [list(line) for line in self.lines.values()]
+        order = []
+        for turn in range(max((len(line) for line in lines), default=0)):
+            order.extend(line[turn] for line in lines if turn < len(line))
+        return order
+
+    def _announce_positions(self) -> None:
+        for position, ticket in enumerate(self._order(), 1):
+            if ticket.position != position:
+                ticket.position = position
+                ticket.on_position(position)
+
+    def _dispatch(self) -> None:
+        """
+        Starts the next question when the worker is idle; the lock is held.
+        """
+        if self.busy or not self.lines:
+            self._announce_positions()
+            return
+        client_id, line = next(iter(self.lines.items()))
+        ticket = line.popleft()
+        # the client goes to the back, behind everyone else waiting
+        del self.lines[client_id]
+        if line:
+            self.lines[client_id] = line
+        self.busy = True
+        waited = time.perf_counter() - ticket.enqueued
+        self.wait_seconds.append(waited)
+        self._announce_positions()
+
+        def run() -> None:
+            started = time.perf_counter()
+            try:
+                ticket.job()
+            finally:
+                with self._lock:
+                    self.service_seconds.append(time.perf_counter() - started)
+                    self.busy = False
+                    self._dispatch()
+
+        self.submit(run)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            waits = list(self.wait_seconds)
+            return {
+                "queued": self.depth(),
+                "clients_waiting": len(self.lines),
+                "busy": self.busy,
+                "max_queued_seen": self.max_depth,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "mean_wait_seconds": round(statistics.mean(waits), 2)
+                if waits
+                else 0.0,
+                "median_wait_seconds": round(statistics.median(waits), 2)
+                if waits
+                else 0.0,
+                "max_wait_seconds": round(max(waits), 2) if waits else 0.0,
+            }
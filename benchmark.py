@@ -0,0 +1,413 @@
+"""
+Benchmarks for the chatbot.
+
+Usage:
+    python benchmark.py startup [--runs N]
+    python benchmark.py semantic [--people N] [--queries N]
+    python benchmark.py scan [--people N] [--workers 1,2,4]
+    python benchmark.py pushdown [--people N]
+
+startup: time from starting ChatBotConsole.py until it shows the first
+prompt (needs GRAMPS_DB_NAME, like chatbot.sh), and the cost of importing
+chatbot.py on its own. The target is to show the first prompt within
+STARTUP_TARGET_SECONDS.
+
+semantic: build and query throughput of the semantic_search index on
+synthetic person profiles, and the recall of its approximate search
+compared to scoring every person.
+
+scan: records per second of scan_engine on a synthetic SQLite tree, for
+every number of workers, with the speedup over a single worker.
+
+pushdown: find_people_by_name on a synthetic SQLite tree, reading every
+person through the database API as before, and with the FTS5 name index
+of the sidecar.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Iterator, List, Optional, Tuple
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+STARTUP_TARGET_SECONDS = 0.3
+PROMPT = "Enter your question"
+
+FIRST_NAMES = (
+    "Jan Pieter Maria Anna Willem Cornelis Johanna Hendrik Grietje Klaas"
+).split()
+SURNAMES = "Baker Bakker Jansen de_Vries Visser Smit Meijer de_Boer Mulder Bos".split()
+PLACES = "Haarlem Amsterdam Leiden Utrecht Groningen Zwolle Delft Hoorn Batavia".split()
+OCCUPATIONS = (
+    "sailor farmer baker smith teacher weaver carpenter merchant soldier "
+    "fisherman miller minister midwife"
+).split()
+NOTES = (
+    "emigrated to America with his family",
+    "served in the army during the war",
+    "worked on the ships to the Indies",
+    "owned a farm near the river",
+    "was a member of the church council",
+    "",
+    "",
+    "",
+)
+
+IMPORT_PROBE = """
+import sys, time
+started = time.perf_counter()
+import chatbot
+print(time.perf_counter() - started)
+print(",".join(name for name in ("litellm", "numpy") if name in sys.modules))
+"""
+
+
+def time_to_first_prompt() -> float:
+    """
+    Starts the console and returns the seconds until the prompt appears.
+    """
+    env = dict(os.environ, PYTHONUNBUFFERED="1")
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(SCRIPT_DIR, "ChatBotConsole.py")],
+        cwd=SCRIPT_DIR,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        env=env,
+        text=True,
+    )
+    output = ""
+    try:
+        while PROMPT not in output:
+            char = process.stdout.read(1)
+            if not char:
+                raise Exception(f"ChatBotConsole.py exited early:\n{output}")
+            output += char
+        return time.perf_counter() - started
+    finally:
+        process.kill()
+        process.wait()
+
+
+def report(name: str, timings: List[float], target: float = 0.0) -> None:
+    line = (
+        f"{name}: median {statistics.median(timings) * 1000:.0f} ms, "
+        f"min {min(timings) * 1000:.0f} ms, max {max(timings) * 1000:.0f} ms"
+    )
+    if target:
+        verdict = "OK" if statistics.median(timings) <= target else "TOO SLOW"
+        line += f" (target {target * 1000:.0f} ms: {verdict})"
+    print(line)
+
+
+def bench_startup(args: argparse.Namespace) -> None:
+    import_timings = []
+    for _ in range(args.runs):
+        probe = subprocess.run(
+            [sys.executable, "-c", IMPORT_PROBE],
+            cwd=SCRIPT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        seconds, heavy_modules = probe.stdout.splitlines()[-2:]
+        import_timings.append(float(seconds))
+    report("import chatbot", import_timings)
+    if heavy_modules:
+        print(f"  imported eagerly, should be lazy: {heavy_modules}")
+
+    if not os.environ.get("GRAMPS_DB_NAME"):
+        print("Set GRAMPS_DB_NAME to also measure the time to the first prompt")
+        return
+    prompt_timings = [time_to_first_prompt() for _ in range(args.runs)]
+    report("first prompt", prompt_timings, STARTUP_TARGET_SECONDS)
+
+
+def synthetic_profiles(count: int, seed: int = 0) -> Iterator[Tuple[str, str]]:
+    """
+    Yields (handle, profile) pairs that look like the profiles built by
+    semantic_index.person_profile().
+    """
+    rng = random.Random(seed)
+    for number in range(count):
+        born = rng.randint(1600, 1950)
+        lines = [
+            f"{rng.choice(FIRST_NAMES)} {rng.choice(SURNAMES).replace('_', ' ')}",
+            rng.choice(("male man", "female woman")),
+            f"Birth {born} {rng.choice(PLACES)}",
+            f"Death {born + rng.randint(0, 95)} {rng.choice(PLACES)}",
+            f"Occupation {born + 20} {rng.choice(OCCUPATIONS)}",
+            rng.choice(NOTES),
+        ]
+        yield f"H{number:08d}", "\n".join(line for line in lines if line)
+
+
+def bench_semantic(args: argparse.Namespace) -> None:
+    import numpy as np
+
+    from semantic_index import SemanticIndex
+
+    profiles = list(synthetic_profiles(args.people))
+    started = time.perf_counter()
+    index = SemanticIndex().build(profiles)
+    build_seconds = time.perf_counter() - started
+    print(
+        f"build: {args.people} persons in {build_seconds:.1f} s "
+        f"({args.people / build_seconds:.0f} persons/s), "
+        f"{index.manifest['clusters']} clusters, "
+        f"vectors {index.vectors.nbytes / 2**20:.1f} MiB"
+    )
+
+    rng = random.Random(1)
+    queries = [
+        f"{rng.choice(OCCUPATIONS)} {rng.choice(PLACES)} "
+        f"{rng.choice(NOTES).split(' ')[-1] or 'family'}"
+        for _ in range(args.queries)
+    ]
+    timings = []
+    recalls = []
+    vectors = index.vectors.astype(np.float32)
+    for query in queries:
+        started = time.perf_counter()
+        found = index.search(query, 10, args.probes)
+        timings.append(time.perf_counter() - started)
+        # compare with the exact top 10 from scoring every vector; many
+        # synthetic profiles score the same, so a result counts as found
+        # when it scores at least as well as the exact 10th
+        exact = np.sort(vectors @ index.query_vector(query))[::-1][:10]
+        if exact[0] > 0:
+            tenth = exact[-1] - 1e-3
+            recalls.append(sum(score >= tenth for _, score in found) / len(exact))
+    report("query", timings)
+    print(
+        f"  {len(queries) / sum(timings):.0f} queries/s, "
+        f"recall@10 {statistics.mean(recalls):.2f}"
+    )
+
+
+class SyntheticTree:
+    """
+    Stands in for an open database on a synthetic SQLite tree: the folder,
+    and the persons one at a time, like the database API reads them.
+    """
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def get_save_path(self) -> str:
+        return self.folder
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(os.path.join(self.folder, "sqlite.db"))
+        return self._connection
+
+    def get_number_of_people(self) -> int:
+        return self.connection.execute("SELECT count(*) FROM person").fetchone()[0]
+
+    def iter_person_handles(self) -> Iterator[str]:
+        for (handle,) in self.connection.execute("SELECT handle FROM person"):
+            yield handle
+
+    def get_raw_person_data(self, handle: str) -> dict:
+        (json_data,) = self.connection.execute(
+            "SELECT json_data FROM person WHERE handle = ?", (handle,)
+        ).fetchone()
+        return json.loads(json_data)
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+
+
+def synthetic_person(rng: random.Random, handle: str, number: int) -> dict:
+    """
+    Returns a raw person shaped like the json_data of a Gramps 6 tree, with
+    the fields scanned by the scan_engine filters.
+    """
+
+    def name(first_name: str, surname: str) -> dict:
+        prefix, _, surname = surname.rpartition("_")
+        return {
+            "first_name": first_name,
+            "surname_list": [
+                {"surname": surname, "prefix": prefix, "primary": True, "connector": ""}
+            ],
+            "call": "",
+            "nick": "",
+            "famnick": "",
+            "title": "",
+            "suffix": "",
+        }
+
+    alternate_names = []
+    if rng.random() < 0.1:
+        alternate_names.append(name(rng.choice(FIRST_NAMES), rng.choice(SURNAMES)))
+    return {
+        "handle": handle,
+        "gramps_id": f"I{number:07d}",
+        "gender": rng.randint(0, 1),
+        "primary_name": name(rng.choice(FIRST_NAMES), rng.choice(SURNAMES)),
+        "alternate_names": alternate_names,
+        "attribute_list": [
+            {
+                "type": {"value": 4, "string": ""},
+                "value": rng.choice(OCCUPATIONS),
+            }
+        ],
+        "event_ref_list": [],
+        "note_list": [],
+        "change": 0,
+    }
+
+
+def synthetic_sqlite_tree(folder: str, count: int, seed: int = 0) -> None:
+    """
+    Writes a person table of `count` synthetic persons to sqlite.db in
+    folder, and the empty tables the sidecar indexes.
+    """
+    from scan_engine import SQLITE_FILE_NAME
+
+    rng = random.Random(seed)
+    connection = sqlite3.connect(os.path.join(folder, SQLITE_FILE_NAME))
+    for table in ("person", "place", "note", "source", "citation"):
+        connection.execute(
+            f"CREATE TABLE {table} (handle VARCHAR(50) PRIMARY KEY NOT NULL, "
+            "json_data TEXT, change INTEGER DEFAULT 0)"
+        )
+    for start in range(0, count, 10000):
+        rows = []
+        for number in range(start, min(start + 10000, count)):
+            # Gramps handles start with the time they were made
+            handle = f"{rng.getrandbits(64):016x}{number:012x}"
+            rows.append((handle, json.dumps(synthetic_person(rng, handle, number))))
+        connection.executemany(
+            "INSERT INTO person (handle, json_data) VALUES (?, ?)", rows
+        )
+    connection.commit()
+    connection.close()
+
+
+def default_workers() -> str:
+    """
+    Returns 1, 2, 4, ... up to the number of cores, and that number.
+    """
+    cores = os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] * 2 <= cores:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cores:
+        counts.append(cores)
+    return ",".join(str(count) for count in counts)
+
+
+def bench_scan(args: argparse.Namespace) -> None:
+    from scan_engine import NameFilter, ScanEngine
+
+    workers = [int(number) for number in args.workers.split(",")]
+    with tempfile.TemporaryDirectory() as folder:
+        started = time.perf_counter()
+        synthetic_sqlite_tree(folder, args.people)
+        print(
+            f"tree: {args.people} persons in {time.perf_counter() - started:.1f} s "
+            f"({os.cpu_count()} cores)"
+        )
+        single = 0.0
+        for count in workers:
+            with ScanEngine(SyntheticTree(folder), count) as engine:
+                timings = []
+                for run in range(args.runs + 1):
+                    started = time.perf_counter()
+                    found = sum(1 for _ in engine.scan("person", NameFilter("Jansen")))
+                    # the first run starts the worker processes
+                    if run:
+                        timings.append(time.perf_counter() - started)
+            seconds = statistics.median(timings)
+            single = single or seconds
+            print(
+                f"{count} workers: {args.people / seconds:.0f} persons/s, "
+                f"{found} matches, speedup {single / seconds:.2f}"
+            )
+
+
+def bench_pushdown(args: argparse.Namespace) -> None:
+    from people_search import find_people
+    from sidecar_index import SidecarIndex
+
+    rng = random.Random(2)
+    searches = [rng.choice(SURNAMES).split("_")[-1] for _ in range(args.queries)]
+    searches += [
+        f"{rng.choice(FIRST_NAMES)} {rng.choice(SURNAMES).split('_')[-1]}"
+        for _ in range(args.queries)
+    ]
+    searches.append("Nobody")
+    with tempfile.TemporaryDirectory() as folder:
+        synthetic_sqlite_tree(folder, args.people)
+        tree = SyntheticTree(folder)
+        started = time.perf_counter()
+        sidecar = SidecarIndex(tree, os.path.join(folder, "sidecar.sqlite")).refresh()
+        print(f"sidecar built in {time.perf_counter() - started:.2f} s")
+        indexes = (
+            ("database API", None),
+            ("sidecar FTS5", sidecar),
+        )
+        for label, use in indexes:
+            timings = []
+            for search in searches:
+                started = time.perf_counter()
+                find_people(tree, search, index=use)
+                timings.append(time.perf_counter() - started)
+            report(f"{label} ({len(searches)} searches)", timings)
+        # the worst case of the API path: no early stop, every person read
+        for label, use in indexes:
+            started = time.perf_counter()
+            found = find_people(tree, "Nobody", index=use)
+            print(
+                f"{label}, no match: {time.perf_counter() - started:.2f} s, "
+                f"{found['total_matches']} found"
+            )
+        sidecar.close()
+        tree.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    startup = subparsers.add_parser("startup", help="time to the first prompt")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.set_defaults(func=bench_startup)
+    semantic = subparsers.add_parser("semantic", help="semantic_search index")
+    semantic.add_argument("--people", type=int, default=100000)
+    semantic.add_argument("--queries", type=int, default=200)
+    semantic.add_argument(
+        "--probes", type=int, default=None, help="clusters searched per query"
+    )
+    semantic.set_defaults(func=bench_semantic)
+    scan = subparsers.add_parser("scan", help="scan_engine")
+    scan.add_argument("--people", type=int, default=1000000)
+    scan.add_argument(
+        "--workers",
+        default=default_workers(),
+        help="comma separated numbers of workers",
+    )
+    scan.add_argument("--runs", type=int, default=3)
+    scan.set_defaults(func=bench_scan)
+    pushdown = subparsers.add_parser("pushdown", help="sidecar_index")
+    pushdown.add_argument("--people", type=int, default=200000)
+    pushdown.add_argument("--queries", type=int, default=5)
+    pushdown.set_defaults(func=bench_pushdown)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Cooperative cancellation of a question that is being answered.
+
+The console (or any other front end) cancels the token of a question; the
+chatbot checks it between LLM turns and tool calls, stops waiting for the
+LLM, and raises QueryCancelled to free the database worker for the next
+question. Tools that read the whole tree check it while they read.
+"""
+import threading
+from typing import Iterable, Iterator, Optional, TypeVar
+
+# records read between two checks of the token by a tool that reads the
+# whole tree
+CHECK_EVERY = 1000
+
+T = TypeVar("T")
+
+
+class QueryCancelled(Exception):
+    """
+    The question was cancelled by the user.
+    """
+
+
+class CancellationToken:
+    """
+    Set once, by any thread, to cancel one question.
+    """
+
+    def __init__(self) -> None:
+        self._event = threading.Event()
+
+    def cancel(self) -> None:
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self) -> None:
+        if self._event.is_set():
+            raise QueryCancelled()
+
+    def wait(self, seconds: float) -> bool:
+        """
+        Waits at most `seconds`; returns True when cancelled.
+        """
+        return self._event.wait(seconds)
+
+
+def checked(
+    items: Iterable[T], cancel: Optional[CancellationToken], every: int = CHECK_EVERY
+) -> Iterator[T]:
+    """
+    Yields the items, raising QueryCancelled before every `every`-th item
+    once `cancel` is cancelled.
+    """
+    if cancel is None:
+        yield from items
+        return
+    for number, item in enumerate(items):
+        if number % every == 0:
+            cancel.raise_if_cancelled()
+        yield item
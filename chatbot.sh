@@ -44,7 +44,7 @@ PYTHON_SCRIPT="ChatBotConsole.py"
 
 # Define the Python package(s) your script needs
 # These will be installed in the virtual environment
-PYTHON_PACKAGES="litellm gramps PyGObject"
+PYTHON_PACKAGES="litellm gramps PyGObject numpy"
 
 # --- Script Logic ---
 
@@ -79,17 +79,25 @@ else
 fi
 
 # 3. Install required Python packages into the virtual environment
-echo "Installing/Upgrading required Python packages: ${PYTHON_PACKAGES}"
-pip install ${PYTHON_PACKAGES}
-if [ $? -ne 0 ]; then
-    echo "Error: Failed to install Python packages. Please check your network connection or package names."
-    deactivate # Deactivate before exiting on error
-    exit 1
+# Only when the package list changed: running pip on every start costs seconds.
+PACKAGES_MARKER="$VENV_NAME/.installed_packages"
+if [ "$(cat "$PACKAGES_MARKER" 2>/dev/null)" != "${PYTHON_PACKAGES}" ]; then
+    echo "Installing/Upgrading required Python packages: ${PYTHON_PACKAGES}"
+    pip install ${PYTHON_PACKAGES}
+    if [ $? -ne 0 ]; then
+        echo "Error: Failed to install Python packages. Please check your network connection or package names."
+        deactivate # Deactivate before exiting on error
+        exit 1
+    fi
+    echo "${PYTHON_PACKAGES}" > "$PACKAGES_MARKER"
+else
+    echo "Required Python packages are already installed: ${PYTHON_PACKAGES}"
 fi
 
 # 4. Run your Python script
 echo "--- Running ${PYTHON_SCRIPT} ---"
-python "$PYTHON_SCRIPT" # Use 'python' as it points to the venv's python
+# any arguments, like --debug, are passed on to the script
+python "$PYTHON_SCRIPT" "$@" # Use 'python' as it points to the venv's python
 
 # 5. Deactivate the virtual environment (optional, but good practice if you want to return to system environment)
 echo "--- Script finished. Deactivating virtual environment. ---"
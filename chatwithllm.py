@@ -1,10 +1,12 @@
 import abc
 import time
 from enum import Enum, auto
-from typing import Iterator, Tuple
+from typing import Iterator, Optional, Tuple
 
 from gramps.gen.const import GRAMPS_LOCALE as glocale
 
+from cancellation import CancellationToken
+
 # ==============================================================================
 # Support GRAMPS API translations
 # ==============================================================================
@@ -17,6 +19,8 @@ class YieldType(Enum):
     PARTIAL = auto()
     TOOL_CALL = auto()
     FINAL = auto()
+    # the place of the question in the queue of the chat service, 1 is next
+    QUEUED = auto()
 
 
 # ==============================================================================
@@ -29,9 +33,12 @@ class IChatLogic(abc.ABC):
     """
 
     @abc.abstractmethod
-    def get_reply(self, message: str) -> Iterator[Tuple[YieldType, str]]:
+    def get_reply(
+        self, message: str, cancel: Optional[CancellationToken] = None
+    ) -> Iterator[Tuple[YieldType, str]]:
         """
-        Processes a user message and returns a reply string.
+        Processes a user message and returns a reply string. The reply
+        should stop soon after `cancel` is cancelled.
         """
         pass
 
@@ -64,7 +71,9 @@ class ChatWithLLM(IChatLogic):
         """
         pass
 
-    def get_reply(self, message: str) -> Iterator[Tuple[YieldType, str]]:
+    def get_reply(
+        self, message: str, cancel: Optional[CancellationToken] = None
+    ) -> Iterator[Tuple[YieldType, str]]:
         """
         Processes the message and yields parts of the reply.
 
@@ -78,6 +87,8 @@ class ChatWithLLM(IChatLogic):
         reversed_message = _("Tree: '{}'").format(message[::-1])
 
         for char in reversed_message:
+            if cancel is not None and cancel.cancelled:
+                return
             yield (YieldType.PARTIAL, char)
             time.sleep(0.05)  # Simulate a slight delay, like a real-time stream
         yield (YieldType.FINAL, reversed_message)  # final response
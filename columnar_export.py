@@ -0,0 +1,401 @@
+"""
+Streaming export of a Gramps tree to chunked, memory-mappable column files.
+
+Every table (people, families, events, places) is written as a series of
+chunks of at most `chunk_rows` rows; every column of a chunk is a NumPy
+.npy file. A string column is two files: the UTF-8 bytes of all its
+values one after the other (<column>.bytes.npy), and the offset of every
+value in them (<column>.offsets.npy, one more than there are rows), so one
+long place name does not widen every row of the chunk. Only one chunk is
+held in memory at a time, so the export runs in constant memory whatever
+the size of the tree, and the files can be opened with mmap_mode="r" for
+offline analysis.
+
+Usage:
+    python columnar_export.py <database name> <output folder>
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from gramps.gen.lib import FamilyRelType, Person, PlaceType
+
+from rawdata_utils import date_year_span, event_type_name, primary_surname
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+LOG = logging.getLogger("columnar_export")
+
+EXPORT_VERSION = 2
+MANIFEST_FILE_NAME = "manifest.json"
+DEFAULT_CHUNK_ROWS = 65536
+
+# table -> ordered (column, NumPy dtype) pairs; "str" columns are stored
+# as UTF-8 bytes with offsets so they can be memory-mapped as well
+TABLES: Dict[str, List[Tuple[str, str]]] = {
+    "people": [
+        ("handle", "str"),
+        ("gramps_id", "str"),
+        ("first_name", "str"),
+        ("surname", "str"),
+        ("gender", "int8"),
+        ("birth_event", "str"),
+        ("birth_year", "int32"),
+        ("birth_place", "str"),
+        ("death_event", "str"),
+        ("death_year", "int32"),
+        ("death_place", "str"),
+    ],
+    "families": [
+        ("handle", "str"),
+        ("gramps_id", "str"),
+        ("father", "str"),
+        ("mother", "str"),
+        ("relationship", "str"),
+        ("child_count", "int32"),
+    ],
+    "events": [
+        ("handle", "str"),
+        ("gramps_id", "str"),
+        ("type", "str"),
+        ("first_year", "int32"),
+        ("last_year", "int32"),
+        ("sortval", "int64"),
+        ("place", "str"),
+        ("description", "str"),
+    ],
+    "places": [
+        ("handle", "str"),
+        ("gramps_id", "str"),
+        ("name", "str"),
+        ("type", "str"),
+        ("enclosed_by", "str"),
+        ("latitude", "str"),
+        ("longitude", "str"),
+    ],
+}
+
+
+def _event_year_place(db: Any, raw_person: Dict[str, Any], ref_key: str) -> Tuple:
+    """
+    Returns (event handle, year, place handle) of a person's birth or death.
+    """
+    refs = raw_person.get("event_ref_list") or []
+    ref_index = raw_person.get(ref_key, -1)
+    if not 0 <= ref_index < len(refs):
+        return ("", 0, "")
+    event_handle = refs[ref_index]["ref"]
+    raw_event = db.get_raw_event_data(event_handle)
+    span = date_year_span(raw_event.get("date"))
+    year = (span[0] + span[1]) // 2 if span else 0
+    return (event_handle, year, raw_event.get("place") or "")
+
+
+def iter_people(db: Any) -> Iterator[Tuple]:
+    for handle in db.iter_person_handles():
+        raw_person = db.get_raw_person_data(handle)
+        yield (
+            handle,
+            raw_person.get("gramps_id", ""),
+            (raw_person.get("primary_name") or {}).get("first_name", ""),
+            primary_surname(raw_person),
+            raw_person.get("gender", Person.UNKNOWN),
+            *_event_year_place(db, raw_person, "birth_ref_index"),
+            *_event_year_place(db, raw_person, "death_ref_index"),
+        )
+
+
+def iter_families(db: Any) -> Iterator[Tuple]:
+    for handle in db.iter_family_handles():
+        raw_family = db.get_raw_family_data(handle)
+        yield (
+            handle,
+            raw_family.get("gramps_id", ""),
+            raw_family.get("father_handle") or "",
+            raw_family.get("mother_handle") or "",
+            FamilyRelType(raw_family["type"]).xml_str(),
+            len(raw_family.get("child_ref_list") or []),
+        )
+
+
+def iter_events(db: Any) -> Iterator[Tuple]:
+    for handle in db.iter_event_handles():
+        raw_event = db.get_raw_event_data(handle)
+        span = date_year_span(raw_event.get("date")) or (0, 0, False)
+        yield (
+            handle,
+            raw_event.get("gramps_id", ""),
+            event_type_name(raw_event["type"]),
+            span[0],
+            span[1],
+            (raw_event.get("date") or {}).get("sortval", 0),
+            raw_event.get("place") or "",
+            raw_event.get("description", ""),
+        )
+
+
+def iter_places(db: Any) -> Iterator[Tuple]:
+    for handle in db.iter_place_handles():
+        raw_place = db.get_raw_place_data(handle)
+        refs = raw_place.get("placeref_list") or []
+        yield (
+            handle,
+            raw_place.get("gramps_id", ""),
+            (raw_place.get("name") or {}).get("value", ""),
+            PlaceType(raw_place["place_type"]).xml_str(),
+            refs[0]["ref"] if refs else "",
+            raw_place.get("lat", ""),
+            raw_place.get("long", ""),
+        )
+
+
+ROW_ITERATORS = {
+    "people": iter_people,
+    "families": iter_families,
+    "events": iter_events,
+    "places": iter_places,
+}
+
+
+class _ChunkWriter:
+    """
+    Buffers at most `chunk_rows` rows of one table and writes them out as
+    one .npy file per column.
+    """
+
+    def __init__(self, folder: str, table: str, chunk_rows: int) -> None:
+        self.folder = folder
+        self.table = table
+        self.columns = TABLES[table]
+        self.chunk_rows = chunk_rows
+        self.buffer: List[Tuple] = []
+        self.chunks: List[Dict[str, Any]] = []
+
+    def append(self, row: Tuple) -> None:
+        self.buffer.append(row)
+        if len(self.buffer) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.buffer:
+            return
+        chunk = os.path.join(self.table, f"{len(self.chunks):05d}")
+        os.makedirs(os.path.join(self.folder, chunk))
+        for position, (column, dtype) in enumerate(self.columns):
+            values = [row[position] for row in self.buffer]
+            path = os.path.join(self.folder, chunk, column)
+            if dtype == "str":
+                encoded = [value.encode("utf-8") for value in values]
+                offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+                np.cumsum([len(value) for value in encoded], out=offsets[1:])
+                np.save(f"{path}.offsets.npy", offsets)
+                np.save(
+                    f"{path}.bytes.npy",
+                    np.frombuffer(b"".join(encoded), dtype=np.uint8),
+                )
+            else:
+                np.save(f"{path}.npy", np.array(values, dtype=dtype))
+        self.chunks.append({"path": chunk, "rows": len(self.buffer)})
+        self.buffer = []
+
+
+def export_tree(
+    db: Any, folder: str, chunk_rows: int = DEFAULT_CHUNK_ROWS
+) -> Dict[str, Any]:
+    """
+    Exports the database to `folder`, replacing an earlier export there.
+    Any other folder that is not empty is left alone and raises.
+
+    The export is written next to the folder first and only moved in place
+    when complete, so readers never see a half-written export.
+    """
+    if np is None:
+        raise Exception("the columnar export requires numpy")
+    folder = os.path.abspath(folder)
+    _check_replaceable(folder)
+    partial = folder + ".partial"
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    manifest: Dict[str, Any] = {
+        "version": EXPORT_VERSION,
+        "database": db.get_dbname(),
+        "created": int(time.time()),
+        "tables": {},
+    }
+    for table, iter_rows in ROW_ITERATORS.items():
+        started = time.perf_counter()
+        writer = _ChunkWriter(partial, table, chunk_rows)
+        for row in iter_rows(db):
+            writer.append(row)
+        writer.flush()
+        manifest["tables"][table] = {
+            "columns": dict(TABLES[table]),
+            "chunks": writer.chunks,
+            "rows": sum(chunk["rows"] for chunk in writer.chunks),
+        }
+        LOG.info(
+            f"Exported {manifest['tables'][table]['rows']} {table} "
+            f"in {time.perf_counter() - started:.1f}s"
+        )
+    with open(os.path.join(partial, MANIFEST_FILE_NAME), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.replace(partial, folder)
+    return manifest
+
+
+def _check_replaceable(folder: str) -> None:
+    """
+    Raises unless `folder` is missing, empty or holds an earlier export.
+    """
+    if not os.path.exists(folder):
+        return
+    if not os.path.isdir(folder):
+        raise Exception(f"{folder} is not a folder")
+    if os.listdir(folder) and not ColumnarTree.exists(folder):
+        raise Exception(
+            f"{folder} is not empty and holds no columnar export; "
+            "not replacing it"
+        )
+
+
+class StringColumn:
+    """
+    One chunk of a string column: the memory-mapped offsets and UTF-8
+    bytes of its values. Values are decoded when they are read.
+    """
+
+    def __init__(self, offsets: Any, data: Any) -> None:
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row: int) -> str:
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return self.data[start:end].tobytes().decode("utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.tolist())
+
+    def tolist(self) -> List[str]:
+        data = self.data.tobytes()
+        offsets = self.offsets.tolist()
+        return [
+            data[start:end].decode("utf-8") for start, end in zip(offsets, offsets[1:])
+        ]
+
+
+class ColumnarTree:
+    """
+    Read access to an export written by export_tree(). Column chunks are
+    memory-mapped, so opening an export costs almost nothing.
+    """
+
+    def __init__(self, folder: str) -> None:
+        if np is None:
+            raise Exception("reading a columnar export requires numpy")
+        self.folder = folder
+        with open(os.path.join(folder, MANIFEST_FILE_NAME)) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        if self.manifest.get("version") != EXPORT_VERSION:
+            raise Exception(f"Unsupported columnar export version in {folder}")
+
+    @staticmethod
+    def exists(folder: Optional[str]) -> bool:
+        return bool(folder) and os.path.exists(
+            os.path.join(folder, MANIFEST_FILE_NAME)
+        )
+
+    @property
+    def database(self) -> str:
+        return self.manifest["database"]
+
+    @property
+    def created(self) -> int:
+        return self.manifest["created"]
+
+    def rows(self, table: str) -> int:
+        return self.manifest["tables"][table]["rows"]
+
+    def iter_chunks(
+        self, table: str, columns: Optional[List[str]] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Yields {column: memory-mapped array} for every chunk of a table;
+        string columns are StringColumns.
+        """
+        table_info = self.manifest["tables"][table]
+        columns = columns or list(table_info["columns"])
+        for chunk in table_info["chunks"]:
+            arrays = {}
+            for column in columns:
+                path = os.path.join(self.folder, chunk["path"], column)
+                if table_info["columns"][column] == "str":
+                    arrays[column] = StringColumn(
+                        np.load(f"{path}.offsets.npy", mmap_mode="r"),
+                        np.load(f"{path}.bytes.npy", mmap_mode="r"),
+                    )
+                else:
+                    arrays[column] = np.load(f"{path}.npy", mmap_mode="r")
+            yield arrays
+
+    def column(self, table: str, column: str) -> Any:
+        """
+        Returns a whole column as one array (this copies the chunks); the
+        values of a string column are Python strings in an object array.
+        """
+        dtype = self.manifest["tables"][table]["columns"][column]
+        chunks = [chunk[column] for chunk in self.iter_chunks(table, [column])]
+        if dtype == "str":
+            return np.array(
+                [value for chunk in chunks for value in chunk.tolist()], dtype=object
+            )
+        if not chunks:
+            return np.array([], dtype=dtype)
+        return np.concatenate(chunks)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("database", help="name of the Gramps database")
+    parser.add_argument("folder", help="folder to write the export to")
+    parser.add_argument(
+        "--chunk-rows",
+        type=int,
+        default=DEFAULT_CHUNK_ROWS,
+        help=f"rows per chunk (default {DEFAULT_CHUNK_ROWS})",
+    )
+    parser.add_argument(
+        "--db-path",
+        default=os.environ.get("GRAMPS_DB_LOCATION"),
+        help="folder holding the Gramps databases (default: GRAMPS_DB_LOCATION)",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from gramps.gen.config import CONFIGMAN
+    from gramps.gen.db.utils import open_database
+
+    if args.db_path:
+        CONFIGMAN.set("database.path", os.path.abspath(args.db_path))
+    db = open_database(args.database, force_unlock=True)
+    if db is None:
+        raise Exception(f"Unable to open database {args.database}")
+    try:
+        export_tree(db, args.folder, args.chunk_rows)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+from bisect import bisect_left, bisect_right, insort
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from cancellation import CancellationToken, checked
+from rawdata_utils import date_year_span, event_type_name
+
+# Entries whose year span is at most this wide live in the sorted list and
+# are found by binary search. Wider spans ("between 1700 and 1900") are rare
+# and are kept aside so they don't widen every binary search window.
+NARROW_SPAN = 20
+
+# key used for the bucket that holds the events of every type
+ALL_TYPES = ""
+
+Entry = Tuple[int, int, str]  # (first_year, last_year, event_handle)
+
+
+class _YearBucket:
+    """
+    The events of one event type, sorted on the first year they may refer to.
+    """
+
+    def __init__(self) -> None:
+        self.starts: List[int] = []
+        self.entries: List[Entry] = []
+        self.wide: Dict[str, Entry] = {}
+
+    def add(self, entry: Entry) -> None:
+        first_year, last_year, handle = entry
+        if last_year - first_year > NARROW_SPAN:
+            self.wide[handle] = entry
+            return
+        position = bisect_right(self.entries, entry)
+        self.entries.insert(position, entry)
+        self.starts.insert(position, first_year)
+
+    def remove(self, entry: Entry) -> None:
+        if self.wide.pop(entry[2], None) is not None:
+            return
+        position = bisect_left(self.entries, entry)
+        if position < len(self.entries) and self.entries[position] == entry:
+            del self.entries[position]
+            del self.starts[position]
+
+    def overlapping(self, start_year: int, end_year: int) -> List[Entry]:
+        """
+        Returns the entries whose span overlaps [start_year, end_year],
+        sorted on their first year.
+        """
+        low = bisect_left(self.starts, start_year - NARROW_SPAN)
+        high = bisect_right(self.starts, end_year)
+        found = [
+            entry for entry in self.entries[low:high] if entry[1] >= start_year
+        ]
+        for entry in self.wide.values():
+            if entry[0] <= end_year and entry[1] >= start_year:
+                insort(found, entry)
+        return found
+
+
+class EventDateIndex:
+    """
+    Sorted index over the years of all dated events in a Gramps database,
+    kept per event type so that e.g. births in a range are found by binary
+    search instead of by walking every person in the tree.
+
+    Approximate dates ("about", "before", "after", ranges and estimated or
+    calculated dates) are indexed with the span of years they may refer to,
+    so they are found by any overlapping query and flagged as approximate.
+    """
+
+    def __init__(self) -> None:
+        self._buckets: Dict[str, _YearBucket] = {ALL_TYPES: _YearBucket()}
+        self._by_handle: Dict[str, Tuple[str, Entry]] = {}
+        self._approximate: Set[str] = set()
+
+    def build(
+        self, db: Any, cancel: Optional[CancellationToken] = None
+    ) -> "EventDateIndex":
+        """
+        Indexes every event in the database. Raises QueryCancelled when
+        `cancel` is cancelled.
+        """
+        for handle in checked(db.iter_event_handles(), cancel):
+            self.add_event(handle, db.get_raw_event_data(handle))
+        return self
+
+    def __len__(self) -> int:
+        return len(self._by_handle)
+
+    def add_event(self, handle: str, raw_event: Dict[str, Any]) -> None:
+        """
+        Adds an event to the index, replacing any earlier version of it.
+        Events without a usable year are not indexed.
+        """
+        self.remove_event(handle)
+        span = date_year_span(raw_event.get("date"))
+        if span is None:
+            return
+        first_year, last_year, approximate = span
+        type_key = event_type_name(raw_event["type"]).lower()
+        entry = (first_year, last_year, handle)
+        self._buckets.setdefault(type_key, _YearBucket()).add(entry)
+        self._buckets[ALL_TYPES].add(entry)
+        self._by_handle[handle] = (type_key, entry)
+        if approximate:
+            self._approximate.add(handle)
+
+    def remove_event(self, handle: str) -> None:
+        indexed = self._by_handle.pop(handle, None)
+        if indexed is None:
+            return
+        type_key, entry = indexed
+        self._buckets[type_key].remove(entry)
+        self._buckets[ALL_TYPES].remove(entry)
+        self._approximate.discard(handle)
+
+    def event_types(self) -> List[str]:
+        return sorted(key for key in self._buckets if key != ALL_TYPES)
+
+    def query(
+        self,
+        start_year: int,
+        end_year: int,
+        event_type: Optional[str] = None,
+        limit: int = 50,
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Finds the events that may have happened between start_year and
+        end_year (inclusive), optionally of one event type only.
+
+        Returns the first `limit` matches in chronological order together
+        with the total number of matches.
+        """
+        if start_year > end_year:
+            start_year, end_year = end_year, start_year
+        bucket = self._buckets.get((event_type or ALL_TYPES).strip().lower())
+        if bucket is None:
+            return [], 0
+        found = bucket.overlapping(start_year, end_year)
+        matches = [
+            {
+                "event_handle": handle,
+                "first_year": first_year,
+                "last_year": last_year,
+                "approximate": handle in self._approximate,
+            }
+            for first_year, last_year, handle in found[:limit]
+        ]
+        return matches, len(found)
@@ -0,0 +1,194 @@
+"""
+Answers the most common questions without the LLM.
+
+"Who is the father of Jim Baker?", "when was Jim Baker born?" and "children
+of Jim Baker" (and their Dutch versions) are recognized with regular
+expressions and answered straight from the tool functions in milliseconds.
+Anything else, and any question whose name does not match exactly one
+person, is left to the LLM.
+"""
+import logging
+import re
+from typing import Any, Callable, Dict, List, Optional, Pattern, Tuple
+
+from people_search import resolve_person
+from rawdata_utils import person_name
+
+LOG = logging.getLogger("fast_path")
+
+FATHER = "father"
+MOTHER = "mother"
+CHILDREN = "children"
+BIRTH_DATE = "birth_date"
+BIRTH_PLACE = "birth_place"
+DEATH_DATE = "death_date"
+DEATH_PLACE = "death_place"
+
+NAME = r"(?P<name>[\w][\w .'-]*?)"
+
+# (language, pattern); the intent follows from the named groups "rel",
+# "ask" and "event", see _intent()
+QUESTION_PATTERNS: List[Tuple[str, Pattern]] = [
+    (language, re.compile(r"^\s*" + pattern + r"\s*[?.!]*\s*$", re.IGNORECASE))
+    for language, pattern in (
+        ("en", r"who (?:is|was) the (?P<rel>father|mother) of " + NAME),
+        ("en", r"who (?:is|was) " + NAME + r"'s (?P<rel>father|mother)"),
+        ("en", r"(?:who (?:are|were) )?(?:the )?(?P<rel>children) of " + NAME),
+        ("en", r"who (?:are|were) " + NAME + r"'s (?P<rel>children)"),
+        ("en", r"(?P<ask>when|where) (?:was|is) " + NAME + r" (?P<event>born)"),
+        ("en", r"(?P<ask>when|where) did " + NAME + r" (?P<event>die)"),
+        ("nl", r"wie (?:is|was) de (?P<rel>vader|moeder) van " + NAME),
+        ("nl", r"(?:wie zijn |wie waren )?(?:de )?(?P<rel>kinderen) van " + NAME),
+        (
+            "nl",
+            r"(?P<ask>wanneer|waar) (?:is|was|werd) " + NAME
+            + r" (?P<event>geboren|overleden|gestorven)",
+        ),
+    )
+]
+
+INTENTS = {
+    "father": FATHER,
+    "vader": FATHER,
+    "mother": MOTHER,
+    "moeder": MOTHER,
+    "children": CHILDREN,
+    "kinderen": CHILDREN,
+}
+DATE_QUESTIONS = ("when", "wanneer")
+BIRTH_EVENTS = ("born", "geboren")
+
+ANSWERS = {
+    "en": {
+        FATHER: "The father of {person} is {answer}.",
+        MOTHER: "The mother of {person} is {answer}.",
+        CHILDREN: "The children of {person} are {answer}.",
+        BIRTH_DATE: "{person} was born {answer}.",
+        BIRTH_PLACE: "{person} was born in {answer}.",
+        DEATH_DATE: "{person} died {answer}.",
+        DEATH_PLACE: "{person} died in {answer}.",
+        "and": "and",
+    },
+    "nl": {
+        FATHER: "De vader van {person} is {answer}.",
+        MOTHER: "De moeder van {person} is {answer}.",
+        CHILDREN: "De kinderen van {person} zijn {answer}.",
+        BIRTH_DATE: "{person} is geboren {answer}.",
+        BIRTH_PLACE: "{person} is geboren in {answer}.",
+        DEATH_DATE: "{person} is overleden {answer}.",
+        DEATH_PLACE: "{person} is overleden in {answer}.",
+        "and": "en",
+    },
+}
+UNKNOWN_ANSWERS = {
+    "en": {
+        FATHER: "The father of {person} is not recorded in the tree.",
+        MOTHER: "The mother of {person} is not recorded in the tree.",
+        CHILDREN: "No children of {person} are recorded in the tree.",
+        BIRTH_DATE: "The birth date of {person} is not recorded in the tree.",
+        BIRTH_PLACE: "The birth place of {person} is not recorded in the tree.",
+        DEATH_DATE: "The date of death of {person} is not recorded in the tree.",
+        DEATH_PLACE: "The place of death of {person} is not recorded in the tree.",
+    },
+    "nl": {
+        FATHER: "De vader van {person} staat niet in de stamboom.",
+        MOTHER: "De moeder van {person} staat niet in de stamboom.",
+        CHILDREN: "Er staan geen kinderen van {person} in de stamboom.",
+        BIRTH_DATE: "De geboortedatum van {person} staat niet in de stamboom.",
+        BIRTH_PLACE: "De geboorteplaats van {person} staat niet in de stamboom.",
+        DEATH_DATE: "De overlijdensdatum van {person} staat niet in de stamboom.",
+        DEATH_PLACE: "De plaats van overlijden van {person} staat niet in de "
+        "stamboom.",
+    },
+}
+
+
+def _intent(match: re.Match) -> str:
+    groups = match.groupdict()
+    if groups.get("rel"):
+        return INTENTS[groups["rel"].lower()]
+    birth = groups["event"].lower() in BIRTH_EVENTS
+    date = groups["ask"].lower() in DATE_QUESTIONS
+    if birth:
+        return BIRTH_DATE if date else BIRTH_PLACE
+    return DEATH_DATE if date else DEATH_PLACE
+
+
+def parse_question(question: str) -> Optional[Tuple[str, str, str]]:
+    """
+    Returns (intent, name, language) when the question is one of the
+    questions we answer without the LLM, else None.
+    """
+    for language, pattern in QUESTION_PATTERNS:
+        match = pattern.match(question)
+        if match:
+            return _intent(match), match.group("name").strip(), language
+    return None
+
+
+def _join(names: List[str], language: str) -> str:
+    if len(names) == 1:
+        return names[0]
+    return f"{', '.join(names[:-1])} {ANSWERS[language]['and']} {names[-1]}"
+
+
+class FastPath:
+    """
+    Answers the questions recognized by parse_question() with the tools of
+    the chatbot, given as its tool map.
+    """
+
+    def __init__(self, tools: Dict[str, Callable[..., Any]]) -> None:
+        self.tools = tools
+        self.answered = 0
+        self.passed = 0
+
+    def resolve_person(self, name: str) -> Optional[str]:
+        """
+        Returns the handle of the one person whose whole name, given name
+        and surname, matches `name`; None leaves the question to the LLM.
+        """
+        return resolve_person(self.tools["find_people_by_name"], name)
+
+    def answer(self, question: str) -> Optional[str]:
+        """
+        Returns the answer to the question, or None if the LLM should
+        answer it.
+        """
+        parsed = parse_question(question)
+        if parsed is None:
+            return None
+        intent, name, language = parsed
+        handle = self.resolve_person(name)
+        if handle is None:
+            LOG.debug(f"No single person named {name!r}, asking the LLM")
+            self.passed += 1
+            return None
+        person = person_name(self.tools["get_person"](handle))
+        answer = self._lookup(intent, handle, language)
+        self.answered += 1
+        if not answer:
+            return UNKNOWN_ANSWERS[language][intent].format(person=person)
+        return ANSWERS[language][intent].format(person=person, answer=answer)
+
+    def _lookup(self, intent: str, handle: str, language: str) -> str:
+        if intent in (FATHER, MOTHER):
+            try:
+                parent = self.tools[f"get_{intent}_of_person"](handle)
+            except AttributeError:
+                # SimpleAccess found no such parent
+                return ""
+            return person_name(parent)
+        if intent == CHILDREN:
+            # all families of the person, not only the first one as
+            # get_children_of_person does
+            names = []
+            for family_handle in self.tools["get_person"](handle).get("family_list", []):
+                family = self.tools["get_family"](family_handle)
+                for child_ref in family.get("child_ref_list") or []:
+                    names.append(person_name(self.tools["get_person"](child_ref["ref"])))
+            return _join(names, language) if names else ""
+        return self.tools[f"get_person_{intent}"](handle) or ""
+
+    def stats(self) -> Dict[str, int]:
+        return {"answered": self.answered, "passed_to_llm": self.passed}
@@ -0,0 +1,123 @@
+"""
+A compact digest of the home person and their family, two generations up
+and down, to add to the system prompt. With it the LLM can start on most
+questions without first calling start_point and walking to the parents
+and children.
+"""
+import logging
+from typing import Any, List, Optional, Tuple
+
+from tree_query import QueryError, run_query
+
+LOG = logging.getLogger("home_digest")
+
+# (label, query from the home person)
+RELATIONS = (
+    ("Home person", "home"),
+    ("Spouse", "home.spouses"),
+    ("Parent", "home.parents"),
+    ("Grandparent", "home.parents.parents"),
+    ("Sibling", "home.siblings"),
+    ("Child", "home.children"),
+    ("Grandchild", "home.children.children"),
+)
+# persons listed per relation, so a large family does not flood the prompt
+MAX_PER_RELATION = 12
+
+HEADER = (
+    "\nThe home person of this tree (what `start_point` returns) and their "
+    "close family, so you do not need tools to look them up. Use the handles "
+    "to get more details:\n"
+)
+
+# (object kind, handle) of a record the digest was built from
+Record = Tuple[str, str]
+
+
+def _describe_line(label: str, person: dict) -> str:
+    line = f"- {label}: {person['name']} [{person['gramps_id']}, {person['handle']}]"
+    if person.get("birth"):
+        line += f", born {person['birth']}"
+    if person.get("death"):
+        line += f", died {person['death']}"
+    return line
+
+
+def _records_of(db: Any, person_handle: str) -> List[Record]:
+    """
+    Returns the records whose changes can change a person's lines: the
+    person, their families and their birth and death events.
+    """
+    raw_person = db.get_raw_person_data(person_handle)
+    records = [("person", person_handle)]
+    for key in ("family_list", "parent_family_list"):
+        records.extend(("family", handle) for handle in raw_person.get(key) or [])
+    refs = raw_person.get("event_ref_list") or []
+    for key in ("birth_ref_index", "death_ref_index"):
+        index = raw_person.get(key, -1)
+        if 0 <= index < len(refs):
+            records.append(("event", refs[index]["ref"]))
+    return records
+
+
+def _snapshot(db: Any, records: List[Record]) -> Tuple:
+    """
+    Returns the raw data of the records. The "change" stamps alone are not
+    enough: they count seconds, and an edit in the same second as the
+    previous one would go unnoticed.
+    """
+    return tuple(
+        getattr(db, f"get_raw_{kind}_data")(handle) for kind, handle in records
+    )
+
+
+class HomeDigest:
+    """
+    The digest text and the records it was built from. refresh() only
+    rebuilds the text when the home person changed or one of those
+    records was edited.
+    """
+
+    def __init__(self) -> None:
+        self.text = ""
+        self.home_handle: Optional[str] = None
+        self.records: List[Record] = []
+        self.snapshot: Tuple = ()
+
+    def refresh(self, db: Any) -> bool:
+        """
+        Brings the digest up to date; returns True when the text changed.
+        """
+        home_handle = db.get_default_handle()
+        if (
+            home_handle == self.home_handle
+            and self.records
+            and _snapshot(db, self.records) == self.snapshot
+        ):
+            return False
+        text, records = self._build(db) if home_handle else ("", [])
+        self.home_handle = home_handle
+        self.records = records
+        self.snapshot = _snapshot(db, records)
+        changed = text != self.text
+        self.text = text
+        return changed
+
+    def _build(self, db: Any) -> Tuple[str, List[Record]]:
+        lines = []
+        records: List[Record] = []
+        seen = set()
+        for label, query in RELATIONS:
+            try:
+                found = run_query(db, query, MAX_PER_RELATION)
+            except QueryError as exc:
+                LOG.debug(f"Home digest query {query} failed: {exc}")
+                continue
+            for person in found["results"]:
+                lines.append(_describe_line(label, person))
+                if person["handle"] not in seen:
+                    seen.add(person["handle"])
+                    records.extend(_records_of(db, person["handle"]))
+            if found["truncated"]:
+                lines.append(f"- ({found['total'] - MAX_PER_RELATION} more)")
+        return HEADER + "\n".join(lines), records
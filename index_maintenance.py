@@ -0,0 +1,147 @@
+"""
+Keeps the indexes and caches of the gramplet's chatbot up to date while
+the tree is edited in Gramps.
+
+After every add, update and delete, also on undo and redo, the database
+emits a signal with the handles of the changed objects. The handlers only
+note the handles: the changes are applied when the next question starts,
+like the other database work of a question (see GrampletChatDriver), so
+editing in Gramps stays fast and no index changes while a tool reads
+it. When a change is applied the object is read again, so whether it was
+added, edited or deleted (by an undo or not) only its current state
+matters. The "-rebuild" signals, sent after
+imports and other batch changes, mark the whole tree as changed.
+"""
+import logging
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+LOG = logging.getLogger("index_maintenance")
+
+# the object types whose signals are followed, with their signal prefix
+OBJECT_TYPES = {
+    "Person": "person",
+    "Family": "family",
+    "Event": "event",
+    "Place": "place",
+    "Note": "note",
+    "Source": "source",
+    "Citation": "citation",
+}
+SIGNALS = ("add", "update", "delete")
+
+
+class TreeChanges:
+    """
+    The changes made to a tree since they were last applied: the handles
+    of the changed objects per object type, whether the whole tree has to
+    be indexed again, and the database Gramps switched to, if it did.
+    """
+
+    def __init__(self) -> None:
+        self.handles: Dict[str, Set[str]] = defaultdict(set)
+        self.rebuild = False
+        self.database: Optional[Any] = None
+
+    def __bool__(self) -> bool:
+        return self.rebuild or self.database is not None or any(self.handles.values())
+
+    def people(self, db: Any) -> Set[str]:
+        """
+        Returns the persons whose own data changed, or the events, places
+        or notes that describe them, e.g. their birth date.
+        """
+        people = set(self.handles["Person"])
+        events = set(self.handles["Event"])
+        for handle in self.handles["Place"]:
+            events.update(
+                ref for _, ref in db.find_backlink_handles(handle, ["Event"])
+            )
+        for handle in events | self.handles["Note"]:
+            people.update(
+                ref for _, ref in db.find_backlink_handles(handle, ["Person"])
+            )
+        return people
+
+
+class IndexMaintenance:
+    """
+    Collects the changes of the database it watches; take() hands them
+    over. The signal handlers run on the GTK thread, take() on the thread
+    that does the database work of the questions.
+    """
+
+    def __init__(self) -> None:
+        self.db: Optional[Any] = None
+        self._keys: List[Tuple[Any, int]] = []
+        self._changes = TreeChanges()
+        self._lock = threading.Lock()
+        self.signals = 0
+        self.applied = 0
+
+    def watch(self, db: Any) -> None:
+        """
+        Follows the changes of `db` instead of the database watched before.
+        """
+        self.stop()
+        self.db = db
+        for object_type, prefix in OBJECT_TYPES.items():
+            for signal in SIGNALS:
+                self._connect(db, f"{prefix}-{signal}", self._handler(object_type))
+            self._connect(db, f"{prefix}-rebuild", self._rebuild)
+
+    def _connect(self, db: Any, signal: str, callback: Any) -> None:
+        self._keys.append((db, db.connect(signal, callback)))
+
+    def stop(self) -> None:
+        for db, key in self._keys:
+            db.disconnect(key)
+        self._keys = []
+
+    def database_changed(self, db: Any) -> None:
+        """
+        Gramps opened another tree, or closed it: all indexes are dropped
+        when the next question starts.
+        """
+        self.watch(db)
+        with self._lock:
+            self._changes = TreeChanges()
+            self._changes.database = db
+
+    def _handler(self, object_type: str) -> Any:
+        def changed(handles: List[str]) -> None:
+            with self._lock:
+                self.signals += 1
+                self._changes.handles[object_type].update(handles)
+
+        return changed
+
+    def _rebuild(self, *args: Any) -> None:
+        with self._lock:
+            self.signals += 1
+            self._changes.rebuild = True
+
+    def take(self) -> TreeChanges:
+        """
+        Returns the changes since the last call, and starts collecting anew.
+        """
+        with self._lock:
+            changes, self._changes = self._changes, TreeChanges()
+        if changes:
+            self.applied += 1
+            LOG.debug(
+                "Applying changes: "
+                + ", ".join(
+                    f"{len(handles)} {object_type}"
+                    for object_type, handles in changes.handles.items()
+                    if handles
+                )
+                + (", rebuild" if changes.rebuild else "")
+            )
+        return changes
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            pending = sum(len(handles) for handles in self._changes.handles.values())
+        return {"signals": self.signals, "applied": self.applied, "pending": pending}
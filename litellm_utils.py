@@ -1,7 +1,35 @@
+import ast
+import difflib
 import inspect
+import json
+import logging
+import re
 import typing
+from types import ModuleType
 from typing import Any, Callable, Dict, List, Optional
 
+LOG = logging.getLogger("litellm_utils")
+
+_litellm: Optional[ModuleType] = None
+
+
+def get_litellm() -> ModuleType:
+    """
+    Returns the litellm module, importing it on first use.
+
+    Importing litellm takes seconds because it pulls in the SDKs of many
+    providers, so we only pay for it when the first LLM call is made.
+    """
+    global _litellm
+    if _litellm is None:
+        try:
+            import litellm
+        except ImportError:
+            raise Exception("GrampsChat requires litellm")
+        litellm.drop_params = True
+        _litellm = litellm
+    return _litellm
+
 
 def function_to_litellm_definition(
     func: Callable, description: Optional[str] = None
@@ -9,7 +37,7 @@ def function_to_litellm_definition(
     sig = inspect.signature(func)
     doc = description or func.__doc__ or ""
 
-    properties: Dict[str, Dict[str, str]] = {}
+    properties: Dict[str, Dict[str, Any]] = {}
     required: List[str] = []
 
     for name, param in sig.parameters.items():
@@ -20,13 +48,14 @@ def function_to_litellm_definition(
         param_type = (
             param.annotation if param.annotation != inspect.Parameter.empty else str
         )
-        json_type = python_type_to_json_type(param_type)
         properties[name] = {
-            "type": json_type,
+            **python_type_to_json_schema(param_type),
             "description": f"{name} parameter",
         }
         if param.default == inspect.Parameter.empty:
             required.append(name)
+        elif param.default is not None:
+            properties[name]["default"] = param.default
 
     function_def = {
         "name": func.__name__,
@@ -67,3 +96,241 @@ def python_type_to_json_type(python_type: type) -> str:
         return "array"
     else:
         return "string"  # default fallback
+
+
+def python_type_to_json_schema(python_type: Any) -> Dict[str, Any]:
+    """
+    Returns the JSON schema of a parameter type: List[str] becomes an array
+    of strings, Optional[int] an integer (the parameter is then optional).
+    """
+    origin = typing.get_origin(python_type)
+    args = [arg for arg in typing.get_args(python_type) if arg is not type(None)]
+    if origin is typing.Union and len(args) == 1:
+        return python_type_to_json_schema(args[0])
+    if origin in (list, typing.List) or python_type in (list, typing.List):
+        schema: Dict[str, Any] = {"type": "array"}
+        if args:
+            schema["items"] = python_type_to_json_schema(args[0])
+        return schema
+    if origin in (dict, typing.Dict):
+        return {"type": "object"}
+    return {"type": python_type_to_json_type(python_type)}
+
+
+class ToolArgumentError(ValueError):
+    """
+    The arguments of a tool call could not be made to fit the tool.
+    """
+
+
+# names models use for the same parameter; an unknown argument is renamed
+# to a missing parameter of its group
+ARGUMENT_ALIASES = (
+    {"query", "search_string", "search", "q", "text", "name", "keywords"},
+    {"limit", "k", "max_results", "top_k", "count", "n", "max"},
+    {"cursor", "offset", "next_cursor", "page_token", "skip"},
+    {"start_year", "from_year", "year_from", "start", "from"},
+    {"end_year", "to_year", "year_to", "end", "to"},
+)
+_TRUE = ("true", "yes", "1")
+_FALSE = ("false", "no", "0")
+
+
+def _normalize(name: str) -> str:
+    return re.sub(r"[^a-z0-9]", "", name.lower())
+
+
+def _coerce(value: Any, schema: Dict[str, Any]) -> Any:
+    """
+    Returns value as the type of the schema, accepting the usual mistakes
+    of models such as numbers in strings; raises ValueError otherwise.
+    """
+    json_type = schema.get("type")
+    if json_type == "string":
+        if isinstance(value, (dict, list)):
+            raise ValueError(f"expected a string, got {json.dumps(value)}")
+        return str(value)
+    if json_type == "integer":
+        if isinstance(value, bool):
+            raise ValueError(f"expected an integer, got {value}")
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        if isinstance(value, str):
+            value = value.strip()
+        return int(value)
+    if json_type == "number":
+        if isinstance(value, bool):
+            raise ValueError(f"expected a number, got {value}")
+        return float(value)
+    if json_type == "boolean":
+        if isinstance(value, bool):
+            return value
+        if str(value).strip().lower() in _TRUE:
+            return True
+        if str(value).strip().lower() in _FALSE:
+            return False
+        raise ValueError(f"expected true or false, got {value}")
+    if json_type == "array":
+        if isinstance(value, str):
+            value = json.loads(value) if value.strip().startswith("[") else [value]
+        if not isinstance(value, list):
+            value = [value]
+        items = schema.get("items")
+        return [_coerce(item, items) for item in value] if items else value
+    if json_type == "object":
+        if isinstance(value, str):
+            value = json.loads(value) if value.strip() else {}
+        if not isinstance(value, dict):
+            raise ValueError(f"expected an object, got {json.dumps(value)}")
+        return value
+    return value
+
+
+def parse_arguments(text: Any) -> Any:
+    """
+    Returns the arguments of a tool call from its JSON text. Accepts an
+    empty text, Python-style quotes and a dict that was already parsed.
+    """
+    if isinstance(text, dict) or text is None:
+        return text or {}
+    if not text.strip():
+        return {}
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        raise ToolArgumentError(f"the arguments are not valid JSON: {text}")
+
+
+class ToolSpec:
+    """
+    A tool with its definition for the LLM and what is needed to check and
+    repair the arguments of its calls, all worked out once.
+    """
+
+    def __init__(self, name: str, func: Callable) -> None:
+        self.name = name
+        self.func = func
+        self.definition = function_to_litellm_definition(func)
+        parameters = self.definition["function"].get("parameters", {})
+        self.schemas: Dict[str, Dict[str, Any]] = parameters.get("properties", {})
+        self.required: List[str] = parameters.get("required", [])
+        self.usage = (
+            f"{name}("
+            + ", ".join(
+                param if param in self.required else f"{param}={schema.get('default')!r}"
+                for param, schema in self.schemas.items()
+            )
+            + ")"
+        )
+
+    def _rename(self, key: str, missing: List[str]) -> Optional[str]:
+        """
+        Returns the missing parameter an unknown argument most likely is.
+        """
+        normalized = _normalize(key)
+        candidates = [
+            name
+            for name in missing
+            if normalized
+            and (normalized in _normalize(name) or _normalize(name) in normalized)
+        ]
+        if not candidates:
+            candidates = [
+                name
+                for name in missing
+                if any(key in group and name in group for group in ARGUMENT_ALIASES)
+            ]
+        if not candidates:
+            candidates = difflib.get_close_matches(key, missing, n=2, cutoff=0.75)
+        return candidates[0] if len(candidates) == 1 else None
+
+    def bind(self, raw_arguments: Any) -> Dict[str, Any]:
+        """
+        Returns the arguments to call the tool with, repaired where the
+        intention is clear; raises ToolArgumentError otherwise.
+        """
+        if not self.schemas:
+            # e.g. start_point: whatever the model sends is ignored, even
+            # text that does not parse
+            return {}
+        arguments = parse_arguments(raw_arguments)
+        if not isinstance(arguments, dict):
+            if len(self.required) != 1:
+                raise ToolArgumentError(f"expected arguments for {self.usage}")
+            # a bare value for the only required parameter
+            arguments = {self.required[0]: arguments}
+        bound = {key: value for key, value in arguments.items() if key in self.schemas}
+        unknown = [key for key in arguments if key not in self.schemas]
+        for key in unknown:
+            missing = [name for name in self.schemas if name not in bound]
+            name = self._rename(key, missing)
+            if name is None:
+                missing_required = [
+                    param for param in self.required if param not in bound
+                ]
+                if len(unknown) == 1 and len(missing_required) == 1:
+                    name = missing_required[0]
+            if name is None:
+                LOG.debug(f"Ignoring argument {key} of {self.name}")
+                continue
+            LOG.debug(f"Argument {key} of {self.name} taken as {name}")
+            bound[name] = arguments[key]
+        for name in self.required:
+            if bound.get(name) is None:
+                raise ToolArgumentError(f"missing argument {name}, use {self.usage}")
+        for name, value in list(bound.items()):
+            if value is None:
+                # null for an optional parameter: its default
+                del bound[name]
+                continue
+            try:
+                bound[name] = _coerce(value, self.schemas[name])
+            except (TypeError, ValueError) as exc:
+                raise ToolArgumentError(f"argument {name}: {exc}, use {self.usage}")
+        return bound
+
+
+class ToolRegistry:
+    """
+    The tools of the chatbot, with their litellm definitions and argument
+    checks built once instead of for every call.
+    """
+
+    def __init__(self, tools: Dict[str, Callable]) -> None:
+        self.specs = {name: ToolSpec(name, func) for name, func in tools.items()}
+        self.definitions = [spec.definition for spec in self.specs.values()]
+        self.calls = 0
+        self.repaired = 0
+        self.rejected = 0
+
+    def bind(self, tool_name: str, raw_arguments: Any) -> Dict[str, Any]:
+        """
+        Returns the checked and repaired arguments of a tool call; raises
+        ToolArgumentError for an unknown tool or arguments beyond repair.
+        """
+        self.calls += 1
+        spec = self.specs.get(tool_name)
+        if spec is None:
+            self.rejected += 1
+            raise ToolArgumentError(
+                f"unknown tool {tool_name}, the tools are {', '.join(self.specs)}"
+            )
+        try:
+            bound = spec.bind(raw_arguments)
+        except ToolArgumentError:
+            self.rejected += 1
+            raise
+        if spec.schemas and bound != parse_arguments(raw_arguments):
+            self.repaired += 1
+        return bound
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "calls": self.calls,
+            "repaired": self.repaired,
+            "rejected": self.rejected,
+        }
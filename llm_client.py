@@ -0,0 +1,363 @@
+"""
+The one place the chatbots call the LLM.
+
+All requests share a pool of keep-alive HTTP connections, so a question of
+several turns does not set up a new TLS connection for every turn. Every
+request gets connect and read timeouts, and transient failures (timeouts,
+dropped connections, rate limits, 5xx answers) are retried with
+exponential backoff and full jitter. A request that still fails raises
+LLMError, with the latencies and error counts per provider kept for
+/metrics.
+
+A request can also be hedged over an ordered list of models: when the
+first model has not answered within the hedge delay, or fails, the same
+request goes to the next model as well, and the first answer wins.
+"""
+import logging
+import queue
+import random
+import statistics
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from cancellation import CancellationToken, QueryCancelled
+from litellm_utils import get_litellm
+
+LOG = logging.getLogger("llm_client")
+
+# seconds to set up a connection, and to wait for the answer; local models
+# can take minutes for a long conversation
+CONNECT_TIMEOUT = 10.0
+READ_TIMEOUT = 300.0
+# retries after the first attempt of a request
+MAX_RETRIES = 3
+# the backoff before retry n is a random time up to
+# min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** n)
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 8.0
+# connections kept open, over all providers
+MAX_CONNECTIONS = 20
+MAX_KEEPALIVE_CONNECTIONS = 10
+KEEPALIVE_EXPIRY_SECONDS = 120.0
+# latencies kept per provider for the median in the metrics
+LATENCY_SAMPLES = 100
+# seconds to wait for a model before the next model gets the request too
+HEDGE_SECONDS = 15.0
+
+
+# the keep-alive pool of all LLMClients in the process: litellm has one
+# client_session, so the clients share it and the last one to close it
+# closes it
+_session: Optional[Any] = None
+_session_users = 0
+_session_lock = threading.Lock()
+
+
+def _acquire_session() -> None:
+    global _session, _session_users
+    with _session_lock:
+        if _session is None:
+            import httpx
+
+            _session = httpx.Client(
+                timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS,
+                    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS,
+                ),
+            )
+            get_litellm().client_session = _session
+        _session_users += 1
+
+
+def _release_session() -> None:
+    global _session, _session_users
+    with _session_lock:
+        _session_users -= 1
+        if _session_users == 0 and _session is not None:
+            if get_litellm().client_session is _session:
+                get_litellm().client_session = None
+            _session.close()
+            _session = None
+
+
+class LLMError(Exception):
+    """
+    The LLM could not be reached or refused the request, after retries.
+    """
+
+
+def _transient_errors() -> Tuple[type, ...]:
+    litellm = get_litellm()
+    import httpx
+
+    return (
+        litellm.exceptions.Timeout,
+        litellm.exceptions.APIConnectionError,
+        litellm.exceptions.RateLimitError,
+        litellm.exceptions.ServiceUnavailableError,
+        litellm.exceptions.InternalServerError,
+        litellm.exceptions.BadGatewayError,
+        httpx.TransportError,
+    )
+
+
+@lru_cache(maxsize=None)
+def provider_of(model: str) -> str:
+    """
+    Returns the litellm provider of a model name, such as "openai" or
+    "ollama".
+    """
+    try:
+        return get_litellm().get_llm_provider(model)[1]
+    except Exception:
+        return model.split("/", 1)[0] if "/" in model else "unknown"
+
+
+def backoff_seconds(retry: int) -> float:
+    """
+    Returns the time to wait before retry number `retry`, counted from 0.
+    """
+    return random.uniform(
+        0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2**retry)
+    )
+
+
+class ProviderMetrics:
+    """
+    Request counts and latencies of one provider.
+    """
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.failed = 0
+        self.retries = 0
+        self.errors: Dict[str, int] = {}
+        self.seconds = 0.0
+        self.latencies: deque = deque(maxlen=LATENCY_SAMPLES)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "failed": self.failed,
+            "retries": self.retries,
+            "errors": dict(self.errors),
+            "mean_seconds": round(self.seconds / len(self.latencies), 2)
+            if self.latencies
+            else 0.0,
+            "median_seconds": round(statistics.median(self.latencies), 2)
+            if self.latencies
+            else 0.0,
+        }
+
+
+class HedgeMetrics:
+    """
+    How often hedged requests needed the next model, and which model won.
+    Many hedges that the first model still wins mean the hedge delay is too
+    short; many wins of later models mean it could be shorter.
+    """
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.hedged = 0
+        self.failed = 0
+        self.wins: Dict[str, int] = {}
+
+    def record(self, launched: List[str], winner: Optional[str]) -> None:
+        self.requests += 1
+        if len(launched) > 1:
+            self.hedged += 1
+        if winner is None:
+            self.failed += 1
+        else:
+            self.wins[winner] = self.wins.get(winner, 0) + 1
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "failed": self.failed,
+            "win_rates": {
+                model: round(wins / self.requests, 3)
+                for model, wins in self.wins.items()
+            },
+        }
+
+
+class LLMClient:
+    """
+    Sends completion requests through litellm with a pooled HTTP client,
+    timeouts and retries.
+    """
+
+    def __init__(
+        self,
+        connect_timeout: float = CONNECT_TIMEOUT,
+        read_timeout: float = READ_TIMEOUT,
+        max_retries: int = MAX_RETRIES,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.sleep = sleep
+        self.metrics: Dict[str, ProviderMetrics] = {}
+        self.hedging = HedgeMetrics()
+        self._lock = threading.Lock()
+        self._uses_session = False
+
+    def _litellm(self) -> Any:
+        """
+        Returns litellm, set up on first use to send its requests through
+        the keep-alive connection pool of the process; httpx keeps the
+        connections per endpoint, so every provider gets its own.
+        """
+        with self._lock:
+            if not self._uses_session:
+                _acquire_session()
+                self._uses_session = True
+        return get_litellm()
+
+    def close(self) -> None:
+        """
+        Lets go of the connection pool; it is closed when no other client
+        of the process uses it.
+        """
+        with self._lock:
+            if self._uses_session:
+                self._uses_session = False
+                _release_session()
+
+    @property
+    def timeout(self) -> Any:
+        import httpx
+
+        return httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+
+    def _record(
+        self, provider: str, seconds: float, error: Optional[Exception], retry: bool
+    ) -> None:
+        with self._lock:
+            metrics = self.metrics.setdefault(provider, ProviderMetrics())
+            if error is None:
+                metrics.requests += 1
+                metrics.seconds += seconds
+                metrics.latencies.append(seconds)
+                return
+            name = type(error).__name__
+            metrics.errors[name] = metrics.errors.get(name, 0) + 1
+            if retry:
+                metrics.retries += 1
+            else:
+                metrics.requests += 1
+                metrics.failed += 1
+
+    def completion(
+        self, model: str, cancel: Optional[CancellationToken] = None, **kwargs: Any
+    ) -> Any:
+        """
+        Returns litellm.completion(model=model, **kwargs), retrying
+        transient errors. Raises LLMError when the request failed, and
+        QueryCancelled instead of retrying a cancelled question.
+        """
+        litellm = self._litellm()
+        transient = _transient_errors()
+        provider = provider_of(model)
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                response = litellm.completion(
+                    model=model, timeout=self.timeout, **kwargs
+                )
+            except transient as exc:
+                retry = attempt < self.max_retries
+                self._record(provider, time.perf_counter() - started, exc, retry)
+                if not retry:
+                    raise LLMError(f"{model}: {exc}") from exc
+                wait = backoff_seconds(attempt)
+                LOG.debug(f"{provider}: {exc!r}, retrying in {wait:.1f} s")
+                self.sleep(wait)
+                if cancel is not None:
+                    cancel.raise_if_cancelled()
+                attempt += 1
+            except Exception as exc:
+                # a bad request or key does not get better by retrying
+                self._record(provider, time.perf_counter() - started, exc, False)
+                raise LLMError(f"{model}: {exc}") from exc
+            else:
+                self._record(provider, time.perf_counter() - started, None, False)
+                return response
+
+    def hedged_completion(
+        self,
+        models: List[str],
+        hedge_seconds: float = HEDGE_SECONDS,
+        cancel: Optional[CancellationToken] = None,
+        **kwargs: Any,
+    ) -> Any:
+        """
+        Sends the request to models[0], and also to the next model whenever
+        no model answered within hedge_seconds or a model failed. Returns
+        the first answer; raises the last LLMError when all models failed.
+        No model gets the request after the question was cancelled.
+
+        The requests that lose keep running in the background until they
+        finish or time out, their answers are dropped: litellm cannot
+        cancel a request.
+        """
+        if len(models) == 1:
+            return self.completion(models[0], cancel, **kwargs)
+        results: queue.Queue = queue.Queue()
+
+        def run(model: str) -> None:
+            try:
+                results.put((model, self.completion(model, cancel, **kwargs), None))
+            except (LLMError, QueryCancelled) as exc:
+                results.put((model, None, exc))
+
+        pending = list(models)
+        launched: List[str] = []
+        running = 0
+        launch_next = True
+        while True:
+            if cancel is not None:
+                cancel.raise_if_cancelled()
+            if launch_next and pending:
+                model = pending.pop(0)
+                launched.append(model)
+                if len(launched) > 1:
+                    LOG.debug(f"Hedging the request with {model}")
+                threading.Thread(target=run, args=(model,), daemon=True).start()
+                running += 1
+                launch_next = False
+            try:
+                model, response, error = results.get(
+                    timeout=hedge_seconds if pending else None
+                )
+            except queue.Empty:
+                launch_next = True
+                continue
+            running -= 1
+            if error is None:
+                with self._lock:
+                    self.hedging.record(launched, model)
+                return response
+            LOG.debug(f"{model} failed: {error}")
+            launch_next = True
+            if not pending and not running:
+                with self._lock:
+                    self.hedging.record(launched, None)
+                raise error
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {
+                provider: metrics.summary()
+                for provider, metrics in self.metrics.items()
+            }
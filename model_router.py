@@ -0,0 +1,138 @@
+"""
+Routes every question to a model tier: a small, usually local, model for
+simple lookups and the main model for questions that need several steps.
+
+The classification is a cheap look at the words of the question, no model
+is involved. A simple question that the small model does not answer within
+its budget of turns is escalated to the main model, which continues from
+the tool results gathered so far.
+"""
+import re
+import statistics
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+SIMPLE = "simple"
+COMPLEX = "complex"
+TIERS = (SIMPLE, COMPLEX)
+
+# LLM turns the small model gets before the question is escalated
+SIMPLE_TIER_MAX_TURNS = 3
+# longer questions are rarely a single lookup
+MAX_SIMPLE_WORDS = 20
+# latencies kept per tier for the median in the metrics
+LATENCY_SAMPLES = 100
+
+# English and Dutch: "when was X born", "where did X die", "who is the
+# father of X", "wanneer is X geboren", ...
+SIMPLE_PATTERNS = [
+    re.compile(pattern, re.IGNORECASE)
+    for pattern in (
+        r"\b(when|where|wanneer|waar)\b.*\b(born|die|died|marry|married|buried"
+        r"|bapti[sz]ed|geboren|overleden|gestorven|getrouwd|begraven|gedoopt)\b",
+        r"\b(who|wie)\b.*\b(father|mother|parents|children|wife|husband|spouse"
+        r"|vader|moeder|ouders|kinderen|vrouw|man|echtgeno\w+)\b",
+        r"\b(how old|hoe oud)\b",
+    )
+]
+# relations that take more than one step, and questions about many people
+COMPLEX_PATTERN = re.compile(
+    r"\b(grand\w*|great|cousins?|uncles?|aunts?|nephews?|nieces?|siblings?"
+    r"|brothers?|sisters?|ancestors?|descendants?|related|relationship"
+    r"|generations?|how many|compare|common|most|average|why|explain|all|every"
+    r"|opa|oma|groot\w+|overgroot\w+|neef|nicht|oom|tante|broers?|zussen|zus"
+    r"|voorouders?|nakomelingen|verwant\w*|generaties?|hoeveel|vergelijk\w*"
+    r"|meeste|gemiddeld\w*|waarom|alle)\b",
+    re.IGNORECASE,
+)
+# a question naming more than one relation ("the mother of the father of")
+# needs more than one hop
+RELATION_PATTERN = re.compile(
+    r"\b(father|mother|parents?|child|children|son|daughter|wife|husband|spouse"
+    r"|vader|moeder|ouders?|kind|kinderen|zoon|dochter|vrouw|echtgeno\w+)\b",
+    re.IGNORECASE,
+)
+
+
+def classify(question: str) -> str:
+    """
+    Returns SIMPLE for a question that is most likely a single lookup,
+    COMPLEX otherwise.
+    """
+    if len(question.split()) > MAX_SIMPLE_WORDS:
+        return COMPLEX
+    if COMPLEX_PATTERN.search(question):
+        return COMPLEX
+    if len(RELATION_PATTERN.findall(question)) > 1:
+        return COMPLEX
+    if any(pattern.search(question) for pattern in SIMPLE_PATTERNS):
+        return SIMPLE
+    return COMPLEX
+
+
+class TierMetrics:
+    """
+    Counts and latencies of the questions answered by one tier.
+    """
+
+    def __init__(self) -> None:
+        self.questions = 0
+        self.answered = 0
+        self.escalated = 0
+        self.failed = 0
+        self.seconds = 0.0
+        self.latencies: deque = deque(maxlen=LATENCY_SAMPLES)
+
+    def record(self, seconds: float, outcome: str) -> None:
+        self.questions += 1
+        self.seconds += seconds
+        self.latencies.append(seconds)
+        setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "questions": self.questions,
+            "answered": self.answered,
+            "escalated": self.escalated,
+            "failed": self.failed,
+            "success_rate": round(self.answered / self.questions, 3)
+            if self.questions
+            else 0.0,
+            "mean_seconds": round(self.seconds / self.questions, 2)
+            if self.questions
+            else 0.0,
+            "median_seconds": round(statistics.median(self.latencies), 2)
+            if self.latencies
+            else 0.0,
+        }
+
+
+class ModelRouter:
+    """
+    Chooses the model for a question and keeps per-tier metrics.
+
+    Without a simple model configured every question goes to the main
+    model, as before.
+    """
+
+    def __init__(self, simple_model: Optional[str]) -> None:
+        self.simple_model = simple_model
+        self.metrics = {tier: TierMetrics() for tier in TIERS}
+
+    def route(self, question: str, main_model: str) -> Tuple[str, str]:
+        """
+        Returns (tier, model) for a question.
+        """
+        if self.simple_model and classify(question) == SIMPLE:
+            return SIMPLE, self.simple_model
+        return COMPLEX, main_model
+
+    def record(self, tier: str, seconds: float, outcome: str) -> None:
+        """
+        Records a question handled by a tier; outcome is "answered",
+        "escalated" or "failed".
+        """
+        self.metrics[tier].record(seconds, outcome)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {tier: metrics.summary() for tier, metrics in self.metrics.items()}
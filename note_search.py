@@ -0,0 +1,128 @@
+"""
+The text analysis of the search_notes tool: terms, snippets and the
+description of the results. The full-text index itself is the text_fts
+table of the sidecar (see sidecar_index).
+"""
+import logging
+import re
+from functools import lru_cache
+from typing import Any, Dict, Iterator, List, Tuple
+
+LOG = logging.getLogger("note_search")
+
+SNIPPET_WORDS = 30
+MAX_REFERENCES = 5
+
+# Our trees are mostly English and Dutch, so both get a stop list and a
+# light suffix stripper. This is not a full Porter/Snowball stemmer, it only
+# needs to make "sailor", "sailors" and "sailing" meet each other.
+STOPWORDS = frozenset(
+    """
+    a an and are as at be by for from has he her his in is it its of on or
+    she that the their they this to was were which with
+    de den der des die dat een en het in is met na naar op te van voor was
+    werd zijn
+    """.split()
+)
+SUFFIXES = (
+    "ingen", "heden", "ations", "ation", "ness", "ings", "heid", "ing",
+    "ers", "ies", "en", "es", "ed", "er", "s", "e",
+)
+MIN_STEM_LENGTH = 3
+
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+# (object type, method returning its handles, method returning its raw data)
+INDEXED_OBJECTS = (
+    ("Note", "iter_note_handles", "get_raw_note_data"),
+    ("Source", "iter_source_handles", "get_raw_source_data"),
+    ("Citation", "iter_citation_handles", "get_raw_citation_data"),
+)
+RAW_DATA_GETTERS = {object_type: getter for object_type, _, getter in INDEXED_OBJECTS}
+
+
+@lru_cache(maxsize=65536)
+def stem(word: str) -> str:
+    for suffix in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= MIN_STEM_LENGTH:
+            return word[: -len(suffix)]
+    return word
+
+
+def analyze(text: str) -> List[str]:
+    """
+    Splits text into lower case, stemmed terms without stop words.
+    """
+    return [
+        stem(word)
+        for word in WORD_PATTERN.findall(text.lower())
+        if word not in STOPWORDS
+    ]
+
+
+def object_text(db: Any, object_type: str, raw_data: Dict[str, Any]) -> str:
+    """
+    Returns the searchable text of a raw note, source or citation.
+    """
+    if object_type == "Note":
+        return (raw_data.get("text") or {}).get("string", "")
+    if object_type == "Source":
+        fields = ("title", "author", "pubinfo", "abbrev")
+        return "\n".join(raw_data.get(field) or "" for field in fields)
+    # a citation is found both on its page and on the title of its source
+    source_title = ""
+    if raw_data.get("source_handle"):
+        source_title = db.get_raw_source_data(raw_data["source_handle"]).get(
+            "title", ""
+        )
+    return f"{raw_data.get('page', '')}\n{source_title}"
+
+
+def make_snippet(text: str, terms: set, width: int = SNIPPET_WORDS) -> str:
+    """
+    Returns the window of `width` words of text that contains the most
+    query terms.
+    """
+    words = list(WORD_PATTERN.finditer(text))
+    if not words:
+        return ""
+    hits = [stem(word.group().lower()) in terms for word in words]
+    best_start, best_count, count = 0, -1, 0
+    for position, hit in enumerate(hits):
+        count += hit
+        if position >= width:
+            count -= hits[position - width]
+        if count > best_count:
+            best_count, best_start = count, max(0, position - width + 1)
+    best_end = min(len(words), best_start + width) - 1
+    snippet = text[words[best_start].start(): words[best_end].end()]
+    snippet = " ".join(snippet.split())
+    if best_start > 0:
+        snippet = "..." + snippet
+    if best_end < len(words) - 1:
+        snippet += "..."
+    return snippet
+
+
+def describe_results(
+    db: Any, hits: List[Tuple[str, str, float]], terms: set
+) -> Iterator[Dict[str, Any]]:
+    """
+    Describes every (handle, object type, score) hit of a search with a
+    snippet around the query terms and the objects that refer to it.
+    """
+    for handle, object_type, score in hits:
+        raw_data = getattr(db, RAW_DATA_GETTERS[object_type])(handle)
+        references = []
+        for class_name, ref_handle in db.find_backlink_handles(handle):
+            references.append({"type": class_name, "handle": ref_handle})
+            if len(references) >= MAX_REFERENCES:
+                break
+        yield {
+            "handle": handle,
+            "type": object_type,
+            "gramps_id": raw_data.get("gramps_id"),
+            "score": round(score, 3),
+            "snippet": make_snippet(object_text(db, object_type, raw_data), terms),
+            "referenced_by": references,
+        }
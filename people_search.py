@@ -0,0 +1,200 @@
+"""
+Ranked, paginated search of people by name.
+
+A common surname can match thousands of people; returning all of them
+floods the conversation. The matches are ranked (the whole name first,
+then surname, given name, other parts of the name and alternate names),
+only one page of them is returned, and the scan stops as soon as that page
+can only hold whole-name matches. The total is then extrapolated from the
+part of the tree that was scanned, so the LLM can decide to narrow the
+question; as later pages scan further, the estimate of each page differs.
+
+With the sidecar index the people without any of the words in a name are
+not read at all; the rest is ranked the same way.
+"""
+import heapq
+import logging
+import re
+from typing import (Any, Callable, Dict, Iterator, List, Optional, Pattern,
+                    Tuple)
+
+from cancellation import CancellationToken, checked
+
+LOG = logging.getLogger("people_search")
+
+# people returned per call, at most and by default
+MAX_PEOPLE_RESULTS = 50
+DEFAULT_PEOPLE_RESULTS = 20
+
+# ranks, best first
+FULL_NAME = "full_name"
+SURNAME = "surname"
+GIVEN_NAME = "given_name"
+OTHER_NAME = "other_name"
+ALTERNATE_NAME = "alternate_name"
+RANKS = (FULL_NAME, SURNAME, GIVEN_NAME, OTHER_NAME, ALTERNATE_NAME)
+
+SURNAME_FIELDS = ("surname", "prefix", "connector")
+GIVEN_NAME_FIELDS = ("first_name", "call")
+OTHER_NAME_FIELDS = ("nick", "famnick", "title", "suffix")
+
+
+def word_patterns(search_string: str) -> List[Pattern]:
+    """
+    Returns a case-insensitive pattern per word of the search string,
+    matching whole words only.
+    """
+    return [
+        re.compile(r"\b" + re.escape(word) + r"\b", re.IGNORECASE)
+        for word in search_string.split()
+    ]
+
+
+def _surname_parts(name: Dict[str, Any]) -> List[str]:
+    return [
+        surname.get(field) or ""
+        for surname in name.get("surname_list") or []
+        for field in SURNAME_FIELDS
+    ]
+
+
+def _matches(patterns: List[Pattern], parts: List[str]) -> List[bool]:
+    text = " ".join(part for part in parts if part)
+    return [bool(pattern.search(text)) for pattern in patterns]
+
+
+def _is_whole_name(patterns: List[Pattern], parts: List[str]) -> bool:
+    text = " ".join(part for part in parts if part)
+    return len(patterns) == 1 and bool(patterns[0].fullmatch(text))
+
+
+def match_rank(raw_person: Dict[str, Any], patterns: List[Pattern]) -> Optional[int]:
+    """
+    Returns the index in RANKS of the best way the person matches any of
+    the words, or None when no word matches. A whole-name match needs the
+    words to cover both a given name and a surname.
+    """
+    name = raw_person.get("primary_name") or {}
+    surname_parts = _surname_parts(name)
+    given_parts = [name.get(field) for field in GIVEN_NAME_FIELDS]
+    surnames = _matches(patterns, surname_parts)
+    given = _matches(patterns, given_parts)
+    if all(s or g for s, g in zip(surnames, given)) and (
+        # "Jansen" alone is a surname or a given name, not a whole name,
+        # unless it is all of the name
+        (any(surnames) and any(given))
+        or _is_whole_name(patterns, given_parts + surname_parts)
+    ):
+        return 0
+    if any(surnames):
+        return 1
+    if any(given):
+        return 2
+    if any(_matches(patterns, [name.get(field) for field in OTHER_NAME_FIELDS])):
+        return 3
+    for alternate in raw_person.get("alternate_names") or []:
+        parts = [alternate.get(field) for field in GIVEN_NAME_FIELDS]
+        parts += [alternate.get(field) for field in OTHER_NAME_FIELDS]
+        if any(_matches(patterns, parts + _surname_parts(alternate))):
+            return 4
+    return None
+
+
+def _summary(raw_person: Dict[str, Any], rank: int) -> Dict[str, Any]:
+    name = raw_person.get("primary_name") or {}
+    surname = (name.get("surname_list") or [{}])[0]
+    return {
+        "handle": raw_person.get("handle"),
+        "gramps_id": raw_person.get("gramps_id"),
+        "first_name": name.get("first_name"),
+        "surname": surname.get("surname"),
+        "prefix": surname.get("prefix"),
+        "match": RANKS[rank],
+    }
+
+
+def _all_people(db: Any) -> Iterator[Tuple[float, Dict[str, Any]]]:
+    """
+    Yields (part of the tree read, raw person) for every person.
+    """
+    people = max(db.get_number_of_people(), 1)
+    for number, handle in enumerate(db.iter_person_handles(), 1):
+        yield min(number / people, 1.0), db.get_raw_person_data(handle)
+
+
+def find_people(
+    db: Any,
+    search_string: str,
+    limit: int = DEFAULT_PEOPLE_RESULTS,
+    cursor: int = 0,
+    index: Optional[Any] = None,
+    cancel: Optional[CancellationToken] = None,
+) -> Dict[str, Any]:
+    """
+    Returns one page of the people matching any word of search_string,
+    best matches first: {"total_matches", "total_is_estimate",
+    "next_cursor", "people"}. next_cursor is the cursor of the next page,
+    or None on the last page. An estimated total is made for this page and
+    may differ on the next. `index` is the SidecarIndex of the tree, if
+    any. Raises QueryCancelled when `cancel` is cancelled during the scan.
+    """
+    limit = min(max(int(limit), 1), MAX_PEOPLE_RESULTS)
+    cursor = max(int(cursor), 0)
+    wanted = cursor + limit
+    patterns = word_patterns(search_string)
+    # the `wanted` best (rank, scan order) seen so far, as a max-heap
+    best: List[Tuple[int, int, Dict[str, Any]]] = []
+    counts = [0] * len(RANKS)
+    # the part of the tree scanned when the scan stopped early
+    scanned = 1.0
+    if index is not None and getattr(index, "available", True):
+        records = index.people_named(search_string)
+    else:
+        records = _all_people(db)
+    if patterns:
+        for order, (progress, raw_person) in enumerate(checked(records, cancel)):
+            rank = match_rank(raw_person, patterns)
+            if rank is None:
+                continue
+            counts[rank] += 1
+            entry = (-rank, -order, raw_person)
+            if len(best) < wanted:
+                heapq.heappush(best, entry)
+            elif entry[:2] > best[0][:2]:
+                heapq.heapreplace(best, entry)
+            if counts[0] >= wanted and progress < 1.0:
+                # nothing ranks above a whole-name match, the page is settled
+                scanned = progress
+                break
+    complete = scanned == 1.0
+    total = sum(counts)
+    if not complete:
+        total = max(total, round(total / scanned))
+        LOG.debug(f"Stopped after {scanned:.1%} of the people for {search_string!r}")
+    ranked = sorted(best, key=lambda entry: (-entry[0], -entry[1]))
+    results = [_summary(raw, -rank) for rank, _, raw in ranked[cursor:]]
+    more = not complete or total > wanted
+    return {
+        "total_matches": total,
+        "total_is_estimate": not complete,
+        "next_cursor": wanted if more else None,
+        "people": results,
+    }
+
+
+def resolve_person(find: Callable[..., Dict[str, Any]], name: str) -> Optional[str]:
+    """
+    Returns the handle of the one person whose whole name matches `name`,
+    or None when `name` is a single word (a surname alone is never unique
+    enough), or matches no one or more than one person. `find` is
+    find_people() bound to a tree, or the find_people_by_name tool.
+    """
+    if len(name.split()) < 2:
+        return None
+    # whole-name matches come first: unless the page is all whole-name
+    # matches, every one of them is on it
+    found = find(name, limit=MAX_PEOPLE_RESULTS)
+    handles = {
+        match["handle"] for match in found["people"] if match["match"] == FULL_NAME
+    }
+    return handles.pop() if len(handles) == 1 else None
@@ -0,0 +1,215 @@
+"""
+Speculative prefetch of the tool results the LLM is likely to ask for next.
+
+After the LLM looks up a person, its next tool calls are very predictable:
+the parents, children, families and birth and death of that person. The
+NeighborhoodPrefetcher queues those calls and runs them while the chat
+waits for the LLM, on the thread that owns the database, so that the
+follow-up tool calls are answered from the ToolResultCache.
+"""
+import logging
+import threading
+from collections import deque
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from cancellation import CancellationToken, QueryCancelled
+from tool_cache import CacheEntry, ToolResultCache, tool_cache_key
+
+LOG = logging.getLogger("prefetch")
+
+# seconds between checks of the cancellation token while waiting
+CANCEL_POLL_SECONDS = 0.02
+
+# persons taken from one tool result, e.g. a long find_people_by_name list
+MAX_PEOPLE_PER_RESULT = 10
+# persons waiting for their neighborhood to be prefetched; older ones are
+# dropped first, the LLM is most likely to continue with the latest ones
+MAX_PENDING_PEOPLE = 50
+
+ToolCall = Tuple[str, Dict[str, Any]]
+
+# the tools taking a person handle, in the order the LLM tends to need them
+PERSON_TOOLS = (
+    "get_father_of_person",
+    "get_mother_of_person",
+    "get_children_of_person",
+    "get_child_in_families",
+    "get_person_birth_date",
+    "get_person_birth_place",
+    "get_person_death_date",
+    "get_person_death_place",
+    "get_person_event_list",
+    "get_person",
+)
+
+
+def person_handles(tool_result: Any) -> List[str]:
+    """
+    Returns the handles of the persons in a tool result: raw person data,
+    find_people_by_name matches and event participants.
+    """
+    found: List[str] = []
+
+    def walk(value: Any) -> None:
+        if len(found) >= MAX_PEOPLE_PER_RESULT:
+            return
+        if isinstance(value, dict):
+            handle = value.get("handle")
+            is_person = (
+                "primary_name" in value
+                or "first_name" in value
+                or value.get("type") == "Person"
+            )
+            if is_person and isinstance(handle, str) and handle not in found:
+                found.append(handle)
+            for item in value.values():
+                if isinstance(item, (dict, list, tuple)):
+                    walk(item)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                walk(item)
+
+    walk(tool_result)
+    return found[:MAX_PEOPLE_PER_RESULT]
+
+
+def person_neighborhood(db: Any, person_handle: str) -> List[ToolCall]:
+    """
+    Returns the tool calls that describe the one-hop neighborhood of a
+    person: parents, children, families and birth and death events.
+    """
+    raw_person = db.get_raw_person_data(person_handle)
+    if not raw_person:
+        return []
+    calls = [(tool, {"person_handle": person_handle}) for tool in PERSON_TOOLS]
+    for family_handle in (raw_person.get("family_list") or []) + (
+        raw_person.get("parent_family_list") or []
+    ):
+        calls.append(("get_family", {"family_handle": family_handle}))
+    refs = raw_person.get("event_ref_list") or []
+    for ref_key in ("birth_ref_index", "death_ref_index"):
+        ref_index = raw_person.get(ref_key, -1)
+        if 0 <= ref_index < len(refs):
+            event_handle = refs[ref_index]["ref"]
+            calls.append(("get_event", {"event_handle": event_handle}))
+            calls.append(("get_event_place", {"event_handle": event_handle}))
+    return calls
+
+
+class NeighborhoodPrefetcher:
+    """
+    Queue of persons whose neighborhood should be prefetched into the tool
+    cache.
+
+    All database access happens in run_while(), on the thread that calls
+    it, so the prefetcher can be used with database backends that must be
+    used from a single thread. Work is done one tool call at a time and
+    stops as soon as the caller's own work is done, when cancel() is
+    called, or when the cache is full: prefetched results never push out
+    results the LLM asked for.
+    """
+
+    def __init__(
+        self,
+        cache: ToolResultCache,
+        compute: Callable[[str, Dict[str, Any]], CacheEntry],
+        neighborhood: Callable[[str], List[ToolCall]],
+    ) -> None:
+        self.cache = cache
+        self.compute = compute
+        self.neighborhood = neighborhood
+        self.people: deque = deque(maxlen=MAX_PENDING_PEOPLE)
+        self.calls: deque = deque()
+        self.expanded: set = set()
+        self.prefetched = 0
+
+    def schedule_people(self, handles: List[str]) -> None:
+        for handle in handles:
+            if handle not in self.expanded and handle not in self.people:
+                self.people.append(handle)
+
+    def pending(self) -> bool:
+        return bool(self.calls or self.people)
+
+    def cancel(self) -> None:
+        """
+        Drops all queued work; a tool call that is running finishes first.
+        """
+        self.people.clear()
+        self.calls.clear()
+
+    def reset(self) -> None:
+        """
+        Forgets which persons were prefetched, e.g. after the cache was
+        cleared because the database changed.
+        """
+        self.cancel()
+        self.expanded.clear()
+
+    def iter_steps(self) -> Iterator[None]:
+        """
+        Does the queued work one tool call per step.
+        """
+        while self.pending() and self.cache.has_room():
+            try:
+                next_call = self.calls.popleft() if self.calls else None
+                handle = None if next_call else self.people.popleft()
+            except IndexError:
+                # cancel() was called from another thread
+                return
+            if next_call:
+                tool_name, arguments = next_call
+                key = tool_cache_key(tool_name, arguments)
+                if key in self.cache:
+                    continue
+                try:
+                    entry = self.compute(tool_name, arguments)
+                except Exception as exc:
+                    # e.g. a person without a father; the LLM gets the
+                    # error when it makes the call itself
+                    LOG.debug(f"Prefetch of {tool_name} failed: {exc}")
+                else:
+                    self.cache.put(key, entry, prefetched=True)
+                    self.prefetched += 1
+            else:
+                self.expanded.add(handle)
+                try:
+                    self.calls.extend(self.neighborhood(handle))
+                except Exception as exc:
+                    LOG.debug(f"Prefetch of person {handle} failed: {exc}")
+            yield
+
+    def run_while(
+        self, func: Callable[[], Any], cancel: Optional[CancellationToken] = None
+    ) -> Any:
+        """
+        Calls func() on a helper thread, e.g. to wait for the LLM, and
+        prefetches on this thread until it returns. Returns what func()
+        returns, or raises what it raised.
+
+        Raises QueryCancelled as soon as `cancel` is cancelled; func() then
+        finishes on the helper thread and its result is dropped.
+        """
+        if not self.pending() and cancel is None:
+            return func()
+        outcome: Dict[str, Any] = {}
+
+        def call() -> None:
+            try:
+                outcome["result"] = func()
+            except BaseException as exc:
+                outcome["error"] = exc
+
+        helper = threading.Thread(target=call, name="PrefetchWait", daemon=True)
+        helper.start()
+        for _ in self.iter_steps():
+            if not helper.is_alive() or (cancel is not None and cancel.cancelled):
+                break
+        while helper.is_alive():
+            if cancel is not None and cancel.cancelled:
+                raise QueryCancelled()
+            helper.join(CANCEL_POLL_SECONDS)
+        LOG.debug(f"Prefetched {self.prefetched} tool results: {self.cache.stats()}")
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome.get("result")
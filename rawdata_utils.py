@@ -0,0 +1,149 @@
+import logging
+import os
+from typing import Any, Dict, Optional, Tuple
+
+from gramps.gen.datehandler import get_date
+from gramps.gen.display.place import displayer as place_displayer
+from gramps.gen.lib import Date, EventType
+
+LOG = logging.getLogger("rawdata_utils")
+
+# Folder next to the Gramps database files where the chatbot keeps the
+# indexes it derives from the tree.
+CACHE_DIR_NAME = "chatbot"
+
+# How many years an "about", "before" or "after" date is allowed to stray
+# from the year that was actually recorded. Gramps itself uses 50 years for
+# its date matching, which is far too wide for questions like "who was born
+# between 1850 and 1870".
+ABOUT_YEARS = 5
+BEFORE_AFTER_YEARS = 10
+
+
+def event_type_name(raw_type: Dict[str, Any]) -> str:
+    """
+    Returns the untranslated name of a raw EventType, e.g. "Birth".
+    Custom event types return their custom string.
+    """
+    return EventType(raw_type).xml_str()
+
+
+def date_year_span(
+    raw_date: Optional[Dict[str, Any]],
+) -> Optional[Tuple[int, int, bool]]:
+    """
+    Converts a raw Gramps date into the span of years it may refer to.
+
+    Returns a tuple (first_year, last_year, approximate) or None when the
+    date carries no usable year (empty dates, text-only dates, or dates
+    with only a day and month).
+    """
+    if not raw_date or not raw_date.get("sortval"):
+        return None
+    modifier = raw_date.get("modifier", Date.MOD_NONE)
+    if modifier == Date.MOD_TEXTONLY:
+        return None
+    dateval = raw_date.get("dateval") or ()
+    if len(dateval) < 3 or not dateval[2]:
+        return None
+    year = dateval[2]
+    approximate = raw_date.get("quality", Date.QUAL_NONE) != Date.QUAL_NONE
+
+    if modifier in (Date.MOD_RANGE, Date.MOD_SPAN):
+        last_year = dateval[6] if len(dateval) >= 7 and dateval[6] else year
+        return (min(year, last_year), max(year, last_year), True)
+    if modifier == Date.MOD_ABOUT:
+        return (year - ABOUT_YEARS, year + ABOUT_YEARS, True)
+    if modifier in (Date.MOD_BEFORE, Date.MOD_TO):
+        return (year - BEFORE_AFTER_YEARS, year, True)
+    if modifier in (Date.MOD_AFTER, Date.MOD_FROM):
+        return (year, year + BEFORE_AFTER_YEARS, True)
+    if approximate:
+        # estimated or calculated: as vague as "about"
+        return (year - ABOUT_YEARS, year + ABOUT_YEARS, True)
+    return (year, year, False)
+
+
+def person_name(raw_person: Dict[str, Any]) -> str:
+    """
+    Returns "first_name surname" for a raw person, including surname
+    prefixes such as "van" or "de".
+    """
+    primary_name = raw_person.get("primary_name") or {}
+    parts = [primary_name.get("first_name", "")]
+    for surname in primary_name.get("surname_list") or []:
+        parts.append(surname.get("prefix", ""))
+        parts.append(surname.get("surname", ""))
+    return " ".join(part for part in parts if part)
+
+
+def primary_surname(raw_person: Dict[str, Any]) -> str:
+    """
+    Returns the primary surname of a raw person, with its prefix.
+    """
+    surnames = (raw_person.get("primary_name") or {}).get("surname_list") or []
+    for surname in surnames:
+        if surname.get("primary"):
+            break
+    else:
+        surname = surnames[0] if surnames else {}
+    return " ".join(
+        part for part in (surname.get("prefix"), surname.get("surname")) if part
+    )
+
+
+def family_name(db: Any, raw_family: Dict[str, Any]) -> str:
+    """
+    Returns "father and mother" for a raw family, leaving out unknown parents.
+    """
+    names = [
+        person_name(db.get_raw_person_data(raw_family[parent]))
+        for parent in ("father_handle", "mother_handle")
+        if raw_family.get(parent)
+    ]
+    return " and ".join(names)
+
+
+def event_summary(db: Any, event_handle: str) -> Dict[str, Any]:
+    """
+    Returns a compact, human readable description of an event: its type,
+    displayed date and place, and the people or families it belongs to.
+    """
+    raw_event = db.get_raw_event_data(event_handle)
+    event = db.get_event_from_handle(event_handle)
+    participants = []
+    for class_name, handle in db.find_backlink_handles(
+        event_handle, ["Person", "Family"]
+    ):
+        if class_name == "Person":
+            name = person_name(db.get_raw_person_data(handle))
+        else:
+            name = family_name(db, db.get_raw_family_data(handle))
+        participants.append({"type": class_name, "handle": handle, "name": name})
+    return {
+        "handle": event_handle,
+        "gramps_id": raw_event.get("gramps_id"),
+        "type": event_type_name(raw_event["type"]),
+        "date": get_date(event),
+        "place": place_displayer.display_event(db, event),
+        "description": raw_event.get("description", ""),
+        "participants": participants,
+    }
+
+
+def chatbot_cache_dir(db: Any) -> Optional[str]:
+    """
+    Returns the folder in which the chatbot may store files derived from
+    this database, or None when the database has no folder on disk we can
+    write to.
+    """
+    save_path = db.get_save_path()
+    if not save_path or not os.path.isdir(save_path):
+        return None
+    path = os.path.join(save_path, CACHE_DIR_NAME)
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError as exc:
+        LOG.warning(f"Unable to create chatbot cache folder {path}: {exc}")
+        return None
+    return path
@@ -0,0 +1,408 @@
+"""
+Tree-wide scans of raw records over several processes.
+
+Some questions can only be answered by looking at every person or event,
+e.g. a filter on a name part or an attribute no index knows about. Instead
+of building Person objects one by one on one core, the table is split into
+handle ranges (shards) and every shard is read by a process of a pool,
+straight from the SQLite file of the tree with its own read-only
+connection. The function evaluated on every record returns None to skip it
+or the value to return, so only the matches travel back. Results are
+yielded as soon as their shard is done.
+
+The function must be picklable: a function at the top level of a module,
+or an instance of a class like NameFilter below. The workers are spawned,
+so a script using the engine needs the usual `if __name__ == "__main__":`
+guard.
+
+A single worker reads the file in this process, and trees that are not
+stored in SQLite are read through the database API.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import time
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional,
+                    Tuple)
+
+from gramps.gen.lib import AttributeType
+
+from cancellation import CancellationToken
+from people_search import RANKS, match_rank, word_patterns
+from rawdata_utils import person_name
+
+LOG = logging.getLogger("scan_engine")
+
+SQLITE_FILE_NAME = "sqlite.db"
+# the tables that can be scanned, with the raw getter of the database API
+TABLES = {
+    "person": "get_raw_person_data",
+    "family": "get_raw_family_data",
+    "event": "get_raw_event_data",
+    "place": "get_raw_place_data",
+    "source": "get_raw_source_data",
+    "citation": "get_raw_citation_data",
+    "repository": "get_raw_repository_data",
+    "media": "get_raw_media_data",
+    "note": "get_raw_note_data",
+}
+# shards per worker: more shards stream results sooner and balance uneven
+# shards, fewer shards cost less overhead
+SHARDS_PER_WORKER = 4
+# records read from SQLite at a time
+FETCH_ROWS = 2000
+# processes are started fresh; forking a program with GUI and network
+# threads is not safe
+START_METHOD = "spawn"
+
+Shard = Tuple[Optional[str], Optional[str]]
+RecordFunction = Callable[[Dict[str, Any]], Any]
+
+# the read-only connection of a worker process
+_connection: Optional[sqlite3.Connection] = None
+
+
+def sqlite_path(db: Any) -> Optional[str]:
+    """
+    Returns the SQLite file of an open tree, or None for other backends.
+    """
+    try:
+        path = os.path.join(db.get_save_path(), SQLITE_FILE_NAME)
+    except (AttributeError, TypeError):
+        return None
+    return path if os.path.isfile(path) else None
+
+
+def latest_change(db: Any, tables: Iterable[str]) -> int:
+    """
+    Returns the latest change stamp of the records of the given tables,
+    0 for empty tables; tells whether something built from them is stale.
+    """
+    latest = 0
+    path = sqlite_path(db)
+    if path is not None:
+        connection = _connect(path)
+        try:
+            for table in tables:
+                (change,) = connection.execute(
+                    f"SELECT max(change) FROM {table}"
+                ).fetchone()
+                latest = max(latest, change or 0)
+        finally:
+            connection.close()
+        return latest
+    for table in tables:
+        get_raw = getattr(db, TABLES[table])
+        for handle in getattr(db, f"iter_{table}_handles")():
+            latest = max(latest, get_raw(handle).get("change", 0))
+    return latest
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+
+
+def _init_worker(path: str) -> None:
+    global _connection
+    _connection = _connect(path)
+
+
+def _shard_batches(
+    connection: sqlite3.Connection, table: str, shard: Shard
+) -> Iterator[List[Tuple[str]]]:
+    """
+    Yields the JSON of the records of a shard, FETCH_ROWS rows at a time.
+    """
+    low, high = shard
+    query = f"SELECT json_data FROM {table}"
+    conditions = []
+    params = []
+    if low is not None:
+        conditions.append("handle >= ?")
+        params.append(low)
+    if high is not None:
+        conditions.append("handle < ?")
+        params.append(high)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    cursor = connection.execute(query, params)
+    while True:
+        batch = cursor.fetchmany(FETCH_ROWS)
+        if not batch:
+            return
+        yield batch
+
+
+def _scan_shard(
+    table: str, shard: Shard, func: RecordFunction
+) -> Tuple[List[Any], int]:
+    """
+    Returns the values of func for the records of a shard, and the number
+    of records read; runs in a worker.
+    """
+    found = []
+    rows = 0
+    for batch in _shard_batches(_connection, table, shard):
+        rows += len(batch)
+        for (json_data,) in batch:
+            value = func(json.loads(json_data))
+            if value is not None:
+                found.append(value)
+    return found, rows
+
+
+def shards(connection: sqlite3.Connection, table: str, count: int) -> List[Shard]:
+    """
+    Splits a table into `count` handle ranges of about the same number of
+    records, using the primary key index.
+    """
+    rows = connection.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+    count = max(1, min(count, rows))
+    bounds: List[Optional[str]] = [None]
+    for number in range(1, count):
+        row = connection.execute(
+            f"SELECT handle FROM {table} ORDER BY handle LIMIT 1 OFFSET ?",
+            (rows * number // count,),
+        ).fetchone()
+        if row and row[0] != bounds[-1]:
+            bounds.append(row[0])
+    bounds.append(None)
+    return list(zip(bounds, bounds[1:]))
+
+
+class ScanEngine:
+    """
+    Scans the tables of one tree. The worker processes are started on the
+    first scan and kept until close().
+    """
+
+    def __init__(self, db: Any, workers: Optional[int] = None) -> None:
+        self.db = db
+        self.path = sqlite_path(db)
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self._pool: Optional[Any] = None
+        self.scans = 0
+        self.records = 0
+        self.seconds = 0.0
+
+    def _get_pool(self) -> Any:
+        if self._pool is None:
+            context = multiprocessing.get_context(START_METHOD)
+            self._pool = context.Pool(
+                self.workers, initializer=_init_worker, initargs=(self.path,)
+            )
+        return self._pool
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self) -> "ScanEngine":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def scan(
+        self,
+        table: str,
+        func: RecordFunction,
+        cancel: Optional[CancellationToken] = None,
+    ) -> Iterator[Any]:
+        """
+        Yields func(raw record) for every record of the table for which it
+        is not None, in no particular order. A cancelled scan stops its
+        workers and raises QueryCancelled.
+        """
+        if table not in TABLES:
+            raise ValueError(f"Unknown table {table!r}, use one of {sorted(TABLES)}")
+        started = time.perf_counter()
+        self.scans += 1
+        try:
+            if self.path is None:
+                yield from self._scan_api(table, func, cancel)
+            elif self.workers == 1:
+                yield from self._scan_file(table, func, cancel)
+            else:
+                yield from self._scan_pool(table, func, cancel)
+        finally:
+            self.seconds += time.perf_counter() - started
+
+    def _scan_api(
+        self,
+        table: str,
+        func: RecordFunction,
+        cancel: Optional[CancellationToken],
+    ) -> Iterator[Any]:
+        get_raw = getattr(self.db, TABLES[table])
+        handles = getattr(self.db, f"iter_{table}_handles")()
+        for number, handle in enumerate(handles):
+            if cancel is not None and number % FETCH_ROWS == 0:
+                cancel.raise_if_cancelled()
+            self.records += 1
+            value = func(get_raw(handle))
+            if value is not None:
+                yield value
+
+    def _scan_file(
+        self,
+        table: str,
+        func: RecordFunction,
+        cancel: Optional[CancellationToken],
+    ) -> Iterator[Any]:
+        connection = _connect(self.path)
+        try:
+            for batch in _shard_batches(connection, table, (None, None)):
+                if cancel is not None:
+                    cancel.raise_if_cancelled()
+                self.records += len(batch)
+                for (json_data,) in batch:
+                    value = func(json.loads(json_data))
+                    if value is not None:
+                        yield value
+        finally:
+            connection.close()
+
+    def _scan_pool(
+        self,
+        table: str,
+        func: RecordFunction,
+        cancel: Optional[CancellationToken],
+    ) -> Iterator[Any]:
+        connection = _connect(self.path)
+        try:
+            parts = shards(connection, table, self.workers * SHARDS_PER_WORKER)
+        finally:
+            connection.close()
+        pool = self._get_pool()
+        pending = [
+            pool.apply_async(_scan_shard, (table, shard, func)) for shard in parts
+        ]
+        LOG.debug(f"Scanning {table} in {len(parts)} shards on {self.workers} workers")
+        try:
+            while pending:
+                if cancel is not None:
+                    cancel.raise_if_cancelled()
+                ready = [result for result in pending if result.ready()]
+                if not ready:
+                    pending[0].wait(0.02)
+                    continue
+                for result in ready:
+                    pending.remove(result)
+                    found, rows = result.get()
+                    self.records += rows
+                    yield from found
+        finally:
+            if pending:
+                # the scan was cancelled or abandoned: stop the busy workers
+                self.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "sqlite": self.path is not None,
+            "scans": self.scans,
+            "records": self.records,
+            "records_per_second": round(self.records / self.seconds)
+            if self.seconds
+            else 0,
+        }
+
+
+class NameFilter:
+    """
+    Matches raw persons with any word of a search string in a name, like
+    find_people_by_name; returns (rank, handle, gramps_id).
+    """
+
+    def __init__(self, search_string: str) -> None:
+        self.search_string = search_string
+        self.patterns = word_patterns(search_string)
+
+    def __call__(self, raw_person: Dict[str, Any]) -> Optional[Tuple]:
+        rank = match_rank(raw_person, self.patterns)
+        if rank is None:
+            return None
+        return (RANKS[rank], raw_person["handle"], raw_person.get("gramps_id"))
+
+
+class AttributeFilter:
+    """
+    Matches raw records with an attribute whose value contains `text`
+    (ignoring case), of one attribute type (its raw value, a custom type
+    by its name) or of any type; returns (handle, gramps_id, value).
+    """
+
+    def __init__(self, text: str, attribute_type: Any = None) -> None:
+        self.text = text.lower()
+        self.attribute_type = attribute_type
+
+    def __call__(self, raw: Dict[str, Any]) -> Optional[Tuple]:
+        for attribute in raw.get("attribute_list") or []:
+            kind = attribute.get("type") or {}
+            if self.attribute_type is not None and self.attribute_type not in (
+                kind.get("value"),
+                kind.get("string"),
+            ):
+                continue
+            value = attribute.get("value") or ""
+            if self.text in value.lower():
+                return (raw["handle"], raw.get("gramps_id"), value)
+        return None
+
+
+def attribute_type_value(name: str) -> Any:
+    """
+    Returns what AttributeFilter matches for an attribute type name like
+    "occupation": the raw value of a standard type, or the name of a
+    custom type.
+    """
+    attribute_type = AttributeType()
+    attribute_type.set_from_xml_str(name.strip().title())
+    if attribute_type.value == AttributeType.CUSTOM:
+        return name.strip()
+    return attribute_type.value
+
+
+def people_with_attribute(
+    engine: ScanEngine,
+    text: str,
+    attribute_type: str = "",
+    limit: int = 20,
+    cancel: Optional[CancellationToken] = None,
+) -> Dict[str, Any]:
+    """
+    Returns the people with an attribute containing `text`, of the given
+    type or any: {"total_matches", "people"}, at most `limit` of them in
+    Gramps ID order, each with handle, gramps_id, name and the value.
+    Raises QueryCancelled when `cancel` is cancelled during the scan.
+    """
+    if not text.strip() and not attribute_type.strip():
+        raise ValueError("give the text or the type of the attribute")
+    matches = sorted(
+        engine.scan(
+            "person",
+            AttributeFilter(
+                text.strip(),
+                attribute_type_value(attribute_type) if attribute_type.strip() else None,
+            ),
+            cancel,
+        ),
+        key=lambda match: (match[1] or "", match[0]),
+    )
+    return {
+        "total_matches": len(matches),
+        "people": [
+            {
+                "handle": handle,
+                "gramps_id": gramps_id,
+                "name": person_name(engine.db.get_raw_person_data(handle)),
+                "value": value,
+            }
+            for handle, gramps_id, value in matches[:limit]
+        ],
+    }
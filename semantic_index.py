@@ -0,0 +1,391 @@
+"""
+Retrieval of persons by the meaning of a question instead of their name.
+
+Every person gets a short text profile: names, events with year, place and
+description, attributes such as occupations, and notes. The profiles are
+turned into vectors with a hashing vectorizer over the stemmed terms of
+note_search.analyze() (no model to download, CPU only), weighted with
+tf-idf, and stored in a memory-mapped matrix. Search uses an inverted file
+(IVF) index: the vectors are clustered with k-means and a query only
+scores the vectors of the clusters closest to it.
+"""
+import json
+import logging
+import math
+import os
+import shutil
+import time
+import zlib
+from collections import Counter
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from cancellation import CancellationToken, checked
+from note_search import analyze
+from rawdata_utils import date_year_span, event_type_name, person_name
+from scan_engine import latest_change
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+LOG = logging.getLogger("semantic_index")
+
+INDEX_VERSION = 1
+INDEX_DIR_NAME = "semantic"
+MANIFEST_FILE_NAME = "manifest.json"
+
+# size of the hashed vectors; stored as float16, 512 bytes per person
+DIMENSIONS = 256
+# below this many persons every vector is scored, no clustering needed
+MIN_CLUSTERED = 2000
+KMEANS_ITERATIONS = 8
+# vectors used to train the clusters, per cluster
+KMEANS_SAMPLE_PER_CLUSTER = 20
+# share of the clusters searched per query, and the minimum; on 100k
+# synthetic profiles 10% of the clusters finds ~77% of the exact top 10
+PROBE_FRACTION = 0.1
+MIN_PROBES = 8
+# rows scored at once when assigning vectors to clusters
+CHUNK_ROWS = 8192
+
+PROFILE_CHARACTERS = 300
+# the tables a profile is made of, see person_profile()
+PROFILE_TABLES = ("person", "event", "place", "note")
+GENDER_WORDS = {0: "female woman", 1: "male man"}
+
+
+def _hash_term(term: str) -> Tuple[int, float]:
+    """
+    Returns the dimension and sign of a term; the sign keeps collisions of
+    different terms from adding up.
+    """
+    hashed = zlib.crc32(term.encode("utf-8"))
+    return hashed % DIMENSIONS, 1.0 if hashed & 0x80000000 else -1.0
+
+
+def term_vector(text: str) -> Tuple[Any, Any]:
+    """
+    Returns the (dimensions, weights) of the hashed, sublinear term
+    frequencies of a text, without idf.
+    """
+    weights: Dict[int, float] = {}
+    for term, count in Counter(analyze(text)).items():
+        dimension, sign = _hash_term(term)
+        weights[dimension] = weights.get(dimension, 0.0) + sign * (
+            1.0 + math.log(count)
+        )
+    return (
+        np.fromiter(weights.keys(), dtype=np.int32, count=len(weights)),
+        np.fromiter(weights.values(), dtype=np.float32, count=len(weights)),
+    )
+
+
+def _normalize(matrix: Any) -> Any:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def person_profile(
+    db: Any, raw_person: Dict[str, Any], place_names: Dict[str, str]
+) -> str:
+    """
+    Returns the text profile of a raw person. place_names caches the names
+    of the places seen so far.
+    """
+    lines = [person_name(raw_person)]
+    for name in raw_person.get("alternate_names") or []:
+        lines.append(person_name({"primary_name": name}))
+    lines.append(GENDER_WORDS.get(raw_person.get("gender"), ""))
+    for event_ref in raw_person.get("event_ref_list") or []:
+        raw_event = db.get_raw_event_data(event_ref["ref"])
+        parts = [event_type_name(raw_event["type"])]
+        span = date_year_span(raw_event.get("date"))
+        if span:
+            parts.append(str((span[0] + span[1]) // 2))
+        place_handle = raw_event.get("place")
+        if place_handle:
+            if place_handle not in place_names:
+                raw_place = db.get_raw_place_data(place_handle)
+                place_names[place_handle] = (raw_place.get("name") or {}).get(
+                    "value", ""
+                )
+            parts.append(place_names[place_handle])
+        parts.append(raw_event.get("description", ""))
+        lines.append(" ".join(part for part in parts if part))
+    for attribute in raw_person.get("attribute_list") or []:
+        lines.append(attribute.get("value", ""))
+    for note_handle in raw_person.get("note_list") or []:
+        raw_note = db.get_raw_note_data(note_handle)
+        lines.append((raw_note.get("text") or {}).get("string", ""))
+    return "\n".join(line for line in lines if line)
+
+
+def iter_profiles(
+    db: Any, cancel: Optional[CancellationToken] = None
+) -> Iterator[Tuple[str, str]]:
+    place_names: Dict[str, str] = {}
+    for handle in checked(db.iter_person_handles(), cancel):
+        yield handle, person_profile(db, db.get_raw_person_data(handle), place_names)
+
+
+def tree_fingerprint(db: Any) -> str:
+    """
+    Changes when persons are added or removed, or when they or the events,
+    places and notes of their profiles are edited, so a stored index can be
+    checked before it is used.
+    """
+    latest = latest_change(db, PROFILE_TABLES)
+    return f"{db.get_number_of_people()}:{latest}"
+
+
+class SemanticIndex:
+    """
+    Vectors of all person profiles with an IVF index, kept in a folder.
+
+    The vectors are sorted by cluster, so the vectors of a cluster are one
+    contiguous slice of the memory-mapped matrix.
+    """
+
+    def __init__(self, folder: Optional[str] = None) -> None:
+        if np is None:
+            raise Exception("the semantic_search tool requires numpy")
+        self.folder = folder
+        self.manifest: Dict[str, Any] = {}
+        self.vectors = None
+        self.handles = None
+        self.idf = None
+        self.centroids = None
+        self.offsets = None
+        # handle -> vector of a person edited since the index was built, or
+        # None when deleted; scored on every search
+        self.changed: Dict[str, Any] = {}
+
+    @property
+    def size(self) -> int:
+        return 0 if self.handles is None else len(self.handles)
+
+    def build(
+        self,
+        items: Iterable[Tuple[str, str]],
+        fingerprint: str = "",
+    ) -> "SemanticIndex":
+        """
+        Builds the index from (handle, profile text) pairs.
+        """
+        started = time.perf_counter()
+        handles, sparse = [], []
+        document_frequency = np.zeros(DIMENSIONS, dtype=np.float64)
+        for handle, profile in items:
+            dimensions, weights = term_vector(profile)
+            document_frequency[dimensions] += 1
+            handles.append(handle)
+            sparse.append((dimensions, weights))
+        count = len(handles)
+        idf = np.log((1 + count) / (1 + document_frequency)).astype(np.float32) + 1
+        vectors = np.zeros((count, DIMENSIONS), dtype=np.float32)
+        for row, (dimensions, weights) in enumerate(sparse):
+            vectors[row, dimensions] = weights * idf[dimensions]
+        vectors = _normalize(vectors)
+
+        centroids, assignments = self._cluster(vectors)
+        order = np.argsort(assignments, kind="stable")
+        offsets = np.searchsorted(
+            assignments[order], np.arange(len(centroids) + 1)
+        ).astype(np.int64)
+        self.vectors = vectors[order].astype(np.float16)
+        self.handles = np.array(handles, dtype=str)[order]
+        self.idf = idf
+        self.centroids = centroids
+        self.offsets = offsets
+        self.manifest = {
+            "version": INDEX_VERSION,
+            "dimensions": DIMENSIONS,
+            "count": count,
+            "clusters": len(centroids),
+            "fingerprint": fingerprint,
+        }
+        LOG.info(
+            f"Built semantic index of {count} persons in {len(centroids)} clusters "
+            f"in {time.perf_counter() - started:.1f}s"
+        )
+        return self
+
+    def _cluster(self, vectors: Any) -> Tuple[Any, Any]:
+        """
+        Spherical k-means on a sample; returns the centroids and the
+        cluster of every vector.
+        """
+        count = len(vectors)
+        if count < MIN_CLUSTERED:
+            return np.zeros((1, DIMENSIONS), dtype=np.float32), np.zeros(
+                count, dtype=np.int64
+            )
+        clusters = int(math.sqrt(count))
+        rng = np.random.default_rng(0)
+        sample_size = min(count, clusters * KMEANS_SAMPLE_PER_CLUSTER)
+        sample = vectors[rng.choice(count, sample_size, replace=False)]
+        centroids = sample[rng.choice(sample_size, clusters, replace=False)].copy()
+        for _ in range(KMEANS_ITERATIONS):
+            nearest = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, nearest, sample)
+            empty = ~sums.any(axis=1)
+            # an empty cluster keeps its old centroid
+            sums[empty] = centroids[empty]
+            centroids = _normalize(sums)
+        assignments = np.empty(count, dtype=np.int64)
+        for start in range(0, count, CHUNK_ROWS):
+            chunk = vectors[start: start + CHUNK_ROWS]
+            assignments[start: start + CHUNK_ROWS] = np.argmax(
+                chunk @ centroids.T, axis=1
+            )
+        return centroids.astype(np.float32), assignments
+
+    def save(self) -> None:
+        """
+        Writes the index to its folder, replacing an earlier one.
+        """
+        if not self.folder:
+            return
+        partial = self.folder + ".partial"
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial)
+        for name in ("vectors", "handles", "idf", "centroids", "offsets"):
+            np.save(os.path.join(partial, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(partial, MANIFEST_FILE_NAME), "w") as f:
+            json.dump(self.manifest, f)
+        shutil.rmtree(self.folder, ignore_errors=True)
+        os.replace(partial, self.folder)
+
+    def load(self, fingerprint: str) -> bool:
+        """
+        Opens the stored index if it was built from the same tree; the
+        vectors are memory-mapped. Returns False if it has to be rebuilt.
+        """
+        if not self.folder:
+            return False
+        try:
+            with open(os.path.join(self.folder, MANIFEST_FILE_NAME)) as f:
+                manifest = json.load(f)
+            if (
+                manifest.get("version") != INDEX_VERSION
+                or manifest.get("dimensions") != DIMENSIONS
+                or manifest.get("fingerprint") != fingerprint
+            ):
+                return False
+            for name in ("vectors", "handles", "idf", "centroids", "offsets"):
+                setattr(
+                    self,
+                    name,
+                    np.load(os.path.join(self.folder, f"{name}.npy"), mmap_mode="r"),
+                )
+        except (OSError, ValueError) as exc:
+            LOG.warning(f"Ignoring unreadable semantic index {self.folder}: {exc}")
+            return False
+        self.manifest = manifest
+        return True
+
+    def update(self, handle: str, profile: Optional[str]) -> None:
+        """
+        Replaces the vector of a person by that of a new profile, or drops
+        it when the profile is None. The clusters are not changed; the
+        index is rebuilt when it is opened next time.
+        """
+        self.changed[handle] = None if profile is None else self.query_vector(profile)
+
+    def query_vector(self, text: str) -> Any:
+        dimensions, weights = term_vector(text)
+        vector = np.zeros(DIMENSIONS, dtype=np.float32)
+        vector[dimensions] = weights * self.idf[dimensions]
+        return _normalize(vector)
+
+    def search(
+        self, text: str, k: int = 10, probes: Optional[int] = None
+    ) -> List[Tuple[str, float]]:
+        """
+        Returns up to k (handle, cosine similarity) pairs, best match first,
+        searching the `probes` clusters closest to the query and the
+        persons changed since the index was built.
+        """
+        vector = self.query_vector(text)
+        if not vector.any():
+            return []
+        found = [
+            (handle, float(changed @ vector))
+            for handle, changed in self.changed.items()
+            if changed is not None
+        ]
+        # the stored vectors of changed persons are out of date
+        found += [
+            (handle, score)
+            for handle, score in self._search_clusters(
+                vector, k + len(self.changed), probes
+            )
+            if handle not in self.changed
+        ]
+        found.sort(key=lambda item: -item[1])
+        return [(handle, score) for handle, score in found[:k] if score > 0]
+
+    def _search_clusters(
+        self, vector: Any, k: int, probes: Optional[int]
+    ) -> List[Tuple[str, float]]:
+        if not self.size:
+            return []
+        if probes is None:
+            probes = max(MIN_PROBES, math.ceil(len(self.centroids) * PROBE_FRACTION))
+        nearest = np.argsort(-(self.centroids @ vector))[:probes]
+        # every cluster is a contiguous slice of the vectors
+        slices = [(self.offsets[c], self.offsets[c + 1]) for c in nearest]
+        rows = np.concatenate([np.arange(start, end) for start, end in slices])
+        if not len(rows):
+            return []
+        scores = np.concatenate(
+            [
+                self.vectors[start:end].astype(np.float32) @ vector
+                for start, end in slices
+            ]
+        )
+        best = np.argsort(-scores)[:k]
+        return [(str(self.handles[rows[i]]), float(scores[i])) for i in best]
+
+    def iter_results(
+        self, db: Any, text: str, k: int = 10
+    ) -> Iterator[Dict[str, Any]]:
+        for handle, score in self.search(text, k):
+            raw_person = db.get_raw_person_data(handle)
+            if not raw_person:
+                continue
+            # the profile is rebuilt, not stored: it is only needed for the
+            # few results, and it shows the current data
+            profile = person_profile(db, raw_person, {})
+            yield {
+                "type": "Person",
+                "handle": handle,
+                "gramps_id": raw_person.get("gramps_id"),
+                "name": person_name(raw_person),
+                "score": round(score, 3),
+                "profile": " | ".join(profile.splitlines())[:PROFILE_CHARACTERS],
+            }
+
+
+def open_index(
+    db: Any, cache_dir: Optional[str], cancel: Optional[CancellationToken] = None
+) -> SemanticIndex:
+    """
+    Loads the index of a database from its cache folder, or builds and
+    saves it when there is none or the tree changed. Raises QueryCancelled
+    when `cancel` is cancelled while the profiles are read.
+    """
+    folder = os.path.join(cache_dir, INDEX_DIR_NAME) if cache_dir else None
+    fingerprint = tree_fingerprint(db)
+    index = SemanticIndex(folder)
+    if index.load(fingerprint):
+        return index
+    index.build(iter_profiles(db, cancel), fingerprint)
+    try:
+        index.save()
+    except OSError as exc:
+        LOG.warning(f"Unable to save semantic index {folder}: {exc}")
+    return index
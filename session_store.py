@@ -0,0 +1,231 @@
+"""
+Chat sessions on disk, so a chat survives the end of the program.
+
+Every message is appended to a JSON-lines file per session as soon as it is
+added to the conversation. The file is synced to disk once per answered
+question (or every FSYNC_EVERY_MESSAGES messages), not for every message.
+Resuming a session reads its lines back: the tool results are in there, so
+no tool runs again. Sessions that were not used for a week are compressed,
+and the oldest sessions are deleted when all of them together take more
+than DISK_QUOTA_BYTES.
+"""
+import gzip
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+LOG = logging.getLogger("session_store")
+
+SESSIONS_DIR_NAME = "sessions"
+LOG_SUFFIX = ".jsonl"
+COMPACTED_SUFFIX = ".jsonl.gz"
+# messages written before they are synced to disk anyway
+FSYNC_EVERY_MESSAGES = 32
+# sessions not written for this long are compressed
+COMPACT_AFTER_SECONDS = 7 * 24 * 3600
+# the oldest sessions are deleted when all sessions take more than this
+DISK_QUOTA_BYTES = 50 * 1024 * 1024
+# messages per page of /history
+HISTORY_PAGE_SIZE = 10
+
+Message = Dict[str, Any]
+
+
+class SessionLog:
+    """
+    The file of one session, opened on the first message so that a chat
+    without questions leaves no file behind.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._file: Optional[Any] = None
+        self.unsynced = 0
+
+    def append(self, message: Message) -> None:
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps(message, default=str) + "\n")
+        self.unsynced += 1
+        if self.unsynced >= FSYNC_EVERY_MESSAGES:
+            self.sync()
+
+    def sync(self) -> None:
+        """
+        Writes the appended messages to disk.
+        """
+        if self._file is None or not self.unsynced:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.unsynced = 0
+
+    def close(self) -> None:
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+
+class MessageList(list):
+    """
+    The messages of a chat; appended messages also go to the session log,
+    if there is one. The system prompt is set before the log is attached,
+    so it is not stored: it is built again when a session is resumed.
+    """
+
+    def __init__(self, messages: Iterable[Message] = ()) -> None:
+        super().__init__(messages)
+        self.log: Optional[SessionLog] = None
+
+    def append(self, message: Message) -> None:
+        super().append(message)
+        if self.log is not None:
+            try:
+                self.log.append(message)
+            except OSError as exc:
+                LOG.warning(f"Unable to store the message, the chat continues: {exc}")
+                self.log = None
+
+    def sync(self) -> None:
+        if self.log is not None:
+            try:
+                self.log.sync()
+            except OSError as exc:
+                LOG.warning(f"Unable to store the session: {exc}")
+
+
+def _read_lines(lines: Iterable[str], path: str) -> List[Message]:
+    messages = []
+    for number, line in enumerate(lines, 1):
+        try:
+            messages.append(json.loads(line))
+        except ValueError:
+            # the last line of a session that ended in a crash
+            LOG.warning(f"Skipping line {number} of {path}")
+    return messages
+
+
+def history_page(
+    messages: List[Message], page: int, page_size: int = HISTORY_PAGE_SIZE
+) -> Tuple[List[Message], int, int]:
+    """
+    Returns the messages on a page, the page number, counted from 1 and
+    limited to the pages there are, and the number of pages.
+    """
+    pages = max(1, -(-len(messages) // page_size))
+    page = min(max(page, 1), pages)
+    start = (page - 1) * page_size
+    return messages[start:start + page_size], page, pages
+
+
+class SessionStore:
+    """
+    The session files in a folder, one per chat.
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        quota_bytes: int = DISK_QUOTA_BYTES,
+        compact_after_seconds: float = COMPACT_AFTER_SECONDS,
+    ) -> None:
+        self.folder = folder
+        self.quota_bytes = quota_bytes
+        self.compact_after_seconds = compact_after_seconds
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def new_session_id() -> str:
+        # sorts by time; the random part keeps two chats started in the
+        # same second apart
+        return time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8]
+
+    def _path(self, session_id: str, suffix: str = LOG_SUFFIX) -> str:
+        return os.path.join(self.folder, session_id + suffix)
+
+    def sessions(self) -> List[Tuple[str, str, int, float]]:
+        """
+        Returns (session id, path, bytes, last write) of every session,
+        oldest first.
+        """
+        found = []
+        for name in os.listdir(self.folder):
+            for suffix in (COMPACTED_SUFFIX, LOG_SUFFIX):
+                if name.endswith(suffix):
+                    path = os.path.join(self.folder, name)
+                    stat = os.stat(path)
+                    found.append(
+                        (name[: -len(suffix)], path, stat.st_size, stat.st_mtime)
+                    )
+                    break
+        return sorted(found, key=lambda session: session[3])
+
+    def open(self, session_id: str) -> SessionLog:
+        """
+        Returns the log to append the messages of a session to. A
+        compressed session is expanded first.
+        """
+        path = self._path(session_id)
+        compacted = self._path(session_id, COMPACTED_SUFFIX)
+        if not os.path.exists(path) and os.path.exists(compacted):
+            with gzip.open(compacted, "rb") as source, open(path, "wb") as target:
+                target.write(source.read())
+            os.remove(compacted)
+        return SessionLog(path)
+
+    def load(self, session_id: str) -> List[Message]:
+        """
+        Returns the messages of a session.
+        """
+        path = self._path(session_id)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                return _read_lines(file, path)
+        compacted = self._path(session_id, COMPACTED_SUFFIX)
+        with gzip.open(compacted, "rt", encoding="utf-8") as file:
+            return _read_lines(file, compacted)
+
+    def latest(self, exclude: Optional[str] = None) -> Optional[str]:
+        """
+        Returns the id of the most recent session other than `exclude`.
+        """
+        ids = [session[0] for session in self.sessions() if session[0] != exclude]
+        return ids[-1] if ids else None
+
+    def maintain(self, keep: Optional[str] = None) -> None:
+        """
+        Compresses old sessions and deletes the oldest ones over the quota;
+        the session `keep` is left alone.
+        """
+        now = time.time()
+        for session_id, path, _, modified in self.sessions():
+            if (
+                session_id != keep
+                and path.endswith(LOG_SUFFIX)
+                and now - modified > self.compact_after_seconds
+            ):
+                self._compact(session_id, path, modified)
+        sessions = self.sessions()
+        total = sum(session[2] for session in sessions)
+        for session_id, path, size, _ in sessions:
+            if total <= self.quota_bytes:
+                break
+            if session_id == keep:
+                continue
+            LOG.debug(f"Deleting session {session_id} to stay within the quota")
+            os.remove(path)
+            total -= size
+
+    def _compact(self, session_id: str, path: str, modified: float) -> None:
+        compacted = self._path(session_id, COMPACTED_SUFFIX)
+        partial = compacted + ".partial"
+        with open(path, "rb") as source, gzip.open(partial, "wb") as target:
+            target.write(source.read())
+        # keep the time of the last message, for the order of the sessions
+        os.utime(partial, (modified, modified))
+        os.replace(partial, compacted)
+        os.remove(path)
@@ -0,0 +1,488 @@
+"""
+A SQLite file next to the Gramps database with the indexes of the search
+tools, so they are not rebuilt in memory at every start.
+
+The file holds FTS5 tables over the names of people, the names of places
+and the text of notes, sources and citations, the places enclosing every
+place, and the years of the births and deaths of the people with B-tree
+indexes. Gramps IDs and surnames get no index of their own: Gramps looks
+up Gramps IDs with an index in every backend, and the names FTS5 table
+finds surnames.
+
+It is filled in bulk, in batches of BATCH_ROWS rows in one transaction,
+the first time it is opened; after that only the objects whose change time
+differs are indexed again, and the people whose birth or death event
+changed. The file is in WAL mode, so other processes can
+read it while it is updated, e.g. with connect(path, read_only=True).
+"""
+import json
+import logging
+import os
+import sqlite3
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from note_search import analyze, describe_results, object_text
+from people_search import GIVEN_NAME_FIELDS, OTHER_NAME_FIELDS, SURNAME_FIELDS
+from rawdata_utils import chatbot_cache_dir, date_year_span
+from scan_engine import sqlite_path
+
+LOG = logging.getLogger("sidecar_index")
+
+SIDECAR_FILE_NAME = "sidecar.sqlite"
+# bump when the tables or what goes into them change; the file is rebuilt
+SIDECAR_VERSION = 3
+# rows inserted per executemany()
+BATCH_ROWS = 5000
+# seconds to wait for another process writing the file
+BUSY_TIMEOUT = 30
+# replaced by the sidecar, removed when it is created
+LEGACY_FILES = ("note_search.json",)
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE person (
+    id INTEGER PRIMARY KEY, handle TEXT UNIQUE NOT NULL, change INTEGER,
+    birth_event TEXT, birth_first INTEGER, birth_last INTEGER,
+    birth_approximate INTEGER,
+    death_event TEXT, death_first INTEGER, death_last INTEGER,
+    death_approximate INTEGER
+);
+CREATE INDEX person_birth ON person (birth_first, birth_last);
+CREATE INDEX person_death ON person (death_first, death_last);
+CREATE TABLE vital_event (handle TEXT NOT NULL, change INTEGER, person TEXT NOT NULL);
+CREATE INDEX vital_event_handle ON vital_event (handle);
+CREATE INDEX vital_event_person ON vital_event (person);
+CREATE TABLE place (
+    id INTEGER PRIMARY KEY, handle TEXT UNIQUE NOT NULL, change INTEGER, names TEXT
+);
+CREATE TABLE enclosed_by (place TEXT NOT NULL, parent TEXT NOT NULL);
+CREATE INDEX enclosed_by_place ON enclosed_by (place);
+CREATE INDEX enclosed_by_parent ON enclosed_by (parent);
+CREATE TABLE text_object (
+    id INTEGER PRIMARY KEY, handle TEXT UNIQUE NOT NULL, object_type TEXT,
+    change INTEGER
+);
+CREATE VIRTUAL TABLE names_fts USING fts5(names);
+CREATE VIRTUAL TABLE places_fts USING fts5(names);
+CREATE VIRTUAL TABLE text_fts USING fts5(terms);
+"""
+
+# (object type, table of the sidecar, Gramps table, raw data getter)
+INDEXED_OBJECTS = (
+    ("Person", "person", "person", "get_raw_person_data"),
+    ("Place", "place", "place", "get_raw_place_data"),
+    ("Note", "text_object", "note", "get_raw_note_data"),
+    ("Source", "text_object", "source", "get_raw_source_data"),
+    ("Citation", "text_object", "citation", "get_raw_citation_data"),
+)
+# the events of a person that are indexed, as in "birth_first"
+VITAL_EVENTS = ("birth", "death")
+# the FTS table of every sidecar table; its rowid is the id of the row
+FTS_TABLES = {"person": "names_fts", "place": "places_fts", "text_object": "text_fts"}
+
+Row = Tuple[Any, ...]
+
+
+def connect(path: str, read_only: bool = False) -> sqlite3.Connection:
+    if read_only:
+        return sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    return connection
+
+
+def fts_query(words: List[str]) -> str:
+    """
+    Returns an FTS5 query for any of the words, each quoted as a phrase so
+    that punctuation in a word is no FTS5 syntax.
+    """
+    return " OR ".join('"' + word.replace('"', '""') + '"' for word in words)
+
+
+def name_parts(name: Dict[str, Any]) -> List[str]:
+    parts = [name.get(field) for field in GIVEN_NAME_FIELDS + OTHER_NAME_FIELDS]
+    for surname in name.get("surname_list") or []:
+        parts.extend(surname.get(field) for field in SURNAME_FIELDS)
+    return [part for part in parts if part]
+
+
+def _vital_event(
+    db: Any, raw_person: Dict[str, Any], kind: str
+) -> Tuple[Optional[Dict[str, Any]], Row]:
+    """
+    Returns the raw birth or death event of a person, and its columns in
+    the person table: handle, first and last year, approximate.
+    """
+    refs = raw_person.get("event_ref_list") or []
+    ref_index = raw_person.get(f"{kind}_ref_index", -1)
+    if not 0 <= ref_index < len(refs):
+        return None, (None, None, None, None)
+    raw_event = db.get_raw_event_data(refs[ref_index]["ref"])
+    if not raw_event:
+        return None, (None, None, None, None)
+    span = date_year_span(raw_event.get("date"))
+    if span is None:
+        return raw_event, (raw_event["handle"], None, None, None)
+    return raw_event, (raw_event["handle"], span[0], span[1], int(span[2]))
+
+
+def _place_names(raw_place: Dict[str, Any]) -> List[str]:
+    names = [raw_place.get("name")] + (raw_place.get("alt_names") or [])
+    return [name["value"] for name in names if name and name.get("value")]
+
+
+class SidecarIndex:
+    """
+    The sidecar of one tree. Opened with open(), which creates or brings
+    the file up to date.
+    """
+
+    def __init__(self, db: Any, path: str) -> None:
+        self.db = db
+        self.path = path
+        self.connection = connect(path)
+        self.indexed = 0
+        # person -> its vital_event rows, from _row() to _index()
+        self._vital_events: Dict[str, List[Row]] = {}
+
+    @classmethod
+    def open(cls, db: Any) -> "SidecarIndex":
+        """
+        Returns the up-to-date sidecar of the tree, in the chatbot folder of
+        the database, or in memory when there is no such folder.
+        """
+        cache_dir = chatbot_cache_dir(db)
+        if cache_dir is None:
+            return cls(db, ":memory:").refresh()
+        for name in LEGACY_FILES:
+            legacy = os.path.join(cache_dir, name)
+            if os.path.exists(legacy):
+                os.remove(legacy)
+        path = os.path.join(cache_dir, SIDECAR_FILE_NAME)
+        try:
+            return cls(db, path).refresh()
+        except sqlite3.Error as exc:
+            LOG.warning(f"Unable to use {path}, indexing in memory: {exc}")
+            return cls(db, ":memory:").refresh()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def _version(self) -> Optional[int]:
+        try:
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'version'"
+            ).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return int(row[0]) if row else None
+
+    def _create(self) -> None:
+        """
+        Starts over with empty tables, in a new file.
+        """
+        if self.path != ":memory:":
+            self.connection.close()
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(self.path + suffix):
+                    os.remove(self.path + suffix)
+            self.connection = connect(self.path)
+        self.connection.executescript(SCHEMA)
+        self.connection.execute(
+            "INSERT INTO meta VALUES ('version', ?)", (str(SIDECAR_VERSION),)
+        )
+        self.connection.commit()
+
+    def _changes(self, gramps_table: str, getter: str) -> Iterator[Tuple[str, int]]:
+        """
+        Yields (handle, change) of every object in a Gramps table, straight
+        from the SQLite file when the tree has one.
+        """
+        path = sqlite_path(self.db)
+        if path is not None:
+            tree = connect(path, read_only=True)
+            try:
+                yield from tree.execute(f"SELECT handle, change FROM {gramps_table}")
+            finally:
+                tree.close()
+            return
+        get_raw = getattr(self.db, getter)
+        for handle in getattr(self.db, f"iter_{gramps_table}_handles")():
+            yield handle, get_raw(handle).get("change", 0)
+
+    def refresh(self) -> "SidecarIndex":
+        """
+        Indexes the objects that are new or changed since the last refresh,
+        and drops the deleted ones; everything on the first refresh.
+        """
+        if self._version() != SIDECAR_VERSION:
+            LOG.debug(f"Building {self.path}")
+            self._create()
+        with self.connection:
+            stale_people = self._stale_people()
+            for object_type, table, gramps_table, getter in INDEXED_OBJECTS:
+                indexed = dict(
+                    self.connection.execute(
+                        f"SELECT handle, change FROM {table}"
+                        + (" WHERE object_type = ?" if table == "text_object" else ""),
+                        (object_type,) if table == "text_object" else (),
+                    )
+                )
+                changed = []
+                for handle, change in self._changes(gramps_table, getter):
+                    if handle not in indexed:
+                        changed.append(handle)
+                    elif (
+                        indexed.pop(handle) != change or handle in stale_people
+                    ):
+                        self._remove(table, handle)
+                        changed.append(handle)
+                # what is left was deleted from the tree
+                for handle in indexed:
+                    self._remove(table, handle)
+                self._index(object_type, table, getter, changed)
+        return self
+
+    def _stale_people(self) -> Set[str]:
+        """
+        Returns the people whose birth or death event changed, or was
+        deleted, since they were indexed.
+        """
+        indexed: Dict[str, Set[Tuple[int, str]]] = {}
+        for handle, change, person in self.connection.execute(
+            "SELECT handle, change, person FROM vital_event"
+        ):
+            indexed.setdefault(handle, set()).add((change, person))
+        if not indexed:
+            return set()
+        stale = set()
+        for handle, change in self._changes("event", "get_raw_event_data"):
+            for indexed_change, person in indexed.pop(handle, ()):
+                if indexed_change != change:
+                    stale.add(person)
+        # what is left was deleted from the tree
+        stale.update(person for rows in indexed.values() for _, person in rows)
+        return stale
+
+    def update(self, object_type: str, handles: Iterable[str]) -> None:
+        """
+        Indexes the current version of objects of one type that were added,
+        edited or deleted, without checking the rest of the tree.
+        """
+        for indexed_type, table, _, getter in INDEXED_OBJECTS:
+            if indexed_type == object_type:
+                break
+        else:
+            return
+        get_raw = getattr(self.db, getter)
+        with self.connection:
+            present = []
+            for handle in handles:
+                self._remove(table, handle)
+                if get_raw(handle):
+                    present.append(handle)
+            self._index(object_type, table, getter, present)
+
+    def _remove(self, table: str, handle: str) -> None:
+        row = self.connection.execute(
+            f"SELECT id FROM {table} WHERE handle = ?", (handle,)
+        ).fetchone()
+        if row is None:
+            return
+        self.connection.execute(f"DELETE FROM {FTS_TABLES[table]} WHERE rowid = ?", row)
+        self.connection.execute(f"DELETE FROM {table} WHERE id = ?", row)
+        if table == "place":
+            self.connection.execute("DELETE FROM enclosed_by WHERE place = ?", (handle,))
+        if table == "person":
+            self.connection.execute(
+                "DELETE FROM vital_event WHERE person = ?", (handle,)
+            )
+
+    def _index(
+        self, object_type: str, table: str, getter: str, handles: List[str]
+    ) -> None:
+        if not handles:
+            return
+        get_raw = getattr(self.db, getter)
+        for start in range(0, len(handles), BATCH_ROWS):
+            batch = handles[start:start + BATCH_ROWS]
+            rows = []
+            texts = []
+            parents = []
+            vital_events = []
+            for handle in batch:
+                raw = get_raw(handle)
+                row, text = self._row(object_type, raw)
+                rows.append(row)
+                texts.append(text)
+                if object_type == "Place":
+                    parents.extend(
+                        (handle, placeref["ref"])
+                        for placeref in raw.get("placeref_list") or []
+                    )
+                if object_type == "Person":
+                    vital_events.extend(self._vital_events.pop(handle, ()))
+            columns = len(rows[0]) if rows else 0
+            self.connection.executemany(
+                f"INSERT INTO {table} VALUES (NULL{', ?' * columns})", rows
+            )
+            self.connection.executemany(
+                f"INSERT INTO {FTS_TABLES[table]} (rowid, "
+                f"{'terms' if table == 'text_object' else 'names'}) VALUES (?, ?)",
+                self._fts_rows(table, batch, texts),
+            )
+            self.connection.executemany("INSERT INTO enclosed_by VALUES (?, ?)", parents)
+            self.connection.executemany(
+                "INSERT INTO vital_event VALUES (?, ?, ?)", vital_events
+            )
+            self.indexed += len(batch)
+
+    def _fts_rows(
+        self, table: str, handles: List[str], texts: List[str]
+    ) -> Iterator[Tuple[int, str]]:
+        text_of = dict(zip(handles, texts))
+        for row_id, handle in self.connection.execute(
+            f"SELECT id, handle FROM {table} WHERE handle IN "
+            "(SELECT value FROM json_each(?))",
+            (json.dumps(handles),),
+        ):
+            yield row_id, text_of[handle]
+
+    def _row(self, object_type: str, raw: Dict[str, Any]) -> Tuple[Row, str]:
+        """
+        Returns the row of an object in its sidecar table, without the id,
+        and the text for its FTS table.
+        """
+        handle, change = raw["handle"], raw["change"]
+        if object_type == "Person":
+            names = [raw.get("primary_name") or {}] + (raw.get("alternate_names") or [])
+            row: Row = (handle, change)
+            self._vital_events[handle] = []
+            for kind in VITAL_EVENTS:
+                raw_event, columns = _vital_event(self.db, raw, kind)
+                row += columns
+                if raw_event:
+                    self._vital_events[handle].append(
+                        (raw_event["handle"], raw_event["change"], handle)
+                    )
+            return row, " ".join(part for name in names for part in name_parts(name))
+        if object_type == "Place":
+            names = _place_names(raw)
+            return (handle, change, "\n".join(names).lower()), " ".join(names)
+        terms = " ".join(analyze(object_text(self.db, object_type, raw)))
+        return (handle, object_type, change), terms
+
+    def people_named(
+        self, search_string: str
+    ) -> Iterator[Tuple[float, Dict[str, Any]]]:
+        """
+        Yields (part of the people read, raw person) for the people with
+        any word of search_string in a name, like SqlPushdown.people_named().
+        """
+        words = search_string.split()
+        if not words:
+            return
+        last_id = self.connection.execute("SELECT max(id) FROM person").fetchone()[0]
+        # FTS5 returns the matches in rowid order, no sorting needed
+        cursor = self.connection.execute(
+            "SELECT person.id, person.handle FROM names_fts "
+            "JOIN person ON person.id = names_fts.rowid "
+            "WHERE names_fts MATCH ? ORDER BY names_fts.rowid",
+            (fts_query(words),),
+        )
+        for row_id, handle in cursor:
+            yield row_id / last_id, self.db.get_raw_person_data(handle)
+
+    def vital_events_in_range(
+        self, kind: str, start_year: int, end_year: int, limit: Optional[int] = None
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Like EventDateIndex.query() for the births or deaths (`kind`) of the
+        people: returns the first `limit` matches, all when None, in
+        chronological order and the number of matches.
+        """
+        if kind not in VITAL_EVENTS:
+            raise ValueError(f"Unknown kind {kind!r}, use one of {VITAL_EVENTS}")
+        if start_year > end_year:
+            start_year, end_year = end_year, start_year
+        # an event shared by several people is one match
+        rows = self.connection.execute(
+            f"""
+            SELECT event, first_year, last_year, approximate, count(*) OVER ()
+            FROM (
+                SELECT DISTINCT {kind}_event AS event, {kind}_first AS first_year,
+                    {kind}_last AS last_year, {kind}_approximate AS approximate
+                FROM person WHERE {kind}_first <= ? AND {kind}_last >= ?
+            )
+            ORDER BY first_year, last_year, event LIMIT ?""",
+            (end_year, start_year, -1 if limit is None else limit),
+        ).fetchall()
+        matches = [
+            {
+                "event_handle": handle,
+                "first_year": first_year,
+                "last_year": last_year,
+                "approximate": bool(approximate),
+            }
+            for handle, first_year, last_year, approximate, _ in rows
+        ]
+        return matches, rows[0][4] if rows else 0
+
+    def places_within(self, name: str) -> Set[str]:
+        """
+        Returns the handles of the places called `name` (ignoring case, also
+        by an alternate name) and of every place they enclose.
+        """
+        name = name.strip().lower()
+        named = [
+            handle
+            for handle, names in self.connection.execute(
+                "SELECT place.handle, place.names FROM places_fts "
+                "JOIN place ON place.id = places_fts.rowid WHERE places_fts MATCH ?",
+                (fts_query([name]),),
+            )
+            if name in names.split("\n")
+        ]
+        if not named:
+            return set()
+        within = self.connection.execute(
+            """
+            WITH RECURSIVE within(handle) AS (
+                SELECT value FROM json_each(?)
+                UNION
+                SELECT enclosed_by.place FROM enclosed_by, within
+                WHERE enclosed_by.parent = within.handle
+            )
+            SELECT handle FROM within
+            """,
+            (json.dumps(named),),
+        )
+        return {handle for (handle,) in within}
+
+    def search_notes(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """
+        Returns the best `limit` notes, sources and citations for the query,
+        ranked with BM25, described by note_search.describe_results().
+        """
+        terms = sorted(set(analyze(query)))
+        if not terms:
+            return []
+        hits = [
+            (handle, object_type, -score)
+            for handle, object_type, score in self.connection.execute(
+                "SELECT text_object.handle, text_object.object_type, "
+                "bm25(text_fts) AS score FROM text_fts "
+                "JOIN text_object ON text_object.id = text_fts.rowid "
+                "WHERE text_fts MATCH ? ORDER BY score, text_object.handle LIMIT ?",
+                (fts_query(terms), limit),
+            )
+        ]
+        return list(describe_results(self.db, hits, set(terms)))
+
+    def stats(self) -> Dict[str, Any]:
+        counts = {
+            table: self.connection.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+            for table in ("person", "place", "text_object")
+        }
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        return {"path": self.path, "bytes": size, "indexed": self.indexed, **counts}
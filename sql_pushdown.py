@@ -0,0 +1,197 @@
+"""
+Filters of the tools run inside SQLite.
+
+The SQLite backend of Gramps 6 stores every object as JSON in the json_data
+column of its table. Instead of reading the records one at a time with
+get_raw_event_data() and filtering them in Python, the date, type and
+place filters of find_events_in_range are translated to SQL with
+json_extract(), so SQLite returns only the matching records; names are
+searched in the sidecar index. For other backends `available` is False and
+the tools keep their Python path.
+
+The filters use a read-only connection of their own, so they always see
+the committed state of the tree.
+"""
+import json
+import logging
+import sqlite3
+from typing import Any, Dict, List, Optional, Tuple
+
+from gramps.gen.lib import Date, EventType
+
+from rawdata_utils import ABOUT_YEARS, BEFORE_AFTER_YEARS, event_type_name
+from scan_engine import sqlite_path
+
+LOG = logging.getLogger("sql_pushdown")
+
+# the year span of a date, as date_year_span() computes it
+YEAR = "json_extract(json_data, '$.date.dateval[2]')"
+LAST_YEAR = "coalesce(nullif(json_extract(json_data, '$.date.dateval[6]'), 0), {y})"
+MODIFIER = "json_extract(json_data, '$.date.modifier')"
+QUALITY = "json_extract(json_data, '$.date.quality')"
+FIRST_YEAR_SQL = f"""CASE
+    WHEN {MODIFIER} IN ({Date.MOD_RANGE}, {Date.MOD_SPAN})
+        THEN min({YEAR}, {LAST_YEAR.format(y=YEAR)})
+    WHEN {MODIFIER} = {Date.MOD_ABOUT} THEN {YEAR} - {ABOUT_YEARS}
+    WHEN {MODIFIER} IN ({Date.MOD_BEFORE}, {Date.MOD_TO})
+        THEN {YEAR} - {BEFORE_AFTER_YEARS}
+    WHEN {QUALITY} != {Date.QUAL_NONE} THEN {YEAR} - {ABOUT_YEARS}
+    ELSE {YEAR} END"""
+LAST_YEAR_SQL = f"""CASE
+    WHEN {MODIFIER} IN ({Date.MOD_RANGE}, {Date.MOD_SPAN})
+        THEN max({YEAR}, {LAST_YEAR.format(y=YEAR)})
+    WHEN {MODIFIER} = {Date.MOD_ABOUT} THEN {YEAR} + {ABOUT_YEARS}
+    WHEN {MODIFIER} IN ({Date.MOD_AFTER}, {Date.MOD_FROM})
+        THEN {YEAR} + {BEFORE_AFTER_YEARS}
+    WHEN {QUALITY} != {Date.QUAL_NONE} THEN {YEAR} + {ABOUT_YEARS}
+    ELSE {YEAR} END"""
+APPROXIMATE_SQL = (
+    f"({MODIFIER} != {Date.MOD_NONE} "
+    f"OR {QUALITY} != {Date.QUAL_NONE})"
+)
+DATED_SQL = (
+    f"json_extract(json_data, '$.date.sortval') != 0 AND {YEAR} != 0 "
+    f"AND {MODIFIER} != {Date.MOD_TEXTONLY}"
+)
+
+# the handles of the places with a name, and of every place they enclose
+PLACES_WITHIN_SQL = """
+WITH RECURSIVE within(handle) AS (
+    SELECT place.handle FROM place
+    WHERE py_lower(json_extract(place.json_data, '$.name.value')) = :name
+       OR EXISTS (
+           SELECT 1 FROM json_each(place.json_data, '$.alt_names') AS alt
+           WHERE py_lower(json_extract(alt.value, '$.value')) = :name
+       )
+    UNION
+    SELECT place.handle
+    FROM within, place, json_each(place.json_data, '$.placeref_list') AS ref
+    WHERE json_extract(ref.value, '$.ref') = within.handle
+)
+"""
+
+
+def _lower(text: Optional[str]) -> Optional[str]:
+    return text.lower() if isinstance(text, str) else text
+
+
+class SqlPushdown:
+    """
+    The SQL versions of the filters, for one tree.
+    """
+
+    def __init__(self, db: Any) -> None:
+        self.path = sqlite_path(db)
+        self._connection: Optional[sqlite3.Connection] = None
+        self._type_values: Optional[Dict[str, int]] = None
+        self.queries = 0
+
+    @property
+    def available(self) -> bool:
+        return self.path is not None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(
+                f"file:{self.path}?mode=ro", uri=True, check_same_thread=False
+            )
+            # lower() of SQLite only knows ASCII letters
+            self._connection.create_function(
+                "py_lower", 1, _lower, deterministic=True
+            )
+        return self._connection
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _execute(self, sql: str, params: Any = ()) -> sqlite3.Cursor:
+        self.queries += 1
+        return self.connection.execute(sql, params)
+
+    def _event_type_condition(self, event_type: str) -> Tuple[str, Dict[str, Any]]:
+        if self._type_values is None:
+            self._type_values = {
+                EventType(value).xml_str().lower(): value
+                for value in EventType().get_map()
+            }
+        event_type = event_type.strip().lower()
+        condition = (
+            f"(json_extract(json_data, '$.type.value') = {EventType.CUSTOM} "
+            "AND lower(json_extract(json_data, '$.type.string')) = :type_string)"
+        )
+        params: Dict[str, Any] = {"type_string": event_type}
+        value = self._type_values.get(event_type)
+        if value is not None and value != EventType.CUSTOM:
+            condition = (
+                f"(json_extract(json_data, '$.type.value') = :type_value "
+                f"OR {condition})"
+            )
+            params["type_value"] = value
+        return condition, params
+
+    def events_in_range(
+        self,
+        start_year: int,
+        end_year: int,
+        event_type: str = "",
+        place: str = "",
+        limit: int = 50,
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Like EventDateIndex.query(), and optionally only the events in a
+        place or any place it encloses: returns the first `limit` matches
+        in chronological order and the number of matches.
+        """
+        if start_year > end_year:
+            start_year, end_year = end_year, start_year
+        conditions = [DATED_SQL]
+        params: Dict[str, Any] = {
+            "start_year": start_year,
+            "end_year": end_year,
+            "limit": limit,
+        }
+        if event_type.strip():
+            condition, type_params = self._event_type_condition(event_type)
+            conditions.append(condition)
+            params.update(type_params)
+        sql = ""
+        if place.strip():
+            sql = PLACES_WITHIN_SQL
+            conditions.append("event.place IN (SELECT handle FROM within)")
+            params["name"] = place.strip().lower()
+        sql += f"""
+            SELECT handle, first_year, last_year, approximate, count(*) OVER ()
+            FROM (
+                SELECT handle, {FIRST_YEAR_SQL} AS first_year,
+                    {LAST_YEAR_SQL} AS last_year, {APPROXIMATE_SQL} AS approximate
+                FROM event WHERE {" AND ".join(conditions)}
+            )
+            WHERE first_year <= :end_year AND last_year >= :start_year
+            ORDER BY first_year, last_year, handle
+            LIMIT :limit"""
+        rows = self._execute(sql, params).fetchall()
+        matches = [
+            {
+                "event_handle": handle,
+                "first_year": first_year,
+                "last_year": last_year,
+                "approximate": bool(approximate),
+            }
+            for handle, first_year, last_year, approximate, _ in rows
+        ]
+        return matches, rows[0][4] if rows else 0
+
+    def event_types(self) -> List[str]:
+        """
+        Returns the names of the event types of the dated events.
+        """
+        cursor = self._execute(
+            "SELECT DISTINCT json_extract(json_data, '$.type') FROM event "
+            f"WHERE {DATED_SQL}"
+        )
+        return sorted(
+            {event_type_name(json.loads(raw_type)).lower() for (raw_type,) in cursor}
+        )
@@ -0,0 +1,50 @@
+import os
+import sys
+from typing import Any, Dict, List
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeTree:
+    """
+    The raw-data part of a Gramps database, holding persons only.
+    """
+
+    def __init__(self, people: List[Dict[str, Any]]) -> None:
+        self.people = {person["handle"]: person for person in people}
+
+    def get_number_of_people(self) -> int:
+        return len(self.people)
+
+    def iter_person_handles(self):
+        return iter(self.people)
+
+    def get_raw_person_data(self, handle: str) -> Dict[str, Any]:
+        return self.people.get(handle)
+
+
+def raw_person(
+    handle: str, first_name: str = "", surname: str = "", **name: str
+) -> Dict[str, Any]:
+    return {
+        "handle": handle,
+        "gramps_id": handle.upper(),
+        "primary_name": {
+            "first_name": first_name,
+            "surname_list": [{"surname": surname}] if surname else [],
+            **name,
+        },
+        "alternate_names": [],
+    }
+
+
+@pytest.fixture
+def make_tree():
+    def make(*names):
+        return FakeTree(
+            [raw_person(f"p{number}", *name) for number, name in enumerate(names)]
+        )
+
+    return make
@@ -0,0 +1,110 @@
+import pytest
+
+from admission import (DEFAULT_SERVICE_SECONDS, AdmissionController,
+                       AdmissionRejected)
+
+
+class Worker:
+    """
+    Runs the submitted jobs one at a time, when the test says so.
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self.ran = []
+
+    def submit(self, job):
+        self.jobs.append(job)
+
+    def run_next(self):
+        self.jobs.pop(0)()
+
+
+def ask(controller, worker, client_id, question, positions=None):
+    def on_position(position):
+        if positions is not None:
+            positions.setdefault(question, []).append(position)
+
+    return controller.admit(
+        client_id, lambda: worker.ran.append(question), on_position
+    )
+
+
+def test_one_job_at_a_time():
+    worker = Worker()
+    controller = AdmissionController(worker.submit)
+    ask(controller, worker, "a", "a1")
+    ask(controller, worker, "a", "a2")
+    assert len(worker.jobs) == 1
+    assert controller.depth() == 1
+    worker.run_next()
+    assert worker.ran == ["a1"]
+    assert len(worker.jobs) == 1
+    worker.run_next()
+    assert worker.ran == ["a1", "a2"]
+    assert not controller.busy
+
+
+def test_clients_take_turns():
+    worker = Worker()
+    controller = AdmissionController(worker.submit)
+    positions = {}
+    for client_id, question in [
+        ("a", "a1"),
+        ("a", "a2"),
+        ("a", "a3"),
+        ("b", "b1"),
+        ("c", "c1"),
+    ]:
+        ask(controller, worker, client_id, question, positions)
+    assert positions["a3"] == [2, 3, 4]
+    assert positions["b1"] == [2]
+    while worker.jobs:
+        worker.run_next()
+    assert worker.ran == ["a1", "a2", "b1", "c1", "a3"]
+    assert positions["a3"] == [2, 3, 4, 3, 2, 1]
+
+
+def test_rejected_when_a_client_asks_too_much():
+    worker = Worker()
+    controller = AdmissionController(
+        worker.submit, max_queued=10, max_queued_per_client=2
+    )
+    for number in range(3):
+        ask(controller, worker, "a", f"a{number}")
+    with pytest.raises(AdmissionRejected) as rejected:
+        ask(controller, worker, "a", "a3")
+    assert rejected.value.retry_after == DEFAULT_SERVICE_SECONDS * 3
+    # other clients still get in
+    ask(controller, worker, "b", "b1")
+    assert controller.stats()["rejected"] == 1
+    assert controller.stats()["admitted"] == 4
+
+
+def test_rejected_when_the_queue_is_full():
+    worker = Worker()
+    controller = AdmissionController(
+        worker.submit, max_queued=2, max_queued_per_client=2
+    )
+    ask(controller, worker, "a", "a1")
+    ask(controller, worker, "b", "b1")
+    ask(controller, worker, "c", "c1")
+    with pytest.raises(AdmissionRejected):
+        ask(controller, worker, "d", "d1")
+    worker.run_next()
+    ask(controller, worker, "d", "d1")
+    assert controller.depth() == 2
+
+
+def test_withdraw():
+    worker = Worker()
+    controller = AdmissionController(worker.submit)
+    positions = {}
+    ask(controller, worker, "a", "a1")
+    b1 = ask(controller, worker, "b", "b1", positions)
+    ask(controller, worker, "c", "c1", positions)
+    controller.withdraw(b1)
+    assert positions["c1"] == [2, 1]
+    while worker.jobs:
+        worker.run_next()
+    assert worker.ran == ["a1", "c1"]
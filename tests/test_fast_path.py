@@ -0,0 +1,37 @@
+import pytest
+
+pytest.importorskip("gramps.gen.lib")
+
+from fast_path import FastPath  # noqa: E402
+from people_search import find_people  # noqa: E402
+
+
+def fast_path(tree):
+    return FastPath(
+        {"find_people_by_name": lambda name, **kwargs: find_people(tree, name, **kwargs)}
+    )
+
+
+def test_surname_alone_is_ambiguous(make_tree):
+    tree = make_tree(("", "Garner"), ("Lewis", "Garner"), ("Anna", "Garner"))
+    assert fast_path(tree).resolve_person("Garner") is None
+
+
+def test_unknown_name(make_tree):
+    tree = make_tree(("Lewis", "Garner"))
+    assert fast_path(tree).resolve_person("Jim Baker") is None
+
+
+def test_unique_full_name(make_tree):
+    tree = make_tree(("Lewis", "Garner"), ("Anna", "Garner"), ("Lewis", "Baker"))
+    assert fast_path(tree).resolve_person("Lewis Garner") == "p0"
+
+
+def test_full_name_of_two_people(make_tree):
+    tree = make_tree(("Lewis", "Garner"), ("Lewis", "Garner"), ("Anna", "Garner"))
+    assert fast_path(tree).resolve_person("Lewis Garner") is None
+
+
+def test_given_names_only(make_tree):
+    tree = make_tree(("Lewis Anderson", "Garner"))
+    assert fast_path(tree).resolve_person("Lewis Anderson") is None
@@ -0,0 +1,34 @@
+from typing import Any, Dict, List, Optional
+
+from litellm_utils import function_to_litellm_definition
+
+
+def tool(
+    query: str,
+    limit: int = 25,
+    filters: Optional[Dict[str, Any]] = None,
+    tags: Optional[List[str]] = None,
+) -> None:
+    """
+    Finds things.
+    """
+
+
+def test_optional_parameters():
+    function = function_to_litellm_definition(tool)["function"]
+    assert function["description"] == "Finds things."
+    parameters = function["parameters"]
+    assert parameters["required"] == ["query"]
+    properties = parameters["properties"]
+    assert properties["query"]["type"] == "string"
+    assert properties["limit"] == {
+        "type": "integer",
+        "description": "limit parameter",
+        "default": 25,
+    }
+    assert properties["filters"] == {
+        "type": "object",
+        "description": "filters parameter",
+    }
+    assert properties["tags"]["type"] == "array"
+    assert properties["tags"]["items"] == {"type": "string"}
@@ -0,0 +1,108 @@
+from people_search import (ALTERNATE_NAME, FULL_NAME, GIVEN_NAME, OTHER_NAME,
+                           RANKS, SURNAME, find_people, match_rank,
+                           word_patterns)
+
+
+def rank(person, search_string):
+    found = match_rank(person, word_patterns(search_string))
+    return None if found is None else RANKS[found]
+
+
+def test_match_rank(make_tree):
+    person = make_tree(("Lewis Anderson", "Garner")).people["p0"]
+    person["primary_name"]["nick"] = "Andy"
+    assert rank(person, "Lewis Garner") == FULL_NAME
+    assert rank(person, "garner") == SURNAME
+    assert rank(person, "Anderson") == GIVEN_NAME
+    assert rank(person, "Andy") == OTHER_NAME
+    assert rank(person, "Baker") is None
+    # whole words only
+    assert rank(person, "Gar") is None
+
+
+def test_match_rank_alternate_name(make_tree):
+    person = make_tree(("Lewis", "Garner")).people["p0"]
+    person["alternate_names"] = [
+        {"first_name": "Louis", "surname_list": [{"surname": "Gardner"}]}
+    ]
+    assert rank(person, "Gardner") == ALTERNATE_NAME
+
+
+def test_one_word_is_a_whole_name_only_when_it_is_all_of_the_name(make_tree):
+    tree = make_tree(("", "Garner"), ("Lewis", "Garner"))
+    assert rank(tree.people["p0"], "Garner") == FULL_NAME
+    assert rank(tree.people["p1"], "Garner") == SURNAME
+
+
+def test_a_whole_name_needs_a_given_name_and_a_surname(make_tree):
+    person = make_tree(("Lewis Anderson", "Garner")).people["p0"]
+    assert rank(person, "Lewis Anderson") == GIVEN_NAME
+    assert rank(person, "Lewis Baker") == GIVEN_NAME
+
+
+def test_best_matches_first(make_tree):
+    tree = make_tree(
+        ("Garner", "Baker"),
+        ("Anna", "Garner"),
+        ("Lewis", "Garner"),
+        ("Lewis", "Baker"),
+    )
+    found = find_people(tree, "Lewis Garner")
+    assert [(person["handle"], person["match"]) for person in found["people"]] == [
+        ("p2", FULL_NAME),
+        ("p1", SURNAME),
+        ("p0", GIVEN_NAME),
+        ("p3", GIVEN_NAME),
+    ]
+    assert found["total_matches"] == 4
+    assert not found["total_is_estimate"]
+    assert found["next_cursor"] is None
+
+
+def test_pages(make_tree):
+    tree = make_tree(*[("Anna", "Garner")] * 3, *[("", "Garner")] * 4, ("", "Baker"))
+    seen = []
+    cursor = 0
+    while cursor is not None:
+        found = find_people(tree, "Garner", limit=3, cursor=cursor)
+        assert len(found["people"]) <= 3
+        seen.extend(person["handle"] for person in found["people"])
+        cursor = found["next_cursor"]
+    # the last page read the whole tree
+    assert not found["total_is_estimate"]
+    assert found["total_matches"] == 7
+    assert len(seen) == len(set(seen)) == 7
+    # the whole-name matches of the surname-only people come first
+    assert seen[:4] == ["p3", "p4", "p5", "p6"]
+
+
+def test_scan_stops_when_the_page_is_settled(make_tree):
+    tree = make_tree(*[("Lewis", "Garner")] * 100)
+    found = find_people(tree, "Lewis Garner", limit=5)
+    assert [person["handle"] for person in found["people"]] == [
+        "p0",
+        "p1",
+        "p2",
+        "p3",
+        "p4",
+    ]
+    assert found["total_is_estimate"]
+    assert found["total_matches"] == 100
+    assert found["next_cursor"] == 5
+
+
+def test_limit_and_cursor_are_clamped(make_tree):
+    tree = make_tree(("Lewis", "Garner"), ("Anna", "Garner"))
+    found = find_people(tree, "Garner", limit=0, cursor=-3)
+    assert [person["handle"] for person in found["people"]] == ["p0"]
+    assert found["next_cursor"] == 1
+
+
+def test_no_words(make_tree):
+    found = find_people(make_tree(("Lewis", "Garner")), "  ")
+    assert found == {
+        "total_matches": 0,
+        "total_is_estimate": False,
+        "next_cursor": None,
+        "people": [],
+    }
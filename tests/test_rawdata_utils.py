@@ -0,0 +1,68 @@
+import pytest
+
+pytest.importorskip("gramps.gen.lib")
+
+from gramps.gen.lib import Date  # noqa: E402
+
+from rawdata_utils import (ABOUT_YEARS, BEFORE_AFTER_YEARS,  # noqa: E402
+                           date_year_span)
+
+
+def raw_date(year, modifier=Date.MOD_NONE, quality=Date.QUAL_NONE, last_year=0):
+    return {
+        "sortval": 1,
+        "modifier": modifier,
+        "quality": quality,
+        "dateval": (0, 0, year, False, 0, 0, last_year, False),
+    }
+
+
+def test_exact_year():
+    assert date_year_span(raw_date(1850)) == (1850, 1850, False)
+
+
+@pytest.mark.parametrize(
+    "modifier, span",
+    [
+        (Date.MOD_ABOUT, (1850 - ABOUT_YEARS, 1850 + ABOUT_YEARS)),
+        (Date.MOD_BEFORE, (1850 - BEFORE_AFTER_YEARS, 1850)),
+        (Date.MOD_TO, (1850 - BEFORE_AFTER_YEARS, 1850)),
+        (Date.MOD_AFTER, (1850, 1850 + BEFORE_AFTER_YEARS)),
+        (Date.MOD_FROM, (1850, 1850 + BEFORE_AFTER_YEARS)),
+    ],
+)
+def test_modifiers_widen_the_span(modifier, span):
+    assert date_year_span(raw_date(1850, modifier)) == (*span, True)
+
+
+@pytest.mark.parametrize("quality", [Date.QUAL_ESTIMATED, Date.QUAL_CALCULATED])
+def test_estimated_and_calculated_widen_like_about(quality):
+    assert date_year_span(raw_date(1850, quality=quality)) == (
+        1850 - ABOUT_YEARS,
+        1850 + ABOUT_YEARS,
+        True,
+    )
+
+
+@pytest.mark.parametrize("modifier", [Date.MOD_RANGE, Date.MOD_SPAN])
+def test_ranges(modifier):
+    assert date_year_span(raw_date(1850, modifier, last_year=1870)) == (
+        1850,
+        1870,
+        True,
+    )
+    # a range given the wrong way round, or without an end
+    assert date_year_span(raw_date(1870, modifier, last_year=1850)) == (
+        1850,
+        1870,
+        True,
+    )
+    assert date_year_span(raw_date(1850, modifier)) == (1850, 1850, True)
+
+
+def test_dates_without_a_year():
+    assert date_year_span(None) is None
+    assert date_year_span({}) is None
+    assert date_year_span(dict(raw_date(1850), sortval=0)) is None
+    assert date_year_span(raw_date(1850, Date.MOD_TEXTONLY)) is None
+    assert date_year_span(raw_date(0)) is None
@@ -0,0 +1,74 @@
+import os
+import time
+
+from session_store import (COMPACTED_SUFFIX, LOG_SUFFIX, SessionStore,
+                           history_page)
+
+
+def test_history_page():
+    messages = list(range(25))
+    assert history_page(messages, 1, 10) == (list(range(10)), 1, 3)
+    assert history_page(messages, 3, 10) == (list(range(20, 25)), 3, 3)
+
+
+def test_history_page_out_of_range():
+    messages = list(range(25))
+    assert history_page(messages, 0, 10) == (list(range(10)), 1, 3)
+    assert history_page(messages, 9, 10) == (list(range(20, 25)), 3, 3)
+    assert history_page([], 2, 10) == ([], 1, 1)
+
+
+def write_session(store, session_id, messages, age_seconds=0):
+    log = store.open(session_id)
+    for message in messages:
+        log.append(message)
+    log.close()
+    modified = time.time() - age_seconds
+    os.utime(log.path, (modified, modified))
+
+
+def files(store):
+    return sorted(os.listdir(store.folder))
+
+
+def test_maintain_compacts_old_sessions(tmp_path):
+    store = SessionStore(str(tmp_path), compact_after_seconds=3600)
+    old = [{"role": "user", "content": "who was Lewis Garner"}]
+    write_session(store, "old", old, age_seconds=7300)
+    write_session(store, "kept", old, age_seconds=7200)
+    write_session(store, "new", old)
+    store.maintain(keep="kept")
+    assert files(store) == [
+        "kept" + LOG_SUFFIX,
+        "new" + LOG_SUFFIX,
+        "old" + COMPACTED_SUFFIX,
+    ]
+    assert store.load("old") == old
+    # the compacted session keeps its place in the order of the sessions
+    assert [session[0] for session in store.sessions()] == ["old", "kept", "new"]
+
+
+def test_maintain_deletes_the_oldest_sessions_over_the_quota(tmp_path):
+    store = SessionStore(str(tmp_path))
+    message = {"role": "user", "content": "x" * 100}
+    for age, session_id in enumerate(["c", "b", "a"]):
+        write_session(store, session_id, [message], age_seconds=100 * (age + 1))
+    size = os.path.getsize(os.path.join(store.folder, "a" + LOG_SUFFIX))
+    store.quota_bytes = 2 * size
+    # "a" is the oldest, but in use
+    store.maintain(keep="a")
+    assert files(store) == ["a" + LOG_SUFFIX, "c" + LOG_SUFFIX]
+    store.quota_bytes = size
+    store.maintain()
+    assert files(store) == ["c" + LOG_SUFFIX]
+
+
+def test_resume_a_compacted_session(tmp_path):
+    store = SessionStore(str(tmp_path), compact_after_seconds=3600)
+    first = {"role": "user", "content": "first"}
+    write_session(store, "chat", [first], age_seconds=7200)
+    store.maintain()
+    second = {"role": "user", "content": "second"}
+    write_session(store, "chat", [second])
+    assert files(store) == ["chat" + LOG_SUFFIX]
+    assert store.load("chat") == [first, second]
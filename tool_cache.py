@@ -0,0 +1,96 @@
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+# (text of the tool result for the LLM, handles of the persons in it)
+CacheEntry = Tuple[str, List[str]]
+
+# what an entry costs besides its text: the key, the tuple and the handles
+ENTRY_OVERHEAD_BYTES = 200
+
+
+def tool_cache_key(tool_name: str, arguments: Dict[str, Any]) -> str:
+    """
+    Returns the cache key of a tool call; the order of the arguments does
+    not matter.
+    """
+    return tool_name + ":" + json.dumps(arguments, sort_keys=True, default=str)
+
+
+class ToolResultCache:
+    """
+    Least recently used cache of tool results, bounded by an estimate of
+    the memory the entries take.
+
+    Entries are written by the tool calls of the LLM and by the prefetcher
+    (see prefetch.py). Prefetched entries never push out other entries:
+    the prefetcher checks has_room() first.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, Tuple[CacheEntry, int, bool]]" = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.prefetch_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def has_room(self) -> bool:
+        return self.nbytes < self.max_bytes
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self.lock:
+            stored = self.entries.get(key)
+            if stored is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            entry, size, prefetched = stored
+            self.hits += 1
+            if prefetched:
+                self.prefetch_hits += 1
+                # count a prefetched entry as a prefetch hit only once
+                self.entries[key] = (entry, size, False)
+            return entry
+
+    def put(self, key: str, entry: CacheEntry, prefetched: bool = False) -> None:
+        size = (
+            len(entry[0])
+            + sum(len(handle) for handle in entry[1])
+            + ENTRY_OVERHEAD_BYTES
+        )
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (entry, size, prefetched)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "prefetch_hits": self.prefetch_hits,
+            "misses": self.misses,
+        }
+
+    def _remove(self, key: str) -> None:
+        stored = self.entries.pop(key, None)
+        if stored is not None:
+            self.nbytes -= stored[1]
@@ -0,0 +1,468 @@
+"""
+A small path language to walk the tree in one tool call.
+
+    person(I0001).parents.parents.events[type=Birth]
+    home.children[gender=female].spouses
+    person("Jim Baker").children.birth.place
+
+A query starts at one object and every step follows an edge of the graph
+from all objects reached so far; steps can be filtered with [field op
+value, ...]. The operators are = and != (case-insensitive), ~ (contains)
+and <, >, <=, >= for years. Every step keeps at most MAX_FANOUT objects so
+that a query on a large tree stays cheap.
+"""
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from gramps.gen.datehandler import get_date
+from gramps.gen.display.place import displayer as place_displayer
+from gramps.gen.lib import FamilyRelType, PlaceType
+
+from cancellation import CancellationToken
+from people_search import find_people, resolve_person
+from rawdata_utils import (date_year_span, event_type_name, family_name,
+                           person_name)
+
+PERSON = "Person"
+FAMILY = "Family"
+EVENT = "Event"
+PLACE = "Place"
+
+# objects kept after every step
+MAX_FANOUT = 500
+MAX_STEPS = 10
+
+GENDERS = {0: "female", 1: "male", 2: "unknown", 3: "other"}
+
+TOKEN_PATTERN = re.compile(
+    r"""\s*(?:
+        (?P<string>"[^"]*"|'[^']*')
+        |(?P<op>!=|<=|>=|=|~|<|>)
+        |(?P<word>[\w-]+)
+        |(?P<punct>[.()\[\],])
+    )""",
+    re.VERBOSE,
+)
+
+
+class QueryError(ValueError):
+    pass
+
+
+def _tokenize(query: str) -> List[Tuple[str, str]]:
+    tokens = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = TOKEN_PATTERN.match(query, position)
+        if not match or match.end() == position:
+            raise QueryError(f"Unexpected character at {position}: {query[position:]!r}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "string":
+            kind, value = "word", value[1:-1]
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    """
+    query  := start ("." step)*
+    start  := ("person" | "family" | "event" | "place") "(" id ")" | "home"
+    step   := name filter?
+    filter := "[" field op value ("," field op value)* "]"
+    """
+
+    def __init__(self, query: str) -> None:
+        self.tokens = _tokenize(query)
+        self.position = 0
+
+    def peek(self) -> Optional[Tuple[str, str]]:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def take(self, kind: str, value: Optional[str] = None) -> str:
+        token = self.peek()
+        if token is None or token[0] != kind or (value and token[1] != value):
+            expected = value or kind
+            found = token[1] if token else "the end of the query"
+            raise QueryError(f"Expected {expected!r} but found {found!r}")
+        self.position += 1
+        return token[1]
+
+    def parse(self) -> Tuple[Tuple[str, str], List[Tuple[str, List[Tuple]]]]:
+        kind = self.take("word").lower()
+        if kind == "home":
+            start = ("home", "")
+        else:
+            if kind.capitalize() not in (PERSON, FAMILY, EVENT, PLACE):
+                raise QueryError(
+                    f"A query starts with person(...), family(...), event(...), "
+                    f"place(...) or home, not {kind!r}"
+                )
+            self.take("punct", "(")
+            start = (kind.capitalize(), self.take("word"))
+            self.take("punct", ")")
+        steps = []
+        while self.peek() is not None:
+            self.take("punct", ".")
+            name = self.take("word").lower()
+            filters = []
+            if self.peek() == ("punct", "["):
+                self.take("punct", "[")
+                while True:
+                    field = self.take("word").lower()
+                    op = self.take("op")
+                    filters.append((field, op, self.take("word")))
+                    if self.peek() == ("punct", ","):
+                        self.take("punct", ",")
+                        continue
+                    self.take("punct", "]")
+                    break
+            steps.append((name, filters))
+        if len(steps) > MAX_STEPS:
+            raise QueryError(f"A query can have at most {MAX_STEPS} steps")
+        return start, steps
+
+
+def _year(db: Any, event_handle: Optional[str]) -> Optional[int]:
+    if not event_handle:
+        return None
+    span = date_year_span(db.get_raw_event_data(event_handle).get("date"))
+    return (span[0] + span[1]) // 2 if span else None
+
+
+def _ref_event(raw_person: Dict[str, Any], ref_key: str) -> Optional[str]:
+    refs = raw_person.get("event_ref_list") or []
+    index = raw_person.get(ref_key, -1)
+    return refs[index]["ref"] if 0 <= index < len(refs) else None
+
+
+def _event_text(db: Any, event_handle: Optional[str]) -> str:
+    if not event_handle:
+        return ""
+    event = db.get_event_from_handle(event_handle)
+    date = get_date(event)
+    place = place_displayer.display_event(db, event)
+    return ", ".join(part for part in (date, place) if part)
+
+
+def describe(db: Any, object_type: str, handle: str) -> Dict[str, Any]:
+    """
+    Returns the fields of an object that can be filtered on and that are
+    returned in the results.
+    """
+    if object_type == PERSON:
+        raw = db.get_raw_person_data(handle)
+        primary_name = raw.get("primary_name") or {}
+        birth, death = _ref_event(raw, "birth_ref_index"), _ref_event(
+            raw, "death_ref_index"
+        )
+        return {
+            "type": PERSON,
+            "handle": handle,
+            "gramps_id": raw.get("gramps_id"),
+            "name": person_name(raw),
+            "first_name": primary_name.get("first_name", ""),
+            "surname": " ".join(
+                surname.get("surname", "")
+                for surname in primary_name.get("surname_list") or []
+            ),
+            "gender": GENDERS.get(raw.get("gender"), "unknown"),
+            "birth": _event_text(db, birth),
+            "birth_year": _year(db, birth),
+            "death": _event_text(db, death),
+            "death_year": _year(db, death),
+        }
+    if object_type == FAMILY:
+        raw = db.get_raw_family_data(handle)
+        return {
+            "type": FAMILY,
+            "handle": handle,
+            "gramps_id": raw.get("gramps_id"),
+            "name": family_name(db, raw),
+            "relationship": FamilyRelType(raw["type"]).xml_str(),
+        }
+    if object_type == EVENT:
+        raw = db.get_raw_event_data(handle)
+        event = db.get_event_from_handle(handle)
+        return {
+            "type": EVENT,
+            "handle": handle,
+            "gramps_id": raw.get("gramps_id"),
+            "event_type": event_type_name(raw["type"]),
+            "date": get_date(event),
+            "year": _year(db, handle),
+            "place": place_displayer.display_event(db, event),
+            "description": raw.get("description", ""),
+        }
+    raw = db.get_raw_place_data(handle)
+    return {
+        "type": PLACE,
+        "handle": handle,
+        "gramps_id": raw.get("gramps_id"),
+        "name": (raw.get("name") or {}).get("value", ""),
+        "title": place_displayer.display(db, db.get_place_from_handle(handle)),
+        "place_type": PlaceType(raw["place_type"]).xml_str(),
+    }
+
+
+def _matches(fields: Dict[str, Any], filters: List[Tuple[str, str, str]]) -> bool:
+    for field, op, expected in filters:
+        if fields["type"] == EVENT and field == "type":
+            field = "event_type"
+        elif fields["type"] == PLACE and field == "type":
+            field = "place_type"
+        if field not in fields:
+            raise QueryError(
+                f"{fields['type']} has no field {field!r}; use one of "
+                f"{', '.join(name for name in fields if name != 'handle')}"
+            )
+        value = fields[field]
+        if op in ("<", ">", "<=", ">="):
+            try:
+                bound = int(expected)
+            except ValueError:
+                raise QueryError(f"{field} {op} needs a number, not {expected!r}")
+            if value is None:
+                return False
+            if not {
+                "<": value < bound,
+                ">": value > bound,
+                "<=": value <= bound,
+                ">=": value >= bound,
+            }[op]:
+                return False
+            continue
+        text = "" if value is None else str(value).lower()
+        expected = expected.lower()
+        if op == "=" and text != expected:
+            return False
+        if op == "!=" and text == expected:
+            return False
+        if op == "~" and expected not in text:
+            return False
+    return True
+
+
+PARENT_KEYS = ("father_handle", "mother_handle")
+
+
+def _refs(raw: Dict[str, Any], key: str) -> List[str]:
+    return [ref["ref"] for ref in raw.get(key) or []]
+
+
+def _parent_families(db: Any, handle: str) -> List[Dict[str, Any]]:
+    raw_person = db.get_raw_person_data(handle)
+    return [
+        db.get_raw_family_data(family_handle)
+        for family_handle in raw_person.get("parent_family_list") or []
+    ]
+
+
+def _own_families(db: Any, handle: str) -> List[Dict[str, Any]]:
+    raw_person = db.get_raw_person_data(handle)
+    return [
+        db.get_raw_family_data(family_handle)
+        for family_handle in raw_person.get("family_list") or []
+    ]
+
+
+def _parents(families: List[Dict[str, Any]], keys: Tuple[str, ...]) -> List[str]:
+    return [family[key] for family in families for key in keys if family.get(key)]
+
+
+def _children(families: List[Dict[str, Any]]) -> List[str]:
+    return [child for family in families for child in _refs(family, "child_ref_list")]
+
+
+def _spouses(db: Any, handle: str) -> List[str]:
+    partners = _parents(_own_families(db, handle), PARENT_KEYS)
+    return [partner for partner in partners if partner != handle]
+
+
+def _siblings(db: Any, handle: str) -> List[str]:
+    children = _children(_parent_families(db, handle))
+    return [child for child in children if child != handle]
+
+
+def _ref_events(ref_key: str) -> Callable[[Any, str], List[str]]:
+    def step(db: Any, handle: str) -> List[str]:
+        event_handle = _ref_event(db.get_raw_person_data(handle), ref_key)
+        return [event_handle] if event_handle else []
+
+    return step
+
+
+def _event_place(db: Any, handle: str) -> List[str]:
+    place = db.get_raw_event_data(handle).get("place")
+    return [place] if place else []
+
+
+def _participants(db: Any, handle: str) -> List[str]:
+    people = []
+    for class_name, ref_handle in db.find_backlink_handles(handle, [PERSON, FAMILY]):
+        if class_name == PERSON:
+            people.append(ref_handle)
+        else:
+            people.extend(_parents([db.get_raw_family_data(ref_handle)], PARENT_KEYS))
+    return people
+
+
+# (object type, step) -> (type of the objects reached, function returning
+# their handles)
+STEPS: Dict[Tuple[str, str], Tuple[str, Callable[[Any, str], List[str]]]] = {
+    (PERSON, "parents"): (
+        PERSON,
+        lambda db, h: _parents(_parent_families(db, h), PARENT_KEYS),
+    ),
+    (PERSON, "father"): (
+        PERSON,
+        lambda db, h: _parents(_parent_families(db, h), ("father_handle",)),
+    ),
+    (PERSON, "mother"): (
+        PERSON,
+        lambda db, h: _parents(_parent_families(db, h), ("mother_handle",)),
+    ),
+    (PERSON, "children"): (PERSON, lambda db, h: _children(_own_families(db, h))),
+    (PERSON, "spouses"): (PERSON, _spouses),
+    (PERSON, "siblings"): (PERSON, _siblings),
+    (PERSON, "families"): (
+        FAMILY,
+        lambda db, h: db.get_raw_person_data(h).get("family_list") or [],
+    ),
+    (PERSON, "parent_families"): (
+        FAMILY,
+        lambda db, h: db.get_raw_person_data(h).get("parent_family_list") or [],
+    ),
+    (PERSON, "events"): (
+        EVENT,
+        lambda db, h: _refs(db.get_raw_person_data(h), "event_ref_list"),
+    ),
+    (PERSON, "birth"): (EVENT, _ref_events("birth_ref_index")),
+    (PERSON, "death"): (EVENT, _ref_events("death_ref_index")),
+    (FAMILY, "father"): (
+        PERSON,
+        lambda db, h: _parents([db.get_raw_family_data(h)], ("father_handle",)),
+    ),
+    (FAMILY, "mother"): (
+        PERSON,
+        lambda db, h: _parents([db.get_raw_family_data(h)], ("mother_handle",)),
+    ),
+    (FAMILY, "parents"): (
+        PERSON,
+        lambda db, h: _parents([db.get_raw_family_data(h)], PARENT_KEYS),
+    ),
+    (FAMILY, "children"): (
+        PERSON,
+        lambda db, h: _children([db.get_raw_family_data(h)]),
+    ),
+    (FAMILY, "events"): (
+        EVENT,
+        lambda db, h: _refs(db.get_raw_family_data(h), "event_ref_list"),
+    ),
+    (EVENT, "place"): (PLACE, _event_place),
+    (EVENT, "participants"): (PERSON, _participants),
+    (PLACE, "enclosed_by"): (
+        PLACE,
+        lambda db, h: _refs(db.get_raw_place_data(h), "placeref_list"),
+    ),
+}
+
+
+def _start(
+    db: Any,
+    object_type: str,
+    identifier: str,
+    index: Optional[Any] = None,
+    cancel: Optional[CancellationToken] = None,
+) -> str:
+    """
+    Returns the handle of the start object, given by handle, Gramps ID or,
+    for a person, by a name that matches exactly one person, found like
+    find_people_by_name does with `index`.
+    """
+    if object_type == "home":
+        person = db.get_default_person()
+        if person is None:
+            raise QueryError("The tree has no home person")
+        return person.handle
+    method = object_type.lower()
+    if getattr(db, f"has_{method}_handle")(identifier):
+        return identifier
+    by_id = getattr(db, f"get_{method}_from_gramps_id")(identifier)
+    if by_id is not None:
+        return by_id.handle
+    if object_type == PERSON:
+        handle = resolve_person(
+            lambda name, **kwargs: find_people(
+                db, name, index=index, cancel=cancel, **kwargs
+            ),
+            identifier,
+        )
+        if handle is not None:
+            return handle
+        raise QueryError(
+            f"No one person is named {identifier!r}; give a first name and "
+            "surname, or start from a handle or Gramps ID (see find_people_by_name)"
+        )
+    raise QueryError(f"No {object_type.lower()} {identifier!r} in the tree")
+
+
+def run_query(
+    db: Any,
+    query: str,
+    limit: int,
+    index: Optional[Any] = None,
+    cancel: Optional[CancellationToken] = None,
+) -> Dict[str, Any]:
+    """
+    Runs a query and returns at most `limit` of the objects it reaches.
+    `index` is the SidecarIndex of the tree, if any, to find a start person
+    by name. Raises QueryCancelled when `cancel` is cancelled.
+    """
+    (start_type, identifier), steps = _Parser(query).parse()
+    object_type = PERSON if start_type == "home" else start_type
+    handles = [_start(db, start_type, identifier, index, cancel)]
+    truncated = False
+    described: Dict[str, Dict[str, Any]] = {}
+    for name, filters in steps:
+        step = STEPS.get((object_type, name))
+        if step is None:
+            names = sorted(step for kind, step in STEPS if kind == object_type)
+            raise QueryError(
+                f"{object_type} has no step {name!r}; use one of {', '.join(names)}"
+            )
+        object_type, follow = step
+        if cancel is not None:
+            cancel.raise_if_cancelled()
+        reached: Dict[str, None] = {}
+        for handle in handles:
+            for next_handle in follow(db, handle):
+                reached[next_handle] = None
+        handles = list(reached)
+        if filters:
+            kept = []
+            for handle in handles:
+                if handle not in described:
+                    described[handle] = describe(db, object_type, handle)
+                if _matches(described[handle], filters):
+                    kept.append(handle)
+            handles = kept
+        if len(handles) > MAX_FANOUT:
+            handles = handles[:MAX_FANOUT]
+            truncated = True
+    total = len(handles)
+    results = [
+        described.get(handle) or describe(db, object_type, handle)
+        for handle in handles[:limit]
+    ]
+    return {
+        "query": query,
+        "result_type": object_type,
+        "total": total,
+        "truncated": truncated or total > limit,
+        "results": results,
+    }
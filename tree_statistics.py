@@ -0,0 +1,503 @@
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from gramps.gen.lib import Person, PlaceType
+
+from cancellation import CancellationToken, checked
+from columnar_export import ColumnarTree
+from rawdata_utils import date_year_span, event_type_name, primary_surname
+from scan_engine import latest_change
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+LOG = logging.getLogger("tree_statistics")
+
+# Gramps uses year 0 for "no year known"; so do we.
+MISSING_YEAR = 0
+# the tables of the database the columnar export is made of
+EXPORTED_TABLES = ("person", "family", "event", "place")
+# lifespans outside 0 to this many years are data errors or vague dates
+MAX_LIFESPAN = 120
+# how many "enclosed by" steps we follow to find e.g. the province of a place
+MAX_PLACE_DEPTH = 12
+
+GENDER_LABELS = {
+    Person.FEMALE: "female",
+    Person.MALE: "male",
+    Person.UNKNOWN: "unknown",
+}
+
+PEOPLE_METRICS = ("count", "mean_lifespan", "min_lifespan", "max_lifespan")
+EVENT_METRICS = ("event_count",)
+PERIODS = {"decade": 10, "century": 100}
+
+
+def _place_type_value(name: str) -> Optional[int]:
+    """
+    Returns the PlaceType value for an untranslated name like "Province".
+    """
+    place_type = PlaceType()
+    place_type.set_from_xml_str(name.capitalize())
+    if place_type.value == PlaceType.CUSTOM:
+        return None
+    return place_type.value
+
+
+class TreeSnapshot:
+    """
+    Columnar, read-only snapshot of the people and events of a tree, held
+    as NumPy arrays so that tree-wide statistics are a handful of
+    vectorized operations instead of a walk over every person.
+
+    Strings (surnames, event types, place names) are stored once in a table
+    and referred to by their position in that table; -1 means "none".
+    """
+
+    def __init__(self) -> None:
+        if np is None:
+            raise Exception("tree_statistics requires numpy")
+        self.surnames: List[str] = []
+        self.event_types: List[str] = []
+        self.place_names: List[str] = []
+        self.place_handles: List[str] = []
+
+    @classmethod
+    def from_database(
+        cls, db: Any, cancel: Optional[CancellationToken] = None
+    ) -> "TreeSnapshot":
+        """
+        Builds the snapshot from the database; raises QueryCancelled when
+        `cancel` is cancelled while the tree is read.
+        """
+        snapshot = cls()
+        place_index: Dict[str, int] = {}
+        place_parents: List[Optional[str]] = []
+        place_types: List[int] = []
+        for handle in checked(db.iter_place_handles(), cancel):
+            raw_place = db.get_raw_place_data(handle)
+            place_index[handle] = len(snapshot.place_handles)
+            snapshot.place_handles.append(handle)
+            snapshot.place_names.append((raw_place.get("name") or {}).get("value", ""))
+            place_types.append((raw_place.get("place_type") or {}).get("value", -1))
+            refs = raw_place.get("placeref_list") or []
+            place_parents.append(refs[0]["ref"] if refs else None)
+        snapshot.place_type = np.array(place_types, dtype=np.int32)
+        snapshot.place_parent = np.array(
+            [place_index.get(parent, -1) for parent in place_parents], dtype=np.int32
+        )
+
+        type_index: Dict[str, int] = {}
+        event_rows: Dict[str, int] = {}
+        event_type, event_year, event_place = [], [], []
+        for handle in checked(db.iter_event_handles(), cancel):
+            raw_event = db.get_raw_event_data(handle)
+            type_name = event_type_name(raw_event["type"])
+            if type_name not in type_index:
+                type_index[type_name] = len(snapshot.event_types)
+                snapshot.event_types.append(type_name)
+            span = date_year_span(raw_event.get("date"))
+            event_rows[handle] = len(event_type)
+            event_type.append(type_index[type_name])
+            event_year.append((span[0] + span[1]) // 2 if span else MISSING_YEAR)
+            event_place.append(place_index.get(raw_event.get("place"), -1))
+        snapshot.event_type = np.array(event_type, dtype=np.int32)
+        snapshot.event_year = np.array(event_year, dtype=np.int32)
+        snapshot.event_place = np.array(event_place, dtype=np.int32)
+
+        surname_index: Dict[str, int] = {}
+        surname, gender, birth_event, death_event = [], [], [], []
+        for handle in checked(db.iter_person_handles(), cancel):
+            raw_person = db.get_raw_person_data(handle)
+            name = primary_surname(raw_person)
+            if name not in surname_index:
+                surname_index[name] = len(snapshot.surnames)
+                snapshot.surnames.append(name)
+            surname.append(surname_index[name])
+            gender.append(raw_person.get("gender", Person.UNKNOWN))
+            refs = raw_person.get("event_ref_list") or []
+            for ref_index, rows in (
+                (raw_person.get("birth_ref_index", -1), birth_event),
+                (raw_person.get("death_ref_index", -1), death_event),
+            ):
+                if 0 <= ref_index < len(refs):
+                    rows.append(event_rows.get(refs[ref_index]["ref"], -1))
+                else:
+                    rows.append(-1)
+        snapshot.surname = np.array(surname, dtype=np.int32)
+        snapshot.gender = np.array(gender, dtype=np.int8)
+        snapshot._set_person_events(
+            np.array(birth_event, dtype=np.int64), np.array(death_event, dtype=np.int64)
+        )
+        LOG.debug(
+            f"Tree snapshot: {len(snapshot.surname)} people, "
+            f"{len(snapshot.event_type)} events, {len(place_types)} places"
+        )
+        return snapshot
+
+    @classmethod
+    def from_columnar(cls, tree: ColumnarTree) -> "TreeSnapshot":
+        """
+        Builds the snapshot from a columnar export instead of the database.
+        """
+        snapshot = cls()
+        snapshot.place_handles = tree.column("places", "handle").tolist()
+        snapshot.place_names = tree.column("places", "name").tolist()
+        place_index = {
+            handle: position for position, handle in enumerate(snapshot.place_handles)
+        }
+        type_names, type_ids = np.unique(
+            tree.column("places", "type"), return_inverse=True
+        )
+        type_values = np.array(
+            [_place_type_from_xml(str(name)) for name in type_names], dtype=np.int32
+        )
+        snapshot.place_type = type_values[type_ids].astype(np.int32)
+        snapshot.place_parent = _handle_ids(
+            tree.column("places", "enclosed_by"), place_index
+        )
+
+        type_names, type_ids = np.unique(
+            tree.column("events", "type"), return_inverse=True
+        )
+        snapshot.event_types = type_names.tolist()
+        snapshot.event_type = type_ids.astype(np.int32)
+        first_year = tree.column("events", "first_year")
+        last_year = tree.column("events", "last_year")
+        snapshot.event_year = np.where(
+            first_year != MISSING_YEAR, (first_year + last_year) // 2, MISSING_YEAR
+        ).astype(np.int32)
+        snapshot.event_place = _handle_ids(tree.column("events", "place"), place_index)
+
+        surnames, surname_ids = np.unique(
+            tree.column("people", "surname"), return_inverse=True
+        )
+        snapshot.surnames = surnames.tolist()
+        snapshot.surname = surname_ids.astype(np.int32)
+        snapshot.gender = tree.column("people", "gender").astype(np.int8)
+        for prefix in ("birth", "death"):
+            setattr(
+                snapshot,
+                f"{prefix}_year",
+                tree.column("people", f"{prefix}_year").astype(np.int32),
+            )
+            setattr(
+                snapshot,
+                f"{prefix}_place",
+                _handle_ids(tree.column("people", f"{prefix}_place"), place_index),
+            )
+        return snapshot
+
+    @classmethod
+    def load(
+        cls,
+        db: Any,
+        export_folder: Optional[str] = None,
+        cancel: Optional[CancellationToken] = None,
+    ) -> "TreeSnapshot":
+        """
+        Uses the columnar export in export_folder when there is one for this
+        database made after its last change, and otherwise builds the
+        snapshot from the database.
+        """
+        if ColumnarTree.exists(export_folder):
+            try:
+                tree = ColumnarTree(export_folder)
+            except Exception as exc:
+                LOG.warning(f"{exc}; ignoring it, export the tree again")
+                return cls.from_database(db, cancel)
+            if tree.database != db.get_dbname():
+                LOG.warning(
+                    f"Columnar export in {export_folder} is of database "
+                    f"{tree.database}, not {db.get_dbname()}; ignoring it"
+                )
+            elif latest_change(db, EXPORTED_TABLES) >= tree.created:
+                LOG.warning(
+                    f"Columnar export in {export_folder} is older than the "
+                    "last change of the tree; ignoring it"
+                )
+            else:
+                LOG.debug(f"Loading tree snapshot from {export_folder}")
+                return cls.from_columnar(tree)
+        return cls.from_database(db, cancel)
+
+    def _set_person_events(self, birth_rows: Any, death_rows: Any) -> None:
+        """
+        Copies year and place of the birth and death events onto the people.
+        """
+        for prefix, rows in (("birth", birth_rows), ("death", death_rows)):
+            known = rows >= 0
+            safe_rows = np.where(known, rows, 0)
+            if len(self.event_year):
+                year = np.where(known, self.event_year[safe_rows], MISSING_YEAR)
+                place = np.where(known, self.event_place[safe_rows], -1)
+            else:
+                year = np.full(len(rows), MISSING_YEAR, dtype=np.int32)
+                place = np.full(len(rows), -1, dtype=np.int32)
+            setattr(self, f"{prefix}_year", year.astype(np.int32))
+            setattr(self, f"{prefix}_place", place.astype(np.int32))
+
+    @property
+    def nbytes(self) -> int:
+        arrays = (
+            "surname", "gender", "birth_year", "death_year", "birth_place",
+            "death_place", "event_type", "event_year", "event_place",
+            "place_type", "place_parent",
+        )
+        return sum(getattr(self, name).nbytes for name in arrays)
+
+    def enclosing_place(self, place_ids: Any, place_type: int) -> Any:
+        """
+        For every place id, returns the id of the place of the given type
+        it lies in (or the place itself), -1 if there is none.
+        """
+        current = place_ids.copy()
+        result = np.full_like(current, -1)
+        for _ in range(MAX_PLACE_DEPTH):
+            known = current >= 0
+            if not known.any():
+                break
+            safe = np.where(known, current, 0)
+            hit = known & (result < 0) & (self.place_type[safe] == place_type)
+            result[hit] = current[hit]
+            current = np.where(known, self.place_parent[safe], -1)
+        return result
+
+    # ---------------------------------------------------------------
+    # statistics
+    # ---------------------------------------------------------------
+
+    def statistics(
+        self,
+        metric: str = "count",
+        group_by: str = "",
+        filters: Optional[Dict[str, Any]] = None,
+        limit: int = 25,
+    ) -> Dict[str, Any]:
+        metric = (metric or "count").strip().lower()
+        group_by = (group_by or "").strip().lower()
+        filters = filters or {}
+        if metric in EVENT_METRICS:
+            mask = self._event_mask(filters)
+            values = np.ones(len(self.event_type), dtype=np.float64)
+            keys, labels = self._event_keys(group_by)
+        elif metric in PEOPLE_METRICS:
+            mask = self._people_mask(filters)
+            values = (self.death_year - self.birth_year).astype(np.float64)
+            if metric != "count":
+                mask &= (self.birth_year != MISSING_YEAR) & (
+                    self.death_year != MISSING_YEAR
+                )
+                # death before birth, or vague dates far apart
+                mask &= (values >= 0) & (values <= MAX_LIFESPAN)
+            keys, labels = self._people_keys(group_by)
+        else:
+            raise ValueError(
+                f"Unknown metric '{metric}', use one of: "
+                f"{', '.join(PEOPLE_METRICS + EVENT_METRICS)}"
+            )
+        if keys is not None:
+            mask &= keys >= 0
+        result: Dict[str, Any] = {
+            "metric": metric,
+            "group_by": group_by or None,
+            "considered": int(mask.sum()),
+        }
+        if keys is None:
+            result["value"] = _aggregate(metric, values[mask])
+            return result
+
+        unique_keys, inverse = np.unique(keys[mask], return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(unique_keys))
+        group_values = _group_aggregate(metric, values[mask], inverse, counts)
+        if group_by.endswith(tuple(PERIODS)):
+            # periods read best as a histogram in chronological order
+            order = np.arange(len(unique_keys))
+        else:
+            order = np.lexsort((unique_keys, -group_values))
+        result["total_groups"] = len(unique_keys)
+        result["groups"] = [
+            {
+                "group": labels(int(unique_keys[position])),
+                "value": _round(group_values[position]),
+                "count": int(counts[position]),
+            }
+            for position in order[:limit]
+        ]
+        return result
+
+    def _people_mask(self, filters: Dict[str, Any]) -> Any:
+        mask = np.ones(len(self.surname), dtype=bool)
+        for key, value in filters.items():
+            if key == "gender":
+                genders = [
+                    number
+                    for number, label in GENDER_LABELS.items()
+                    if label == str(value).lower()
+                ]
+                mask &= np.isin(self.gender, genders)
+            elif key == "surname":
+                ids = [
+                    number
+                    for number, name in enumerate(self.surnames)
+                    if name.lower() == str(value).lower()
+                ]
+                mask &= np.isin(self.surname, ids)
+            elif key in ("born_after", "born_before", "died_after", "died_before"):
+                years = self.birth_year if key.startswith("born") else self.death_year
+                known = years != MISSING_YEAR
+                if key.endswith("after"):
+                    mask &= known & (years >= int(value))
+                else:
+                    mask &= known & (years <= int(value))
+            elif key in ("birth_place", "death_place"):
+                places = self.birth_place if key == "birth_place" else self.death_place
+                mask &= self._in_place(places, str(value))
+            else:
+                raise ValueError(
+                    f"Unknown filter '{key}', use: gender, surname, born_after, "
+                    "born_before, died_after, died_before, birth_place, death_place"
+                )
+        return mask
+
+    def _event_mask(self, filters: Dict[str, Any]) -> Any:
+        mask = np.ones(len(self.event_type), dtype=bool)
+        for key, value in filters.items():
+            if key == "event_type":
+                ids = [
+                    number
+                    for number, name in enumerate(self.event_types)
+                    if name.lower() == str(value).lower()
+                ]
+                mask &= np.isin(self.event_type, ids)
+            elif key in ("after", "before"):
+                known = self.event_year != MISSING_YEAR
+                if key == "after":
+                    mask &= known & (self.event_year >= int(value))
+                else:
+                    mask &= known & (self.event_year <= int(value))
+            elif key == "place":
+                mask &= self._in_place(self.event_place, str(value))
+            else:
+                raise ValueError(
+                    f"Unknown filter '{key}', use: event_type, after, before, place"
+                )
+        return mask
+
+    def _in_place(self, place_ids: Any, name: str) -> Any:
+        """
+        True for every place id that is, or lies within, a place whose name
+        contains `name`.
+        """
+        name = name.lower()
+        matching = np.array(
+            [name in place_name.lower() for place_name in self.place_names] or [False]
+        )
+        inside = np.zeros(len(place_ids), dtype=bool)
+        current = place_ids.copy()
+        for _ in range(MAX_PLACE_DEPTH):
+            known = current >= 0
+            if not known.any():
+                break
+            safe = np.where(known, current, 0)
+            inside |= known & matching[safe]
+            current = np.where(known, self.place_parent[safe], -1)
+        return inside
+
+    def _people_keys(self, group_by: str) -> Tuple[Any, Any]:
+        if not group_by:
+            return None, None
+        if group_by == "surname":
+            return self.surname, lambda key: self.surnames[key]
+        if group_by == "gender":
+            return self.gender.astype(np.int32), lambda key: GENDER_LABELS.get(
+                key, str(key)
+            )
+        prefix, _, detail = group_by.partition("_")
+        if prefix in ("birth", "death"):
+            if detail in PERIODS:
+                years = getattr(self, f"{prefix}_year")
+                return _period_keys(years, PERIODS[detail])
+            places = getattr(self, f"{prefix}_place")
+            return self._place_keys(places, detail)
+        raise ValueError(
+            f"Unknown group_by '{group_by}', use: surname, gender, birth_decade, "
+            "birth_century, death_decade, death_century, birth_place, death_place "
+            "or birth_/death_ followed by a place type such as birth_province"
+        )
+
+    def _event_keys(self, group_by: str) -> Tuple[Any, Any]:
+        if not group_by:
+            return None, None
+        if group_by == "event_type":
+            return self.event_type, lambda key: self.event_types[key]
+        prefix, _, detail = group_by.partition("_")
+        if prefix == "event":
+            if detail in PERIODS:
+                return _period_keys(self.event_year, PERIODS[detail])
+            return self._place_keys(self.event_place, detail)
+        raise ValueError(
+            f"Unknown group_by '{group_by}' for event_count, use: event_type, "
+            "event_decade, event_century, event_place or event_ followed by a "
+            "place type such as event_province"
+        )
+
+    def _place_keys(self, place_ids: Any, detail: str) -> Tuple[Any, Any]:
+        if detail != "place":
+            place_type = _place_type_value(detail)
+            if place_type is None:
+                raise ValueError(f"Unknown place type '{detail}'")
+            place_ids = self.enclosing_place(place_ids, place_type)
+        return place_ids, lambda key: self.place_names[key]
+
+
+def _place_type_from_xml(name: str) -> int:
+    place_type = PlaceType()
+    place_type.set_from_xml_str(name)
+    return place_type.value
+
+
+def _handle_ids(handles: Any, index: Dict[str, int]) -> Any:
+    """
+    Maps an array of handles onto positions in `index`, -1 when unknown.
+    """
+    return np.array(
+        [index.get(handle, -1) for handle in handles.tolist()], dtype=np.int32
+    )
+
+
+def _period_keys(years: Any, width: int) -> Tuple[Any, Any]:
+    keys = np.where(years != MISSING_YEAR, years // width, -1)
+    return keys, lambda key: f"{key * width}-{key * width + width - 1}"
+
+
+def _round(value: float) -> Any:
+    return int(value) if float(value).is_integer() else round(float(value), 1)
+
+
+def _aggregate(metric: str, values: Any) -> Any:
+    if metric in ("count", "event_count"):
+        return int(len(values))
+    if not len(values):
+        return None
+    if metric == "mean_lifespan":
+        return _round(values.mean())
+    if metric == "min_lifespan":
+        return _round(values.min())
+    return _round(values.max())
+
+
+def _group_aggregate(metric: str, values: Any, inverse: Any, counts: Any) -> Any:
+    if metric in ("count", "event_count"):
+        return counts.astype(np.float64)
+    if metric == "mean_lifespan":
+        return np.bincount(inverse, weights=values, minlength=len(counts)) / counts
+    if metric == "min_lifespan":
+        result = np.full(len(counts), np.inf)
+        np.minimum.at(result, inverse, values)
+        return result
+    result = np.full(len(counts), -np.inf)
+    np.maximum.at(result, inverse, values)
+    return result